@@ -1,16 +1,27 @@
-import py_qmc5883l
 import utils
 import logging
-import time
+import math
+import collections
 import sys
 import os
-import serial
 import status
+import nmea
+import gpsd
+import hal
+import clock as clk
 
 logger = logging.getLogger(__name__)
 
+METERS_PER_DEGREE = 111320.0
+KNOTS_TO_MPS = 0.514444
+#Local plane radius before it is re-centred on the current fix
+PLANE_RADIUS = 5000
+HEADING_CONTROLS = ["continuous", "bucketed"]
+GPS_SOURCES = ["serial", "gpsd"]
+
 class GPSCoord(object):
-	
+	__slots__ = ('latitude', 'longitude', 'altitude')
+
 	def __init__(this, latitude, longitude, altitude):
 		this.latitude = latitude
 		this.longitude = longitude
@@ -36,100 +47,438 @@ class GPSCoord(object):
 				print(f"Invalid Values in GPSCoord String [{str}]")
 		return GPSCoord(0,0,0)
 
-	def fromGPRMC(str):
-		logger.info(f"\tDecoding $GPRMC [{str}]")
-		split = str.split(",")
-		if len(split) != 12:
-			logger.warning("\t\t$GPRMC invalid length")
-		if len(split) < 6:
-			logger.warning("\t\t$GPRMC invalid length")
-		else:
-			return GPSCoord(format(split[2],split[3]),format(split[4],split[5]),0)
-		return GPSCoord(0,0,0)
-	
-	def fromGPGGA(str):
-		logger.info(f"\tDecoding $GPGGA [{str}]")
-		split = str.split(",")
-		if len(split) != 15:
-			logger.warning(f"\t\t$GPGGA invalid length")
-		if len(split) < 9:
-			logger.warning(f"\t\t$GPGGA invalid length")
+class GPSFix(GPSCoord):
+	"""
+	A fix as published by GPSReader, with when it was read (`at`) and the speed (m/s) and
+	 course over ground, both None when the receiver did not report them. `mode` is the fix
+	 mode (gpsd.MODE_2D or MODE_3D), `satellites` and `hdop` come from the latest GGA or SKY.
+	 The 95% error estimates (metres, m/s and degrees) are only reported by gpsd. Any of
+	 these is None when unknown.
+	"""
+	__slots__ = ('at', 'speed', 'course', 'mode', 'satellites', 'hdop',
+				'horizontalError', 'verticalError', 'speedError', 'courseError')
+
+	def __init__(this, latitude = 0, longitude = 0, altitude = 0, at = 0, speed = None, course = None):
+		GPSCoord.__init__(this, latitude, longitude, altitude)
+		this.at = at
+		this.speed = speed
+		this.course = course
+		this.mode = None
+		this.satellites = None
+		this.hdop = None
+		this.horizontalError = None
+		this.verticalError = None
+		this.speedError = None
+		this.courseError = None
+
+class LocalPlane(object):
+	"""
+	East/north metres on a plane tangent to the earth at `origin`. The metres per degree are
+	 computed once, so projecting a fix is a subtraction and a multiply per axis. Within a few
+	 kilometres of the origin the error is well under the GPS noise.
+	"""
+	def __init__(this, origin):
+		this.origin = GPSCoord(origin.latitude, origin.longitude, origin.altitude)
+		this.northScale = METERS_PER_DEGREE
+		this.eastScale = METERS_PER_DEGREE * math.cos(math.radians(origin.latitude))
+
+	def toENU(this, latitude, longitude):
+		dLon = longitude - this.origin.longitude
+		if dLon > 180:
+			dLon -= 360
+		elif dLon < -180:
+			dLon += 360
+		return dLon * this.eastScale, (latitude - this.origin.latitude) * this.northScale
+
+	def fromENU(this, east, north):
+		return GPSCoord(this.origin.latitude + north / this.northScale, this.origin.longitude + east / this.eastScale, this.origin.altitude)
+
+def wrapAngle(degrees):
+	""":return degrees wrapped into [-180, 180)"""
+	return (degrees + 180) % 360 - 180
+
+class HeadingController(object):
+	"""
+	Continuous heading hold. The motor is positioned (as a turn position in seconds, within
+	 +/-maxTurnTime) from the wrapped heading error and the turn rate:
+
+		target = gain * (kp * error - kd * turnRate) + ki * integral(error)
+
+	 With a bow motor the turn rate follows the motor angle, so the proportional term eases the
+	 motor back toward centre as the bow comes round and the rate term damps the overshoot. The
+	 boat turns faster the faster it goes, so kp and kd are set for half speed and scaled by
+	 gain = halfSpeed / speed fraction, at most maxGain. The integral trims out a steady yaw
+	 (wind, a bent shaft) and stops accumulating while the target is pinned against the turn
+	 range (anti-windup). The motor is only moved when the target is more than `deadband`
+	 seconds from where it is, which keeps relay actuations down.
+	"""
+	def __init__(this, kp = 0.08, kd = 0.05, ki = 0.001, deadband = 0.35, integralLimit = 1000, maxGain = 3.0):
+		this.kp = kp
+		this.kd = kd
+		this.ki = ki
+		this.deadband = deadband
+		this.integralLimit = integralLimit
+		this.maxGain = maxGain
+		this.reset()
+
+	def reset(this):
+		this.integral = 0.0
+		this.at = None
+
+	def update(this, error, turnRate, speedFraction, now, controls):
+		"""
+		:param error        : wrapped heading error in degrees, positive to turn right
+		:param turnRate     : degrees/sec, positive turning right
+		:param speedFraction: current speed over Speed.MAX, above 0
+		:return the turn position target in seconds
+		"""
+		dt = now - this.at if this.at is not None else 0
+		this.at = now
+		limit = controls.maxTurnTime
+		gain = min(this.maxGain, 0.5 / speedFraction)
+		unclamped = gain * (this.kp * error - this.kd * turnRate) + this.ki * this.integral
+		target = max(-limit, min(limit, unclamped))
+		#Anti-windup: only integrate while the output is free to move in the direction the error asks for
+		if target == unclamped or (unclamped > limit) != (error > 0):
+			this.integral = max(-this.integralLimit, min(this.integralLimit, this.integral + error * dt))
+		if controls.turningLeft or controls.turningRight:
+			return target
+		position = controls.turnPosition()
+		if abs(target - position) < this.deadband:
+			return target
+		logger.info("Steering %.1f^ (rate %.1f^/s), motor to %.2f sec", error, turnRate, target)
+		if target < position:
+			controls.turnLeft(target)
 		else:
-			numSats = -1
-			alt = -1
+			controls.turnRight(target)
+		return target
+
+class GPSReader(utils.WorkerThread):
+	"""
+	Drains the GPS serial port on its own thread so the control loop never waits on the UART.
+	 The most recent valid fix is published to `latest` as a GPSFix, stamped with `clock`. Each
+	 fix is a new record, complete before it is published with a single reference assignment and
+	 never written again, so readers can keep it without a lock or a copy.
+
+	 RMC speed and course carry over to the GGA fixes that follow, like GGA altitude does to RMC.
+	 `onFix`, when set, is called on the reader's thread after each fix is published.
+	"""
+	def __init__(this, gps, clock = None):
+		utils.WorkerThread.__init__(this, "GPS_Thread")
+		this.clock = clock or clk.get()
+		this.gps = gps
+		this.parser = nmea.NMEAParser()
+		this.altitude = 0
+		this.mode = None
+		this.satellites = None
+		this.hdop = None
+		this.speed = None
+		this.course = None
+		this.latest = GPSFix()
+		this.onFix = None
+
+	def record(this, latitude, longitude, altitude, speed = None, course = None,
+				horizontalError = None, verticalError = None, speedError = None, courseError = None):
+		"""Publish a fix read now with the current mode and satellites"""
+		fix = GPSFix(latitude, longitude, altitude, this.clock.now(), speed, course)
+		fix.mode = this.mode
+		fix.satellites = this.satellites
+		fix.hdop = this.hdop
+		fix.horizontalError = horizontalError
+		fix.verticalError = verticalError
+		fix.speedError = speedError
+		fix.courseError = courseError
+		this.latest = fix
+		onFix = this.onFix
+		if onFix:
+			onFix()
+
+	def publish(this, fixes):
+		"""Publish the valid RMC and GGA fixes, the receiver reports (0,0) or no position without a fix"""
+		for fix in fixes:
+			if isinstance(fix, nmea.GGAFix):
+				if fix.altitude is not None:
+					this.altitude = fix.altitude
+				if fix.quality <= 0:
+					continue
+				this.satellites = fix.satellites
+				this.hdop = fix.hdop
+			elif isinstance(fix, nmea.RMCFix):
+				if not fix.valid:
+					continue
+				this.speed = this.course = None
+				if fix.speedKnots is not None and fix.course is not None:
+					this.speed = fix.speedKnots * KNOTS_TO_MPS
+					this.course = fix.course
+			elif isinstance(fix, nmea.GSAFix):
+				#GSA fix types are the same 1 (none), 2 (2D) and 3 (3D) as gpsd modes
+				this.mode = fix.fixType
+				continue
+			else:
+				continue
+			if fix.latitude and fix.longitude:
+				this.record(fix.latitude, fix.longitude, this.altitude, this.speed, this.course)
+
+	def read(this):
+		#Block for the first byte (up to the port timeout), then take whatever else is buffered
+		chunk = this.gps.read(1)
+		if chunk and this.gps.in_waiting:
+			chunk += this.gps.read(this.gps.in_waiting)
+		return chunk
+
+	def waitReady(this, seconds):
+		"""
+		Before the thread starts, read until the receiver has sent its first bytes (NMEA, or
+		 gpsd's greeting), for up to seconds. What arrives is parsed and published as usual.
+		:return True once bytes have arrived
+		"""
+		clock = this.clock
+		deadline = clock.now() + seconds
+		while True:
 			try:
-				numSats = int(split[5])
-				alt = float(split[8])
-			except ValueError:
-				logger.warning("\t\tInvalid satellite count or altitude")
-			if numSats < 1:
-				logger.warning("\t\tInsufficient statelite count")
-			elif alt != -1:
-				return GPSCoord(format(split[1],split[2]), format(split[3],split[4]),alt)
-		return GPSCoord(0,0,0)
+				chunk = this.read()
+			except OSError as e:
+				logger.warning("GPS read from %s failed: %s", this.gps, e)
+				return False
+			if chunk:
+				this.publish(this.parser.feed(chunk))
+				return True
+			if clock.now() >= deadline:
+				logger.warning("GPS sent nothing within %s sec", seconds)
+				return False
 
-	def format(str, direction):
-		multiplier = float(0)
-		if "S" == direction or "s" == direction or "W" == direction or "w" == direction:
-			multiplier = float(-1)
-		elif "N" == direction or "n" == direction or "E" == direction or "e" == direction:
-			multiplier = float(1)
-		else:
-			logger.warning(f"Invalid lat/long orientation: {directon}")
-			return 0
-
-		parts = str.split(".")
-		slen = len(parts[0])
-		if len(parts) != 2 or slen < 2:
-			logger.warning(f"\t\t\tInvalid coordinates {str}")
-			return 0
-		degrees = parts[0][:slen-2]
-		mins = parts[0][slen-3:slen]+"."+parts[1]
-		try:
-			return (float(degrees) + (float(mins)/float(60))) * multiplier
-		except ValueError:
-			logger.warning(f"\t\t\tInvalid coordinate values {str}")
+	def run(this):
+		import serial
+		logger.info("GPS Reader Starting")
+		while not this.isStopped():
+			try:
+				chunk = this.read()
+			except serial.SerialException as e:
+				logger.warning(f"GPS serial read failed: {e}")
+				this.stopFlag.wait(1)
+				continue
+			if chunk:
+				this.publish(this.parser.feed(chunk))
+		this.gps.close()
 
-def readFromSerial(gps):
+class GPSDReader(GPSReader):
 	"""
-	:param gps          : Serial Port GPS device is connected to
-	:return GPSCoord  
+	Takes fixes from gpsd instead of the serial port, so gpsd can own /dev/serial0 and nothing
+	 competes with it for the UART. `gps` is a gpsd.Connection. TPV reports with a 2D or 3D fix
+	 are published with gpsd's speed, track, mode and error estimates, SKY reports set the
+	 satellites and hdop of the fixes that follow. A lost connection is reopened every second.
 	"""
-	data = gps.readline()
-	if data:
-		logger.debug("\tReading serial...")
-		#get identifier
-		message = data[0:6]
-		data = data.decode("utf-8", errors="ignore")
-		if message == "$GPRMC":
-			return GPSCoord.fromGPRMC(data)
-		elif message == "$GPGGA":
-			return GPSCoord.fromGPGGA(data)
-		elif data.startswith("$GP"):
-			logger.debug(f"\t\tUnsupported NMEA: [{message}]")
-		else:
-			logger.warning(f"\t\tUnrecognized sentence: [{message}]")
-	return GPSCoord(0,0,0)
+	def __init__(this, gps, clock = None):
+		GPSReader.__init__(this, gps, clock)
+		this.name = "GPSD_Thread"
+		this.parser = gpsd.GPSDParser()
+
+	def read(this):
+		return this.gps.read()
+
+	def publish(this, reports):
+		for r in reports:
+			if isinstance(r, gpsd.SKYReport):
+				this.satellites = r.used
+				this.hdop = r.hdop
+				continue
+			if not isinstance(r, gpsd.TPVReport) or r.mode < gpsd.MODE_2D or not r.latitude or not r.longitude:
+				continue
+			this.mode = r.mode
+			if r.altitude is not None:
+				this.altitude = r.altitude
+			speed = course = None
+			if r.speed is not None and r.track is not None:
+				speed = r.speed
+				course = r.track
+			this.record(r.latitude, r.longitude, this.altitude, speed, course,
+						r.horizontalError, r.verticalError, r.speedError, r.trackError)
+
+	def run(this):
+		logger.info("GPS Reader Starting on %s", this.gps)
+		while not this.isStopped():
+			try:
+				chunk = this.read()
+			except OSError as e:
+				logger.warning("GPS read from %s failed: %s", this.gps, e)
+				this.gps.close()
+				while not this.stopFlag.wait(1):
+					try:
+						this.gps.open()
+					except OSError:
+						continue
+					this.parser.reset()
+					logger.info("GPS reconnected to %s", this.gps)
+					break
+				continue
+			if chunk:
+				this.publish(this.parser.feed(chunk))
+		this.gps.close()
 
 class Navigation(object):
+	"""
+	 Devices are opened in the constructor unless openDevices is False, in which case the caller
+	 runs openHeading, openGPS (e.g. concurrently with other devices) and openEstimator before start().
+	 With an estimator, read() also fuses headings, fixes and the commanded speed and turn into
+	 `estimator` every tick. Its positions are metres on `plane`, centred on the first fix.
+
+	 Anchor lock holds position with a deadband: on station (within anchorRadius metres) the motor
+	 is off until the boat is more than anchorReleaseRadius away, then it steers for the anchor and
+	 steps the speed up from anchorSpeed with distance until it is back within anchorRadius.
+	 Distances are taken from a line fitted through the last anchorFixes fixes, anchorLeadSecs
+	 ahead, so GPS noise is averaged out and the motor lets off before it overshoots.
 
-	def __init__(this, status_q, turnDebounceSecs, serialPort = '/dev/serial0', serialBaudRate = 9600, serialTimeout = 0.5):
+	 headingControl selects how the motor is steered onto the locked heading or anchor bearing:
+	 "continuous" runs a HeadingController, "bucketed" turns for a fixed fraction of maxTurnTime
+	 picked from the size of the error, waiting a speed scaled debounce between turns.
+
+	 Sample, fix and turn times are all taken on `clock`, which defaults to the clock module's.
+	"""
+	def __init__(this, status_q, turnDebounceSecs, serialPort = '/dev/serial0', serialBaudRate = 9600, serialTimeout = 0.5,
+				headingRateHz = 100, headingWindow = 25, calibrationFile = None, openDevices = True,
+				anchorRadius = 3, anchorReleaseRadius = 8, anchorLeadSecs = 3, anchorFixes = 15, anchorMetersPerSpeed = 2, anchorSpeed = 4,
+				headingControl = "continuous", clock = None):
+		this.clock = clock or clk.get()
 		this.headingSensor = None
+		this.headingSampler = None
+		this.gpsReader = None
 		this.status_q = status_q
-		try:
-			this.headingSensor = py_qmc5883l.QMC5883L()
-		except:
-			logger.warning("Error initializing heading sensor")
+		this.calibrationFile = calibrationFile
+		this.calibrating = False
 		this.heading = 0
+		this.turnRate = 0
+		this.headingAt = 0
 		this.headingLock = None
 		this.coarseCorrection = 0
 		
-		this.lastGPS = 0
-		this.gps = serial.Serial(serialPort, baudrate = serialBaudRate, timeout = serialTimeout)
-		this.position = None
+		this.position = GPSFix()
+		this.positionAt = 0
 		this.anchorLock = None
+		this.anchorPlane = None
+		this.anchorFixes = collections.deque(maxlen = anchorFixes)
+		this.anchorFixAt = 0
+		this.anchorSteppedAt = 0
+		this.anchorDistance = None
+		this.anchorBearing = 0
+		this.anchorHolding = True
+		this.anchorRadius = anchorRadius
+		this.anchorReleaseRadius = anchorReleaseRadius
+		this.anchorLeadSecs = anchorLeadSecs
+		this.anchorMetersPerSpeed = anchorMetersPerSpeed
+		this.anchorSpeed = anchorSpeed
+		if headingControl not in HEADING_CONTROLS:
+			raise ValueError(f"Unknown heading control {headingControl}, expected one of {HEADING_CONTROLS}")
+		this.headingControl = headingControl
+		this.controller = HeadingController()
 		this.turnDebounceSecs = turnDebounceSecs
 		this.lastTurnSentAt = 0
+		this.estimator = None
+		this.plane = None
+		this.fusedHeadingAt = None
+		this.fusedPositionAt = 0
+		if openDevices:
+			this.openHeading(headingRateHz, headingWindow)
+			this.openGPS(serialPort, serialBaudRate, serialTimeout)
+			this.openEstimator()
+
+	def openHeading(this, rateHz, window, readySecs = 0):
+		"""
+		Open the magnetometer and its sampler, importing numpy on first use. With readySecs, wait
+		 up to that long for the sensor to return a first sample.
+		:return True when the sensor is ready
+		"""
+		import heading
+		try:
+			this.headingSensor = hal.get().magnetometer(rateHz)
+			sampler = heading.HeadingSampler(this.headingSensor, rateHz, window, clock = this.clock)
+		except:
+			logger.warning("Error initializing heading sensor")
+			return False
+		calibrationFile = this.calibrationFile
+		if calibrationFile and os.path.exists(calibrationFile):
+			try:
+				sampler.setCalibration(heading.Calibration.load(calibrationFile))
+			except (OSError, ValueError, KeyError) as e:
+				logger.warning("Ignoring unreadable heading calibration %s: %s", calibrationFile, e)
+		ready = readySecs <= 0
+		clock = this.clock
+		deadline = clock.now() + readySecs
+		while not ready:
+			try:
+				ready = sampler.sample() is not None
+			except OSError:
+				pass
+			if not ready:
+				if clock.now() >= deadline:
+					logger.warning("Heading sensor returned no data within %s sec", readySecs)
+					break
+				clock.sleep(0.005)
+		this.headingSampler = sampler
+		return ready
+
+	def openGPS(this, port, baudRate, timeout, source = "serial", gpsdHost = gpsd.DEFAULT_HOST, gpsdPort = gpsd.DEFAULT_PORT,
+				readySecs = 0):
+		"""
+		Read fixes from the serial port, or from gpsd with source "gpsd". The serial port is
+		 the fallback when gpsd cannot be reached. With readySecs, wait up to that long for the
+		 first bytes from the receiver or gpsd.
+		:return True when the GPS is ready
+		"""
+		if source not in GPS_SOURCES:
+			raise ValueError(f"Unknown GPS source {source}, expected one of {GPS_SOURCES}")
+		this.gpsReader = None
+		if source == "gpsd":
+			try:
+				this.gpsReader = GPSDReader(hal.get().gpsdConnection(gpsdHost, gpsdPort, timeout), this.clock)
+			except OSError as e:
+				logger.warning("gpsd at %s:%s unavailable, reading %s directly: %s", gpsdHost, gpsdPort, port, e)
+		if this.gpsReader is None:
+			this.gpsReader = GPSReader(hal.get().gpsSerial(port, baudRate, timeout), this.clock)
+		return readySecs <= 0 or this.gpsReader.waitReady(readySecs)
+
+	def openEstimator(this):
+		import estimator
+		this.estimator = estimator.Estimator()
+
+	def start(this):
+		this.gpsReader.start()
+		if this.headingSampler:
+			this.headingSampler.start()
+
+	def stop(this):
+		if this.gpsReader:
+			utils.stopThread(this.gpsReader)
+		if this.headingSampler:
+			utils.stopThread(this.headingSampler)
+
+	def startCalibration(this, seconds):
+		"""Begin capturing raw magnetometer samples while the boat is turned through full circles"""
+		if not this.headingSampler or this.calibrating:
+			return False
+		logger.info("Starting heading calibration capture for %s sec", seconds)
+		this.calibrating = True
+		this.headingSampler.startCapture(int(seconds / this.headingSampler.period * 2))
+		this.status_q.put(status.StatusUpdate.calibrating())
+		return True
+
+	def finishCalibration(this):
+		"""Fit the captured samples, persist the result and apply it to the running sampler"""
+		if not this.calibrating:
+			return
+		import heading
+		import numpy
+		this.calibrating = False
+		samples = this.headingSampler.stopCapture()
+		try:
+			cal = heading.fitCalibration(samples)
+			if this.calibrationFile:
+				cal.save(this.calibrationFile)
+		except (ValueError, numpy.linalg.LinAlgError, OSError) as e:
+			logger.warning("Heading calibration failed with %s samples: %s", len(samples), e)
+			this.status_q.put(status.StatusUpdate.error())
+			return
+		this.headingSampler.setCalibration(cal)
+		this.status_q.put(status.StatusUpdate.ready())
 
 	def setHeadingLock(this, lock = True):
 		if lock and not this.headingSensor:
@@ -138,8 +487,9 @@ class Navigation(object):
 		else:
 			this.anchorLock = None
 			this.coarseCorrection = 0
+			this.controller.reset()
 			if lock:
-				logger.info(f"Setting headingLock to {this.heading}")
+				logger.info("Setting headingLock to %s", this.heading)
 				this.headingLock = this.heading
 				this.status_q.put(status.StatusUpdate.headingLock(failed = this.heading == None))
 			else:
@@ -156,9 +506,16 @@ class Navigation(object):
 		else:
 			this.headingLock = None
 			this.coarseCorrection = 0
+			this.controller.reset()
 			if lock:
-				logger.info(f"Setting anchor lock to: {this.posiition}")
-				this.anchorLock = this.position
+				logger.info(f"Setting anchor lock to: {this.position}")
+				#Fixes are projected onto a plane around the anchor, two multiplies each instead of haversine trig
+				this.anchorPlane = LocalPlane(this.position)
+				this.anchorLock = this.anchorPlane.origin
+				this.anchorFixes.clear()
+				this.anchorFixAt = this.positionAt
+				this.anchorDistance = None
+				this.anchorHolding = True
 				this.status_q.put(status.StatusUpdate.anchorLock(failed = this.position == None))
 			else:
 				logger.info("Clearing anchor lock")
@@ -166,20 +523,147 @@ class Navigation(object):
 				this.status_q.put(status.StatusUpdate.ready())
 			
 
-	def read(this):
+	def read(this, controls = None):
 		#Read Current Heading/Position
-		if this.headingSensor:
-			this.heading = this.headingSensor.get_bearing()
+		#Snapshot of the filtered heading published by the sampler, no I2C in the control loop
+		h = None
+		if this.headingSampler:
+			h, this.turnRate, this.headingAt = this.headingSampler.latest
+			if h is not None:
+				this.heading = h
 
-		this.position = readFromSerial(this.gps)
+		#Snapshot of the latest fix published by the GPS reader, never blocks
+		this.position = fix = this.gpsReader.latest
+		this.positionAt = fix.at
+		if this.estimator:
+			this.estimate(controls, h)
 		#
-		if this.headingLock:
-			this.coarseCorrection = this.headingLock - this.heading
-			if this.coarseCorrection < -180:
-				this.coarseCorrection += 360
-			logger.debug(f"Coarse Correction Of {this.coarseCorrection} needed for current heading {this.heading}")
+		if this.headingLock is not None:
+			this.coarseCorrection = wrapAngle(this.headingLock - this.heading)
+			logger.debug("Coarse Correction Of %s needed for current heading %s", this.coarseCorrection, this.heading)
+		elif this.anchorLock:
+			this.trackAnchor()
+			if not this.anchorHolding:
+				this.coarseCorrection = wrapAngle(this.anchorBearing - this.heading)
+
+	def estimate(this, controls, heading):
+		est = this.estimator
+		speed = motor = 0
+		if controls:
+			speed = controls.getCurSpeed() / controls.getMaxSpeed()
+			motor = max(-1.0, min(1.0, controls.turnPosition() / controls.maxTurnTime))
+		est.predict(this.clock.now(), speed, motor)
+		if heading is not None and this.headingAt != this.fusedHeadingAt:
+			this.fusedHeadingAt = this.headingAt
+			est.heading(heading)
+		if this.positionAt != this.fusedPositionAt and this.position.isValid():
+			this.fusedPositionAt = this.positionAt
+			if this.plane is None:
+				this.plane = LocalPlane(this.position)
+			east, north = this.plane.toENU(this.position.latitude, this.position.longitude)
+			if abs(east) > PLANE_RADIUS or abs(north) > PLANE_RADIUS:
+				#Keep the flat earth approximation close to its origin
+				this.plane = LocalPlane(this.position)
+				est.recenter(east, north)
+				east = north = 0.0
+			est.position(east, north)
+			fix = this.position
+			if fix.speed is not None:
+				c = math.radians(fix.course)
+				est.velocity(fix.speed * math.sin(c), fix.speed * math.cos(c))
+
+	def estimatedPosition(this):
+		""":return GPSCoord of the estimated position, None before the first fix"""
+		enu = this.estimator.positionEstimate() if this.estimator and this.plane else None
+		return this.plane.fromENU(*enu) if enu else None
+
+	def trackAnchor(this):
+		#Only new fixes move the anchor geometry, the bearing is re-steered against every heading
+		if this.positionAt == this.anchorFixAt or not this.position.isValid():
+			return
+		this.anchorFixAt = this.positionAt
+		east, north = this.anchorPlane.toENU(this.position.latitude, this.position.longitude)
+		this.anchorFixes.append((this.positionAt, east, north))
+		east, north, velocityEast, velocityNorth = this.anchorTrack()
+		east += velocityEast * this.anchorLeadSecs
+		north += velocityNorth * this.anchorLeadSecs
+		this.anchorDistance = math.hypot(east, north)
+		this.anchorBearing = math.degrees(math.atan2(-east, -north)) % 360
+		logger.debug("Anchor %.1fm away at %.0f^ in %s sec (velocity %.2f,%.2f m/s)", this.anchorDistance,
+					this.anchorBearing, this.anchorLeadSecs, velocityEast, velocityNorth)
+
+	def anchorTrack(this):
+		"""
+		Least squares line through the fixes in the ring, which averages out GPS noise
+		:return (east, north) metres of the line at the newest fix and its (east, north) m/s slope
+		"""
+		fixes = this.anchorFixes
+		n = len(fixes)
+		t, east, north = fixes[-1]
+		if n < 3:
+			return east, north, 0.0, 0.0
+		meanT = sum(f[0] for f in fixes) / n
+		meanE = sum(f[1] for f in fixes) / n
+		meanN = sum(f[2] for f in fixes) / n
+		varT = sum((f[0] - meanT) ** 2 for f in fixes)
+		if varT <= 0:
+			return east, north, 0.0, 0.0
+		velocityEast = sum((f[0] - meanT) * (f[1] - meanE) for f in fixes) / varT
+		velocityNorth = sum((f[0] - meanT) * (f[2] - meanN) for f in fixes) / varT
+		return meanE + velocityEast * (t - meanT), meanN + velocityNorth * (t - meanT), velocityEast, velocityNorth
+
+	def holdAnchor(this, controls):
+		distance = this.anchorDistance
+		if distance is None:
+			return
+		if this.anchorHolding:
+			if distance <= this.anchorReleaseRadius:
+				return
+			logger.info("Anchor %.1fm away, driving back", distance)
+			this.anchorHolding = False
+		elif distance <= this.anchorRadius:
+			logger.info("Anchor reached (%.1fm), holding", distance)
+			this.anchorHolding = True
+			this.coarseCorrection = 0
+			this.controller.reset()
+			controls.stop()
+			return
+		this.steer(controls)
+		#One speed step per fix, toward a setting that grows with distance. Come round toward the anchor at anchorSpeed first.
+		if this.anchorSteppedAt == this.anchorFixAt:
+			return
+		this.anchorSteppedAt = this.anchorFixAt
+		speed = controls.speed
+		target = this.anchorSpeed
+		if abs(this.coarseCorrection) <= 90:
+			target = min(speed.MAX, this.anchorSpeed + int((distance - this.anchorRadius) / this.anchorMetersPerSpeed))
+		if controls.getCurSpeed() == 0:
+			speed.set(this.anchorSpeed, turnOn = True)
+		elif speed.curSpeed != target:
+			speed.set(speed.curSpeed + (1 if target > speed.curSpeed else -1), turnOn = True)
 
 	def applyCoarseCorrection(this, controls):
+		if this.anchorLock:
+			this.holdAnchor(controls)
+		elif this.headingLock is not None:
+			this.steer(controls)
+
+	def steer(this, controls):
+		if this.headingControl == "bucketed":
+			this.applyBucketedCorrection(controls)
+			return
+		curSpeed = controls.getCurSpeed()
+		if curSpeed == 0:
+			#No steerage way, and nothing for the integral to learn
+			this.controller.reset()
+			return
+		#The estimator's turn rate is smoother than the sampler's window slope, which keeps the rate term from chattering
+		turnRate = this.turnRate
+		if this.estimator and this.estimator.headingReady:
+			turnRate = this.estimator.headingEstimate()[1]
+		this.controller.update(this.coarseCorrection, turnRate, curSpeed / controls.getMaxSpeed(), this.clock.now(), controls)
+
+	def applyBucketedCorrection(this, controls):
 		if this.coarseCorrection == 0:
 			return
 		curSpeed = controls.getCurSpeed()
@@ -189,9 +673,9 @@ class Navigation(object):
 		#Adjust seconds to speed. lower speed results in longer debounce since it will take longer to reach heading
 		factor = curSpeed / controls.getMaxSpeed()
 		debounce = this.turnDebounceSecs / factor
-		timeSince = time.time() - this.lastTurnSentAt
+		timeSince = this.clock.now() - this.lastTurnSentAt
 		if timeSince < debounce:
-			logger.debug(f"Ignoring coarse correction: {debounce} sec debounce not met (speed factor = {factor})")
+			logger.debug("Ignoring coarse correction: %s sec debounce not met (speed factor = %s)", debounce, factor)
 			return
 
 		#Number of seconds to turn motor to correct
@@ -209,12 +693,12 @@ class Navigation(object):
 			tsecs = controls.maxTurnTime * .125
 		else: #Don't adjust for small corrections
 			return
-		logger.info(f"Applying {tsecs} sec turn for coarse correction of {this.coarseCorrection}^")
+		logger.info("Applying %s sec turn for coarse correction of %s^", tsecs, this.coarseCorrection)
 		if this.coarseCorrection < 0:
 			controls.turnLeft(controls.turnTimeHeading - tsecs)
 		else:
 			controls.turnRight(controls.turnTimeHeading + tsecs)
-		this.lastTurnSentAt = time.time() + tsecs
+		this.lastTurnSentAt = this.clock.now() + tsecs
 		
 
 
@@ -0,0 +1,308 @@
+"""
+ Micro-benchmarks for the controller's hot paths. Run them on the Pi itself to check headroom:
+	python3 bench.py nmea
+	python3 bench.py logging
+	python3 bench.py estimator
+	python3 bench.py loop
+	sudo python3 bench.py jitter
+"""
+import gc
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import nmea
+import utils
+
+#################   NMEA
+
+GPS_SAMPLE = [
+	"GNRMC,123519.00,A,4807.03812,N,01131.00046,E,0.224,84.40,230394,,,A",
+	"GNVTG,84.40,T,,M,0.224,N,0.415,K,A",
+	"GNGGA,123519.00,4807.03812,N,01131.00046,E,1,08,0.94,545.4,M,46.9,M,,",
+	"GNGSA,A,3,04,05,09,12,24,25,29,31,,,,,1.72,0.94,1.44",
+	"GPGSV,3,1,11,03,03,111,00,04,15,270,00,06,01,010,00,13,06,292,00",
+	"GNHDT,274.07,T"
+]
+
+def benchNMEA(seconds = 3.0):
+	epoch = b''.join(nmea.sentence(s) for s in GPS_SAMPLE)
+	stream = epoch * 200
+	rnd = random.Random(1)
+	chunks = []
+	i = 0
+	while i < len(stream):
+		n = rnd.randint(1, 64)
+		chunks.append(stream[i:i + n])
+		i += n
+
+	parser = nmea.NMEAParser()
+	records = 0
+	passes = 0
+	start = time.perf_counter()
+	while time.perf_counter() - start < seconds:
+		for c in chunks:
+			records += len(parser.feed(c))
+		passes += 1
+	elapsed = time.perf_counter() - start
+
+	rate = parser.sentences / elapsed
+	byteRate = passes * len(stream) / elapsed
+	#10 Hz receiver sending every sentence above, and a saturated 115200 baud 8N1 link
+	need10Hz = len(GPS_SAMPLE) * 10
+	needBaud = 115200 / 10 / (len(epoch) / len(GPS_SAMPLE))
+	print(f"NMEA parser: {rate:,.0f} sentences/s ({byteRate / 1024:,.0f} KiB/s), {records / elapsed:,.0f} records/s")
+	print(f"  checksum errors={parser.checksumErrors} decode errors={parser.decodeErrors} unsupported={parser.unsupported}")
+	print(f"  10 Hz fix rate needs {need10Hz} sentences/s -> {rate / need10Hz:,.0f}x headroom")
+	print(f"  115200 baud saturated needs {needBaud:,.0f} sentences/s -> {rate / needBaud:,.0f}x headroom")
+
+#################   Logging
+
+def percentiles(samples, pcts = (50, 99)):
+	ordered = sorted(samples)
+	return [ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] for p in pcts] + [ordered[-1]]
+
+def loggingPass(iterations, argv):
+	root = logging.getLogger("")
+	stderr = sys.stderr
+	with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+		sys.stderr = devnull
+		try:
+			utils.initLogger(os.path.join(tmp, "bench.log"), argv)
+			log = logging.getLogger("bench")
+			times = []
+			for i in range(iterations):
+				start = time.perf_counter()
+				#Roughly what a busy control pass emits: turn/button/speed info lines plus filtered debug
+				log.info("Right Turn Started: Target = %s", i * 0.001)
+				log.info("Button Down: %s", "Go")
+				log.info("Setting Speed Value to %s", i % 15)
+				log.debug("Coarse Correction Of %s needed for current heading %s", i % 90, i % 360)
+				log.debug("Status Update: %s", i)
+				times.append(time.perf_counter() - start)
+			utils.stopLogger()
+		finally:
+			sys.stderr = stderr
+			for h in list(root.handlers):
+				root.removeHandler(h)
+				h.close()
+	return times
+
+def benchLogging(iterations = 20000):
+	for label, argv in (("synchronous", ["logLevel=INFO", "logQueue=0"]), ("queued", ["logLevel=INFO", "logQueue=1"])):
+		times = loggingPass(iterations, argv)
+		p50, p99, worst = percentiles(times)
+		print(f"Logging {label:>11}: per pass p50={p50 * 1e6:,.1f}us p99={p99 * 1e6:,.1f}us max={worst * 1e6:,.1f}us total={sum(times):.3f}s")
+
+#################   Estimator
+
+def benchEstimator(ticks = 20000, tickSecs = 0.25):
+	import estimator
+	est = estimator.Estimator()
+	def run(start, count):
+		for i in range(start, start + count):
+			now = i * tickSecs
+			est.predict(now, 0.5, 0.2)
+			est.heading((i * 0.7) % 360)
+			if i % 4 == 0:
+				#1 Hz fix with SOG/COG
+				est.position(i * 0.1, i * 0.05)
+				est.velocity(0.4, 0.2)
+	run(0, 100)
+	tracemalloc.start()
+	only = [tracemalloc.Filter(True, estimator.__file__)]
+	before = tracemalloc.take_snapshot().filter_traces(only)
+	run(100, 1000)
+	grown = sum(s.size_diff for s in tracemalloc.take_snapshot().filter_traces(only).compare_to(before, "filename"))
+	tracemalloc.stop()
+	start = time.perf_counter()
+	run(1100, ticks)
+	elapsed = time.perf_counter() - start
+	print(f"Estimator: {elapsed / ticks * 1e6:,.1f}us per tick (predict + heading, fix every 4th), "
+		f"{grown} bytes retained by the estimator over 1000 ticks")
+
+#################   Control Loop Allocations
+
+LOOP_STAGES = ["gps", "heading", "button", "tick", "status"]
+
+def benchLoop(passes = 2000):
+	"""
+	One control loop pass on simulated devices on a manual clock: a GPS epoch published, a
+	 heading sample, a RIGHT press and release through the runtime, the tick, and the status
+	 thread taking the updates they posted. tracemalloc reports the peak bytes each stage
+	 allocates above what was live before it, and the blocks a pass leaves behind.
+	 Then the pause of a full collection with and without the startup heap frozen.
+	"""
+	import clock as clk
+	import hal
+	import status
+	import controls as ctl
+	import autopilot
+	import values
+	import runtime
+	import rfcontrols
+	import simulator
+	rnd = random.Random(1)
+	previous = hal.get()
+	previousClock = clk.get()
+	clock = clk.ManualClock()
+	hal.install(simulator.SimulatorBackend(simulator.BoatModel(rnd), rnd))
+	clk.install(clock)
+	try:
+		status_q = status.StatusChannel()
+		controls = ctl.Control(status_q, values.MAX_TURN_TIME_SECS, values.TURN_ACTUATION_DELAY_SECS, simulator.VirtualTimer(), clock)
+		controls.direction = ctl.Direction(values.TURN_MASTER_RELAY_PIN, values.TURN_POWER_RELAY_PIN, values.TURN_GROUND_RELAY_PIN)
+		controls.speed = ctl.Speed(status_q, values.SPEED_MASTER_RELAY_PIN, values.SPEED_R1_RELAY_PIN,
+									values.SPEED_R2_RELAY_PIN, values.SPEED_R3_RELAY_PIN, values.SPEED_R4_RELAY_PIN)
+		nav = autopilot.Navigation(status_q, values.TURN_DEBOUNCE_SECS, headingRateHz = 20, headingWindow = 5, clock = clock)
+		rt = runtime.Runtime(nav, controls, clock = clock)
+		controls.speed.set(8, turnOn = True)
+		fixes = nmea.NMEAParser().feed(b"".join(nmea.sentence(s) for s in GPS_SAMPLE))
+		compass = nav.headingSensor
+		right = rfcontrols.RemoteButton(rfcontrols.RIGHT_BTN, 0)
+		def press():
+			rt.handleButton(rfcontrols.ButtonEvent(clock.now(), right, rfcontrols.BUTTON_DOWN, time.perf_counter_ns()))
+			rt.handleButton(rfcontrols.ButtonEvent(clock.now(), right, rfcontrols.BUTTON_UP, time.perf_counter_ns()))
+		stages = [
+			lambda: nav.gpsReader.publish(fixes),
+			lambda: nav.headingSampler.update(compass.get_magnet_raw(), clock.now()),
+			press,
+			rt.tick,
+			lambda: status_q.get(block = False)]
+		def run(count, peaks = None):
+			for i in range(count):
+				clock.advance(0.25)
+				for n, stage in enumerate(stages):
+					if peaks is None:
+						stage()
+						continue
+					tracemalloc.reset_peak()
+					live = tracemalloc.get_traced_memory()[0]
+					stage()
+					peaks[n] += tracemalloc.get_traced_memory()[1] - live
+		run(200)
+		peaks = [0] * len(stages)
+		tracemalloc.start()
+		before = tracemalloc.take_snapshot()
+		run(passes, peaks)
+		retained = sum(d.count_diff for d in tracemalloc.take_snapshot().compare_to(before, "filename"))
+		tracemalloc.stop()
+		start = time.perf_counter()
+		run(passes)
+		elapsed = time.perf_counter() - start
+		rt.loop.close()
+	finally:
+		hal.install(previous)
+		clk.install(previousClock)
+	perStage = " ".join(f"{name}={peak / passes:,.0f}" for name, peak in zip(LOOP_STAGES, peaks))
+	print(f"Control loop pass: {elapsed / passes * 1e6:,.1f}us, peak bytes allocated per stage {perStage}, "
+		f"{retained / passes:.2f} blocks left behind per pass")
+	gc.collect()
+	start = time.perf_counter()
+	gc.collect()
+	full = time.perf_counter() - start
+	gc.freeze()
+	start = time.perf_counter()
+	gc.collect()
+	frozen = time.perf_counter() - start
+	gc.unfreeze()
+	print(f"  full collection of {len(gc.get_objects()):,} objects {full * 1e3:,.2f}ms, {frozen * 1e3:,.2f}ms with them frozen")
+
+#################   Loop Jitter
+
+#Stands in for gpsd, journald and SD card flushes: one process per core spinning, writing and syncing a file
+LOAD = """
+import os, tempfile, time
+with tempfile.TemporaryFile() as f:
+	while True:
+		end = time.perf_counter() + 0.05
+		while time.perf_counter() < end:
+			pass
+		f.write(os.urandom(65536))
+		os.fsync(f.fileno())
+"""
+
+def jitterPass(seconds, periodSecs, mode):
+	"""
+	Periods between wake ups of a deadline loop like the runtime's ticker on its own thread.
+	 Each pass does a tick's worth of work that leaves cyclic garbage for the collector.
+	"""
+	periods = []
+	def run():
+		if mode:
+			mode.start([None])
+		deadline = time.perf_counter()
+		last = None
+		end = deadline + seconds
+		junk = []
+		while deadline < end:
+			now = time.perf_counter()
+			if last is not None:
+				periods.append(now - last)
+			last = now
+			for i in range(200):
+				node = {"id" : i}
+				node["self"] = node
+				junk.append(node)
+			del junk[:]
+			deadline += periodSecs
+			if mode:
+				mode.idle(time.perf_counter())
+			time.sleep(max(0, deadline - time.perf_counter()))
+	t = threading.Thread(target = run, name = "Jitter_Thread")
+	t.start()
+	t.join()
+	if mode:
+		mode.stop()
+	return periods
+
+def benchJitter(seconds = 10.0, periodSecs = 0.01):
+	"""
+	p50/p99/max period of a control loop under load without and with the real-time mode
+	 (values.REALTIME_* settings). SCHED_FIFO and mlockall need root or CAP_SYS_NICE and
+	 CAP_IPC_LOCK, steps that are not permitted are reported and skipped.
+	"""
+	import realtime
+	import values
+	load = [subprocess.Popen([sys.executable, "-c", LOAD]) for i in range(os.cpu_count() or 1)]
+	try:
+		for label in ("default", "realtime"):
+			mode = None
+			if label == "realtime":
+				mode = realtime.RealtimeMode(realtime.parseCpus(values.REALTIME_CONTROL_CPUS) & os.sched_getaffinity(0) or os.sched_getaffinity(0),
+											priority = values.REALTIME_PRIORITY, gcFullSecs = values.REALTIME_GC_FULL_SECS)
+			periods = jitterPass(seconds, periodSecs, mode)
+			p50, p99, worst = percentiles(periods)
+			print(f"Loop period {label:>8}: target={periodSecs * 1e3:.1f}ms p50={p50 * 1e3:.3f}ms p99={p99 * 1e3:.3f}ms "
+				f"max={worst * 1e3:.3f}ms over {len(periods)} passes")
+			if mode and mode.failed:
+				print(f"  not applied: {', '.join(mode.failed)}")
+	finally:
+		for p in load:
+			p.kill()
+			p.wait()
+
+BENCHMARKS = {
+	"nmea" : benchNMEA,
+	"logging" : benchLogging,
+	"estimator" : benchEstimator,
+	"loop" : benchLoop,
+	"jitter" : benchJitter
+}
+
+def main(argv):
+	names = argv if argv else list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			print(f"Unknown benchmark {name}. Choose from: {', '.join(BENCHMARKS)}")
+			return 1
+		BENCHMARKS[name]()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,47 @@
+"""
+ Clock service for everything that measures durations or schedules deadlines. The Pi has no
+ RTC, so the wall clock steps by minutes when NTP or the GPS sets it after boot; turn timing,
+ debounces and long presses read the clock passed to them instead of time.time(). Classes take
+ a `clock` argument and default to the module clock, a MonotonicClock.
+
+ A ManualClock only moves when it is set or advanced, so the simulator, replay and benchmarks
+ jump from event to event instead of sleeping through the real delays.
+"""
+import time
+
+class MonotonicClock(object):
+	"""Seconds on time.perf_counter(): monotonic, the finest resolution available, arbitrary origin"""
+	def now(this):
+		return time.perf_counter()
+
+	def sleep(this, secs):
+		if secs > 0:
+			time.sleep(secs)
+
+class ManualClock(object):
+	"""Virtual time, moved only by set, advance or sleep. Sleeping returns immediately with the clock advanced."""
+	def __init__(this, start = 1000.0):
+		this.t = start
+
+	def now(this):
+		return this.t
+
+	def set(this, t):
+		this.t = t
+
+	def advance(this, secs):
+		this.t += secs
+
+	def sleep(this, secs):
+		if secs > 0:
+			this.t += secs
+
+clock = MonotonicClock()
+
+def install(c):
+	"""Install the clock used by objects created without one"""
+	global clock
+	clock = c
+
+def get():
+	return clock
@@ -1,150 +1,219 @@
+import gc
 import time
 import threading
 import sys
 import os
+import concurrent.futures
 import values
-import queue 
 import utils
 import controls as ctl
 import rfcontrols
 import logging
 import autopilot
 import status
+import hal
+import clock as clk
+import recorder
+import metrics
+import profiler
+import realtime
+from runtime import Runtime
 
 logger = logging.getLogger(__name__)
 
 rxThread = None
 statusThread = None
+nav = None
+controls = None
+flightRecorder = None
+profile = None
+notReady = []
 
 #################   Utility
 def cleanup():
 	logger.info("Cleaning up")
-	rxThread.stop()
-	utils.stopThread(rxThread)
-	statusThread.stop()
-	utils.stopThread(statusThread)
+	utils.sdNotify("STOPPING=1")
+	if rxThread:
+		utils.stopThread(rxThread)
+	if flightRecorder:
+		utils.stopThread(flightRecorder)
+	if profile and profile.running():
+		profile.stop()
+	if nav:
+		nav.stop()
+	if controls:
+		utils.stopThread(controls.timer)
+		logger.info(controls.stopLateness)
+	if statusThread:
+		statusThread.stop()
+		utils.stopThread(statusThread)
 	#rxThread.rfDevice.cleanup()
 	#sys.exit(0)
+	hal.get().close()
+	utils.stopLogger()
 	
+def ready():
+	#The event loop is running with the receiver started, so the remote works from here
+	sinceStart, sinceBoot = utils.startupTimes()
+	logger.info(f"Ready {sinceStart:.2f} sec after start, {sinceBoot:.1f} sec after boot")
+	metrics.registry.gauge("ready_seconds", "Seconds until the controller responded to the remote", lambda: sinceStart, since = "start")
+	metrics.registry.gauge("ready_seconds", "Seconds until the controller responded to the remote", lambda: sinceBoot, since = "boot")
+	waiting = f", waiting for {', '.join(notReady)}" if notReady else ""
+	utils.sdNotify(f"READY=1\nSTATUS=Ready {sinceStart:.2f}s after start, {sinceBoot:.1f}s after boot{waiting}")
+
+#################   Device Probing
+def probe(name, open, *args):
+	"""
+	Open a device and wait until it is usable, logging how long that took. `open` returns the
+	 device and whether it became usable within its wait, a device that did not is still
+	 returned and listed in notReady.
+	"""
+	clock = clk.get()
+	startedAt = clock.now()
+	device, ready = open(*args)
+	if ready:
+		logger.info("%s ready in %.3f sec", name, clock.now() - startedAt)
+	else:
+		logger.warning("%s opened but not ready after %.3f sec", name, clock.now() - startedAt)
+		notReady.append(name)
+	return device
+
+def opened(future):
+	""":return the device a probe opened, None if it failed"""
+	return future.result() if future.exception() is None else None
+
+def openStatus(status_q):
+	thread = status.StatusThread(status_q, 
+								values.STATUS_PIN1,
+								values.STATUS_PIN2,
+								values.STATUS_PIN3)
+	thread.start()
+	return thread, True
+
+def openControls(status_q):
+	c = ctl.Control(status_q, values.MAX_TURN_TIME_SECS, values.TURN_ACTUATION_DELAY_SECS)
+	c.direction = ctl.Direction(
+								values.TURN_MASTER_RELAY_PIN,
+								values.TURN_POWER_RELAY_PIN,
+								values.TURN_GROUND_RELAY_PIN)
+	c.speed = ctl.Speed(status_q,
+							values.SPEED_MASTER_RELAY_PIN,
+							values.SPEED_R1_RELAY_PIN,
+							values.SPEED_R2_RELAY_PIN,
+							values.SPEED_R3_RELAY_PIN,
+							values.SPEED_R4_RELAY_PIN)
+	#Relays are in a known state once stopped
+	c.stop()
+	return c, True
+
+def openReceiver(status_q):
+	#The runtime is attached before the thread starts, codes decoded until then wait in its queue
+	rx = rfcontrols.RxThread(status_q, values.RX_PIN, rfcontrols.Yosoo4ButtonRemote(), None,
+							receiver = values.RX_RECEIVER)
+	return rx, rx.waitReady(values.RF_READY_SECS)
+
+def openHeading(nav):
+	ready = nav.openHeading(values.HEADING_SAMPLE_HZ, values.HEADING_WINDOW, values.HEADING_READY_SECS)
+	return nav.headingSampler, ready
+
+def openGPS(nav, source, gpsdHost, gpsdPort):
+	ready = nav.openGPS(values.GPS_SERIAL_PORT, values.GPS_BAUD_RATE, 0.5, source, gpsdHost, gpsdPort, values.GPS_READY_SECS)
+	return nav.gpsReader, ready
 
 #################  Main
 def main(argv):
-	utils.initLogger(values.LOG_FILE, argv)
-	utils.registerInterrupt(cleanup)    
-	
-	#Initialize (values.PIN is board.PIN, gpiozero needs pin number, so call board.PIN.id)
-	global rxThread, statusThread
-	status_q = queue.Queue()
-	statusThread = status.StatusThread(status_q, 
-								values.STATUS_PIN1.id,
-								values.STATUS_PIN2.id,
-								values.STATUS_PIN3.id)
-	statusThread.start()
-
-	
-	#Initialize Navigation
-	logger.info("Initializing Navigation")
-	nav = autopilot.Navigation(status_q, values.TURN_DEBOUNCE_SECS)
-
-	#Initialize Relays
-	logger.info("Initializing Controls")
-	controls = ctl.Control(status_q, values.MAX_TURN_TIME_SECS)
-	controls.direction = ctl.Direction(
-										values.TURN_MASTER_RELAY_PIN.id,
-										values.TURN_POWER_RELAY_PIN.id,
-										values.TURN_GROUND_RELAY_PIN.id)
-	controls.speed = ctl.Speed(status_q,
-									values.SPEED_MASTER_RELAY_PIN.id,
-									values.SPEED_R1_RELAY_PIN.id,
-									values.SPEED_R2_RELAY_PIN.id,
-									values.SPEED_R3_RELAY_PIN.id,
-									values.SPEED_R4_RELAY_PIN.id)
-	controls.stop()
-
-	#Initialize RF Remote
-	logger.info("Initializing RF Receiver")
-	q = queue.Queue()
-	rxThread = rfcontrols.RxThread(status_q, values.RX_PIN.id, rfcontrols.Yosoo4ButtonRemote(), q)
-
-
-	#Pause for hardware to initialize
-	time.sleep(2)
-
-	#Start Threads
-	logger.info("Starting Remote Thread")
-	rxThread.start()
-	
-	#Begin Keep Main Thread open for interrupt signal
-	stopDownAt = 0
-	goDownAt = 0
-	while True:
-		#Read Navigation Data
-		nav.read()
-
-		#Check for remote control button events
+	utils.initLogger(utils.argValue(argv, "logFile", values.LOG_FILE), argv)
+
+	#profile=sample|cprofile profiles from startup, SIGUSR2 or holding STOP toggles it later
+	global profile
+	profileMode = utils.argValue(argv, "profile")
+	profile = profiler.Profiler(utils.argValue(argv, "profileDir", values.PROFILE_DIR), profileMode or "sample",
+								float(utils.argValue(argv, "profileSecs", values.PROFILE_SECS)),
+								float(utils.argValue(argv, "profileHz", 100)))
+
+	#realtime=1 [rtControlCpus=..] [rtRxCpus=..] [rtPriority=N] [rtRxPriority=N] [rtLockMemory=0|1] [rtGC=idle|off|auto]
+	rtMode = None
+	if utils.argValue(argv, "realtime", "0") != "0":
+		rtMode = realtime.RealtimeMode(realtime.parseCpus(utils.argValue(argv, "rtControlCpus", values.REALTIME_CONTROL_CPUS)),
+									realtime.parseCpus(utils.argValue(argv, "rtRxCpus", values.REALTIME_RX_CPUS)),
+									int(utils.argValue(argv, "rtPriority", values.REALTIME_PRIORITY)),
+									int(utils.argValue(argv, "rtRxPriority", values.REALTIME_RX_PRIORITY)),
+									utils.argValue(argv, "rtLockMemory", "1") != "0",
+									utils.argValue(argv, "rtGC", "idle"),
+									float(utils.argValue(argv, "rtGCFullSecs", values.REALTIME_GC_FULL_SECS)))
+
+	#Select real hardware or the simulated devices (backend=sim) every device is created through
+	hal.use(utils.argValue(argv, "backend", "real"), argv)
+
+	#Initialize (values.PIN are BCM pin numbers as gpiozero expects)
+	global rxThread, statusThread, nav, controls, flightRecorder
+	status_q = status.StatusChannel()
+	nav = autopilot.Navigation(status_q, values.TURN_DEBOUNCE_SECS, calibrationFile = values.MAG_CALIBRATION_FILE,
+							openDevices = False, anchorRadius = values.ANCHOR_RADIUS_METERS,
+							anchorReleaseRadius = values.ANCHOR_RELEASE_METERS, anchorLeadSecs = values.ANCHOR_LEAD_SECS,
+							anchorFixes = values.ANCHOR_FIXES, anchorMetersPerSpeed = values.ANCHOR_METERS_PER_SPEED,
+							anchorSpeed = values.ANCHOR_SPEED,
+							headingControl = utils.argValue(argv, "headingControl", values.HEADING_CONTROL))
+	try:
+		#Open every device at once, so slow ones (I2C setup, numpy import, serial, RF GPIO) overlap instead of adding up
+		logger.info("Probing Devices")
+		with concurrent.futures.ThreadPoolExecutor(max_workers = 5, thread_name_prefix = "Probe") as pool:
+			statusProbe = pool.submit(probe, "Status LEDs", openStatus, status_q)
+			controlsProbe = pool.submit(probe, "Relays", openControls, status_q)
+			rxProbe = pool.submit(probe, "RF Receiver", openReceiver, status_q)
+			headingProbe = pool.submit(probe, "Heading Sensor", openHeading, nav)
+			gpsProbe = pool.submit(probe, "GPS", openGPS, nav, utils.argValue(argv, "gpsSource", values.GPS_SOURCE),
+								utils.argValue(argv, "gpsdHost", values.GPSD_HOST), int(utils.argValue(argv, "gpsdPort", values.GPSD_PORT)))
+			#Keep whatever opened so cleanup can release it if another device failed
+			statusThread = opened(statusProbe)
+			controls = opened(controlsProbe)
+			rxThread = opened(rxProbe)
+			for future in (statusProbe, controlsProbe, rxProbe, headingProbe, gpsProbe):
+				future.result()
+		nav.openEstimator()
+		nav.start()
+
+		#Initialize Flight Recorder, the controller runs without it if the ring file cannot be mapped
 		try:
-			m = q.get_nowait()
-			logger.debug(f"Button Event: {m}")
-			button = m["button"]
-			if m["position"] == rfcontrols.BUTTON_DOWN:
-				if button.id == rfcontrols.GO_BTN:
-					goDownAt = time.time()
-					stopDownAt = 0
-					controls.speed.bump()
-				elif button.id == rfcontrols.STOP_BTN:
-					goDownAt = 0
-					stopDownAt = time.time()
-					controls.speed.bump(-1)
-				elif button.id == rfcontrols.LEFT_BTN:
-					controls.turnLeft()
-				elif button.id == rfcontrols.RIGHT_BTN:
-					controls.turnRight()
-				else:
-					logger.warning(f"Unsupported button {button.id}")
-			else:
-				if button.id == rfcontrols.GO_BTN:
-					goDownAt = 0
-				elif button.id == rfcontrols.STOP_BTN:
-					stopDownAt = 0
-				elif button.id == rfcontrols.LEFT_BTN:
-					controls.stopTurn()
-				elif button.id == rfcontrols.RIGHT_BTN:
-					controls.stopTurn()
-				else:
-					logger.warning(f"Unsupported button {button.id}")
-		except queue.Empty:
-			pass
-
-		#Check for long presses on remote control button events
-		if goDownAt > 0:
-			dur = time.time() - goDownAt
-			if dur > 2:
-				logger.info("Go Long Press")
-				nav.setHeadingLock()
-			if dur > 5:
-				logger.info("Go Extended Long Press")
-				controls.stop()
-				nav.setAnchorLock()
-		elif stopDownAt > 0:
-			dur = time.time() - stopDownAt
-			if dur > 2:
-				logger.info("Stop Long Press")
-				nav.setHeadingLock(False)
-				nav.setAnchorLock(False)
-				controls.stop()
-				controls.speed.set(ctl.Speed.MIN)
-			if dur > 10:
-				logger.info("Stop Extended Long Press")
-				controls.resetTurnHeading()
-			
-		#Check autopilot needs
-		nav.applyCoarseCorrection(controls)
-
-		#Check that turning is not stuck
-		controls.checkTurn()
-
-		time.sleep(0.25)
-		
+			flightRecorder = recorder.Recorder(utils.argValue(argv, "recordFile", values.RECORDER_FILE), nav, controls,
+											values.RECORDER_HZ, values.RECORDER_HOURS)
+			flightRecorder.start()
+		except OSError as e:
+			logger.warning(f"Flight recorder disabled: {e}")
+
+		#Initialize Event Runtime
+		runtime = Runtime(nav, controls, calibrateHoldSecs = values.CALIBRATE_HOLD_SECS, calibrationSecs = values.CALIBRATION_SECS,
+						recorder = flightRecorder, metricsSocket = utils.argValue(argv, "metricsSocket", values.METRICS_SOCKET),
+						profiler = profile, profileHoldSecs = values.PROFILE_HOLD_SECS, onReady = ready,
+						longPressSecs = values.LONG_PRESS_SECS, goExtraLongSecs = values.GO_EXTRA_LONG_SECS,
+						stopExtraLongSecs = values.STOP_EXTRA_LONG_SECS, doubleTapSecs = values.DOUBLE_TAP_SECS,
+						realtime = rtMode)
+		if profileMode:
+			runtime.toggleProfiler()
+		metrics.registry.gauge("queue_depth", "Items waiting in a queue", status_q.qsize, trackMax = True, queue = "status")
+		metrics.registry.gauge("queue_depth", "Items waiting in a queue", rxThread.codes.qsize, trackMax = True, queue = "rf")
+
+		#Everything allocated so far lives until exit. Move it out of the collector's generations so
+		# collections triggered from the control loop only walk what the loop itself allocates
+		gc.collect()
+		gc.freeze()
+		logger.info("Froze %d startup objects", gc.get_freeze_count())
+
+		#Start the remote as soon as there is a runtime to hand its events to
+		logger.info("Starting Remote Thread")
+		rxThread.q = runtime
+		rxThread.start()
+
+		#Pin and prioritize the threads that time turns and buttons once they all exist, threads they
+		# start later would inherit it. The event loop runs on this thread
+		if rtMode:
+			rtMode.start([None, controls.timer], [rxThread, rxThread.receiver])
+
+		#Run until SIGINT/SIGTERM, handling remote and navigation events as they arrive
+		runtime.run()
+	finally:
+		cleanup()
+
 
 ################# Application Entry
 
@@ -1,13 +1,24 @@
-import gpiozero
 import logging
-import time
+import threading
 import status
+import utils
+import hal
+import clock as clk
 
 logger = logging.getLogger(__name__)
 
-class Control(object):
+#Buckets (ms) for how late a scheduled turn stop fired relative to its deadline
+STOP_LATENESS_BUCKETS_MS = [0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 250]
 
-	def __init__(this, status_q, maxTurnTime):
+class Control(object):
+	"""
+	Automated turns (turnLeft/turnRight with a target) arm a deadline on `clock` for the moment
+	 the turn should stop, either at the target or at the maxTurnTime limit. The stop is issued
+	 early by the actuation delay: the configured time the motor keeps turning after the relays
+	 drop, plus the measured time the relay writes themselves take.
+	"""
+	def __init__(this, status_q, maxTurnTime, actuationDelay = 0, timer = None, clock = None):
+		this.clock = clock or clk.get()
 		this.direction = None
 		this.speed = None
 		this.status_q = status_q
@@ -16,82 +27,147 @@ class Control(object):
 		this.turnStartedAt = 0
 		this.turnTimeHeading = 0
 		this.maxTurnTime = maxTurnTime
-		this.turnTarget = 0
+		this.turnTarget = None
+		this.lock = threading.RLock()
+		this.actuationDelay = actuationDelay
+		this.relayDelay = 0
+		this.turnDeadline = None
+		this.turnDeadlineLimited = False
+		this.stopLateness = utils.Histogram("Turn stop lateness", STOP_LATENESS_BUCKETS_MS, "ms")
+		if timer is None:
+			timer = utils.TimerThread("Turn_Timer", this.clock)
+			timer.start()
+		this.timer = timer
 
 	def turnLeft(this, target = None):
-		if this.turningRight:
-			this.stopTurn()
+		with this.lock:
+			if this.turningRight:
+				this.stopTurn()
 
-		this.turnTarget = target
+			this.turnTarget = target
 
-		if this.turningLeft:
-			logger.debug("Already turning left")
-		elif target and abs(this.turnTimeHeading) > this.maxTurnTime:
-			logger.info("Max left turn reached for automated turns")
-			this.status_q.put(status.StatusUpdate.turningMaxed())
-		else:
-			logger.info(f"Left Turn Started: Target = {target}")
-			this.turningLeft = True
-			this.turnStartedAt = time.time()
-			this.status_q.put(status.StatusUpdate.turningStarted())
-			this.direction.turnLeft()
+			if this.turningLeft:
+				logger.debug("Already turning left")
+				this.armTurnStop()
+			elif target is not None and this.turnTimeHeading < -this.maxTurnTime:
+				logger.info("Max left turn reached for automated turns")
+				this.status_q.put(status.StatusUpdate.turningMaxed())
+			else:
+				logger.info("Left Turn Started: Target = %s", target)
+				this.turningLeft = True
+				this.turnStartedAt = this.clock.now()
+				this.status_q.put(status.StatusUpdate.turningStarted())
+				this.direction.turnLeft()
+				this.armTurnStop()
 
 	def turnRight(this, target = None):
+		with this.lock:
+			if this.turningLeft:
+				this.stopTurn()
+
+			this.turnTarget = target
+
+			if this.turningRight:
+				logger.debug("Already turning right")
+				this.armTurnStop()
+			elif target is not None and this.turnTimeHeading > this.maxTurnTime:
+				logger.info("Max right turn reached for automated turns")
+				this.status_q.put(status.StatusUpdate.turningMaxed())
+			else:
+				logger.info("Right Turn Started: Target = %s", target)
+				this.turningRight = True
+				this.turnStartedAt = this.clock.now()
+				this.status_q.put(status.StatusUpdate.turningStarted())
+				this.direction.turnRight()
+				this.armTurnStop()
+
+	def armTurnStop(this):
+		"""Schedule the stop of the current automated turn, or cancel it for a manual turn"""
+		if this.turnTarget is None:
+			this.turnDeadline = None
+			this.timer.cancel()
+			return
 		if this.turningLeft:
-			this.stopTurn()
-
-		this.turnTarget = target
-
-		if this.turningRight:
-			logger.debug("Already turning right")
-		elif target and this.turnTimeHeading > this.maxTurnTime:
-			logger.info("Max right turn reached for automated turns")
-			this.status_q.put(status.StatusUpdate.turningMaxed())
+			toTarget = this.turnTimeHeading - this.turnTarget
+			toLimit = this.turnTimeHeading + this.maxTurnTime
 		else:
-			logger.info(f"Right Turn Started: Target = {target}")
-			this.turningRight = True
-			this.turnStartedAt = time.time()
-			this.status_q.put(status.StatusUpdate.turningStarted())
-			this.direction.turnRight()
+			toTarget = this.turnTarget - this.turnTimeHeading
+			toLimit = this.maxTurnTime - this.turnTimeHeading
+		this.turnDeadlineLimited = toLimit < toTarget
+		runFor = min(toTarget, toLimit) - this.actuationDelay - this.relayDelay
+		this.turnDeadline = this.turnStartedAt + max(0, runFor)
+		this.timer.arm(this.turnDeadline, this.onTurnDeadline)
+
+	def onTurnDeadline(this, deadline):
+		with this.lock:
+			if deadline != this.turnDeadline:
+				return #turn was stopped or re-armed since
+			this.stopLateness.record((this.clock.now() - deadline) * 1000)
+			if this.turnDeadlineLimited:
+				logger.info("Stopping Turn: Limit reached for automated turns")
+				this.stopTurn()
+				this.status_q.put(status.StatusUpdate.turningMaxed())
+			else:
+				logger.info("Stopping Turn: Target reached")
+				this.stopTurn()
 
 	def checkTurn(this):
-		if this.turnTarget:
-			turnTime = time.time()-this.turnStartedAt
-			if this.turningLeft:
-				tt = this.turnTimeHeading - turnTime
-				if abs(tt) > this.maxTurnTime:
-					logger.info(f"Stopping Left Turn at {tt}: Limit reached for automated turns")
-					this.stopTurn()
-					this.status_q.put(status.StatusUpdate.turningMaxed())
-				elif tt <= this.turnTarget:
-					logger.info(f"Stopping Left Turn at {tt}: Target reached")
-					this.stopTurn()
-			elif this.turningRight:
-				tt = this.turnTimeHeading + turnTime
-				if tt > this.maxTurnTime:
-					logger.info(f"Stopping Right Turn at {tt}: Limit reached for automated turns")
-					this.stopTurn()
-					this.status_q.put(status.StatusUpdate.turningMaxed())
-				elif tt >= this.turnTarget:
-					logger.info(f"Stopping Right Turn at {tt}: Target Reached")
-					this.stopTurn()
+		#Backstop for the scheduled stop
+		with this.lock:
+			if this.turnTarget is not None:
+				turnTime = this.clock.now() - this.turnStartedAt
+				if this.turningLeft:
+					tt = this.turnTimeHeading - turnTime
+					if abs(tt) > this.maxTurnTime:
+						logger.info("Stopping Left Turn at %s: Limit reached for automated turns", tt)
+						this.stopTurn()
+						this.status_q.put(status.StatusUpdate.turningMaxed())
+					elif tt <= this.turnTarget:
+						logger.info("Stopping Left Turn at %s: Target reached", tt)
+						this.stopTurn()
+				elif this.turningRight:
+					tt = this.turnTimeHeading + turnTime
+					if tt > this.maxTurnTime:
+						logger.info("Stopping Right Turn at %s: Limit reached for automated turns", tt)
+						this.stopTurn()
+						this.status_q.put(status.StatusUpdate.turningMaxed())
+					elif tt >= this.turnTarget:
+						logger.info("Stopping Right Turn at %s: Target Reached", tt)
+						this.stopTurn()
+
+	def turnPosition(this):
+		""":return turnTimeHeading including the turn in progress"""
+		if this.turningLeft:
+			return this.turnTimeHeading - (this.clock.now() - this.turnStartedAt)
+		if this.turningRight:
+			return this.turnTimeHeading + (this.clock.now() - this.turnStartedAt)
+		return this.turnTimeHeading
 
 	def resetTurnHeading(this):
-		logger.info("Reseting turnTimeHeading to 0")
-		this.turnTimeHeading = 0
-		this.status_q.put(status.StatusUpdate.turningReset())
+		with this.lock:
+			logger.info("Reseting turnTimeHeading to 0")
+			this.turnTimeHeading = 0
+			this.status_q.put(status.StatusUpdate.turningReset())
 
 	def stopTurn(this):
-		this.direction.stop()
-		turnTime = time.time() - this.turnStartedAt
-		if this.turningLeft:
-			this.turnTimeHeading -= turnTime
-		elif this.turningRight:
-			this.turnTimeHeading += turnTime
-		this.turnTarget = None
-		this.turningLeft = False
-		this.turningRight = False
-		this.status_q.put(status.StatusUpdate.turningStopped())
+		with this.lock:
+			this.timer.cancel()
+			this.turnDeadline = None
+			stopAt = this.clock.now()
+			this.direction.stop()
+			#Track how long the relay writes take so scheduled stops can be issued that much earlier
+			this.relayDelay = 0.8 * this.relayDelay + 0.2 * (this.clock.now() - stopAt)
+			if this.turningLeft or this.turningRight:
+				#The motor keeps turning for actuationDelay after the stop is issued
+				turnTime = stopAt + this.actuationDelay - this.turnStartedAt
+				if this.turningLeft:
+					this.turnTimeHeading -= turnTime
+				else:
+					this.turnTimeHeading += turnTime
+			this.turnTarget = None
+			this.turningLeft = False
+			this.turningRight = False
+			this.status_q.put(status.StatusUpdate.turningStopped())
 
 	def stop(this):
 		logger.info("Stopping All Controls")
@@ -133,33 +209,38 @@ class Direction(object):
 			groundRelay OFF -> 3 -
 							   6 x
 
-
+	Power and ground must switch together: with only one of them on, 3 or 6 sees both + and -.
+	 The relays share one bank so power and ground move in a single transition, and they only
+	 ever move with the master off. A turn is up to three transitions: master off, power and
+	 ground to the new direction, master on. Without line requests the bank writes its lines
+	 one at a time, so none of these may be merged.
 	"""
 	def __init__(this, masterRelayPin, powerRelayPin, groundRelayPin):
-		this.masterRelay = gpiozero.OutputDevice(masterRelayPin, active_high=False, initial_value=False)
-		this.powerRelay = gpiozero.OutputDevice(powerRelayPin, active_high=False, initial_value=False)
-		this.groundRelay = gpiozero.OutputDevice(groundRelayPin, active_high=False, initial_value=False)
+		this.bank = hal.get().relayBank("direction", [masterRelayPin, powerRelayPin, groundRelayPin],
+										active_high=False, initial_value=False)
+		this.masterRelay = this.bank.line(masterRelayPin)
+		this.powerRelay = this.bank.line(powerRelayPin)
+		this.groundRelay = this.bank.line(groundRelayPin)
+		this.left = {masterRelayPin : 1, powerRelayPin : 0, groundRelayPin : 0}
+		this.right = {masterRelayPin : 1, powerRelayPin : 1, groundRelayPin : 1}
+		this.stopped = {masterRelayPin : 0, powerRelayPin : 0, groundRelayPin : 0}
+
+	def turn(this, target):
+		power = this.powerRelay.pin
+		ground = this.groundRelay.pin
+		if this.powerRelay.value != target[power] or this.groundRelay.value != target[ground]:
+			this.masterRelay.off()
+			this.bank.apply({power : target[power], ground : target[ground]})
+		this.masterRelay.on()
 
 	def turnLeft(this):
-		this.masterRelay.off()
-
-		this.powerRelay.off()
-		this.groundRelay.off()
-
-		this.masterRelay.on()
+		this.turn(this.left)
 
 	def turnRight(this):
-		this.masterRelay.off()
-
-		this.powerRelay.on()
-		this.groundRelay.on()
-
-		this.masterRelay.on()
+		this.turn(this.right)
 
 	def stop(this):
-		this.masterRelay.off()
-		this.powerRelay.off()
-		this.groundRelay.off()
+		this.bank.apply(this.stopped)
 
 class Speed(object):
 	"""
@@ -187,12 +268,11 @@ class Speed(object):
 	MAX = 15
 	def __init__(this, status_q, masterPin, r1Pin, r2Pin, r3Pin, r4Pin):
 		this.status_q = status_q
-		this.masterRelay = gpiozero.OutputDevice(masterPin, active_high=False, initial_value=False)
-		this.resistorRelays = [
-			gpiozero.OutputDevice(r1Pin, active_high=False, initial_value=False),
-			gpiozero.OutputDevice(r2Pin, active_high=False, initial_value=False),
-			gpiozero.OutputDevice(r3Pin, active_high=False, initial_value=False),
-			gpiozero.OutputDevice(r4Pin, active_high=False, initial_value=False)]
+		resistorPins = [r1Pin, r2Pin, r3Pin, r4Pin]
+		#One bank so a speed change moves every resistor relay at once, never through intermediate resistances
+		this.bank = hal.get().relayBank("speed", [masterPin] + resistorPins, active_high=False, initial_value=False)
+		this.masterRelay = this.bank.line(masterPin)
+		this.resistorRelays = [this.bank.line(pin) for pin in resistorPins]
 
 		this.speedSettings = {
 			 1 : [0,0,0,0],
@@ -211,18 +291,18 @@ class Speed(object):
 			14 : [0,1,1,1],
 			15 : [1,1,1,1]
 		}
+		#Bank targets for each setting, with and without turning the motor on
+		this.patterns = {}
+		for speed, bits in this.speedSettings.items():
+			pattern = dict(zip(resistorPins, bits))
+			this.patterns[speed] = (pattern, {**pattern, masterPin : 1})
 		this.curSpeed = 1
 
 	def set(this, speed, turnOn = False):
 		if speed in this.speedSettings:
-			logger.info(f"Setting Speed Value to {speed}")
-			s = this.speedSettings[speed]
-			for i in range(min(len(s), len(this.resistorRelays))):
-				logger.debug(f"Setting Resistor Relay {i} to {s[i]}")
-				this.resistorRelays[i].value = s[i]
+			logger.info("Setting Speed Value to %s", speed)
+			this.bank.apply(this.patterns[speed][1 if turnOn else 0])
 			this.curSpeed = speed
-			if turnOn:
-				this.masterRelay.on()
 			this.status_q.put(status.StatusUpdate.speed(this.curSpeed, this.masterRelay.value==1))
 		else:
 			logger.warning(f"Invalid Speed Setting: {speed}")
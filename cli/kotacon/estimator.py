@@ -0,0 +1,224 @@
+"""
+ Navigation state estimate at the control loop rate, from two small linear Kalman filters:
+
+	heading  : [heading deg, turn rate deg/s]. The turn rate relaxes toward the rate the motor
+	           angle and speed through water command, magnetometer headings correct both.
+	position : [east m, north m, drift east m/s, drift north m/s] on Navigation's local plane.
+	           The boat moves at its commanded speed through water along the estimated heading
+	           plus a drift (current, wind, speed model error) that GPS fixes and COG/SOG correct.
+
+ Position is predicted forward every tick between 1 Hz fixes. Every matrix is allocated once and
+ predict/update work in place with out= arguments, so a step allocates no arrays.
+"""
+import math
+import numpy
+
+def invert(S, out):
+	"""Inverse of a 1x1 or 2x2 matrix into out"""
+	if S.shape[0] == 1:
+		out[0, 0] = 1.0 / S[0, 0]
+		return
+	a, b, c, d = S[0, 0], S[0, 1], S[1, 0], S[1, 1]
+	det = a * d - b * c
+	out[0, 0] = d / det
+	out[0, 1] = -b / det
+	out[1, 0] = -c / det
+	out[1, 1] = a / det
+
+class Measurement(object):
+	"""Observation matrix and noise for one kind of update, with its scratch arrays. Write the observation into z."""
+	def __init__(this, n, H, variances):
+		this.H = numpy.array(H, dtype = float)
+		m = this.H.shape[0]
+		this.Ht = numpy.ascontiguousarray(this.H.T)
+		this.R = numpy.diag(numpy.array(variances, dtype = float))
+		this.z = numpy.zeros(m)
+		this.hx = numpy.zeros(m)
+		this.y = numpy.zeros(m)
+		this.S = numpy.zeros((m, m))
+		this.Sinv = numpy.zeros((m, m))
+		this.PHt = numpy.zeros((n, m))
+		this.K = numpy.zeros((n, m))
+		this.KH = numpy.zeros((n, n))
+		this.dx = numpy.zeros(n)
+
+class KalmanFilter(object):
+	"""x' = F x + bu, P' = F P F^T + Q. Callers set F, bu and Q in place before predict()."""
+	def __init__(this, n):
+		this.x = numpy.zeros(n)
+		this.P = numpy.eye(n)
+		this.F = numpy.eye(n)
+		this.Ft = this.F.T
+		this.Q = numpy.zeros((n, n))
+		this.bu = numpy.zeros(n)
+		this.xp = numpy.zeros(n)
+		this.T = numpy.zeros((n, n))
+		this.T2 = numpy.zeros((n, n))
+
+	def predict(this):
+		numpy.dot(this.F, this.x, out = this.xp)
+		numpy.add(this.xp, this.bu, out = this.x)
+		numpy.dot(this.F, this.P, out = this.T)
+		numpy.dot(this.T, this.Ft, out = this.P)
+		this.P += this.Q
+
+	def update(this, m, angle = None):
+		"""
+		:param m            : Measurement with the observation in m.z
+		:param angle        : index of an innovation in degrees to wrap into [-180, 180)
+		"""
+		numpy.dot(m.H, this.x, out = m.hx)
+		numpy.subtract(m.z, m.hx, out = m.y)
+		if angle is not None:
+			m.y[angle] = (m.y[angle] + 180) % 360 - 180
+		numpy.dot(this.P, m.Ht, out = m.PHt)
+		numpy.dot(m.H, m.PHt, out = m.S)
+		m.S += m.R
+		invert(m.S, m.Sinv)
+		numpy.dot(m.PHt, m.Sinv, out = m.K)
+		numpy.dot(m.K, m.y, out = m.dx)
+		this.x += m.dx
+		#P = (I - KH) P, symmetrized so rounding cannot make it indefinite
+		numpy.dot(m.K, m.H, out = m.KH)
+		numpy.dot(m.KH, this.P, out = this.T)
+		numpy.subtract(this.P, this.T, out = this.T2)
+		numpy.add(this.T2, this.T2.T, out = this.P)
+		this.P *= 0.5
+
+	def reset(this, *diagonal):
+		this.P.fill(0)
+		for i, v in enumerate(diagonal):
+			this.P[i, i] = v
+
+class Estimator(object):
+	"""
+	Boat model parameters match simulator.BoatModel: speed through water approaches
+	 maxSpeed * speed fraction with speedTau, and the turn rate approaches
+	 yawGain * speed * sin(motor angle) rad/s with yawTau.
+	"""
+	def __init__(this, maxSpeed = 1.5, speedTau = 3.0, maxMotorAngle = 90.0, yawGain = 0.4, yawTau = 1.0,
+				headingSigma = 1.0, yawNoise = 1.0, gpsSigma = 3.0, velocitySigma = 0.2, positionNoise = 0.1, driftNoise = 0.02):
+		this.maxSpeed = maxSpeed
+		this.speedTau = speedTau
+		this.maxMotorAngle = maxMotorAngle
+		this.yawGain = yawGain
+		this.yawTau = yawTau
+		this.yawVariance = yawNoise * yawNoise
+		this.gpsVariance = gpsSigma * gpsSigma
+		this.positionVariance = positionNoise * positionNoise
+		this.driftVariance = driftNoise * driftNoise
+
+		this.hdg = KalmanFilter(2)
+		this.pos = KalmanFilter(4)
+		this.headingFix = Measurement(2, [[1, 0]], [headingSigma * headingSigma])
+		this.positionFix = Measurement(4, [[1, 0, 0, 0], [0, 1, 0, 0]], [this.gpsVariance] * 2)
+		this.velocityFix = Measurement(4, [[0, 0, 1, 0], [0, 0, 0, 1]], [velocitySigma * velocitySigma] * 2)
+		this.speed = 0.0
+		this.at = None
+		this.headingReady = False
+		this.positionReady = False
+
+	def predict(this, now, speedFraction, motorFraction):
+		"""
+		Advance the estimate to `now` (seconds, monotonic)
+		:param speedFraction: commanded speed, 0 (off) to 1 (Speed.MAX)
+		:param motorFraction: motor angle from the turn position, -1 (full left) to 1 (full right)
+		"""
+		dt = now - this.at if this.at is not None else 0
+		this.at = now
+		if dt <= 0:
+			return
+		this.speed += (speedFraction * this.maxSpeed - this.speed) * min(1.0, dt / this.speedTau)
+
+		h = this.hdg
+		if this.headingReady:
+			relax = min(1.0, dt / this.yawTau)
+			commanded = math.degrees(this.yawGain * this.speed * math.sin(math.radians(motorFraction * this.maxMotorAngle)))
+			h.F[0, 1] = dt
+			h.F[1, 1] = 1 - relax
+			h.bu[1] = relax * commanded
+			h.Q[1, 1] = this.yawVariance * dt
+			h.predict()
+			h.x[0] %= 360
+
+		if this.positionReady:
+			p = this.pos
+			p.F[0, 2] = dt
+			p.F[1, 3] = dt
+			east, north = this.thrust()
+			p.bu[0] = east * dt
+			p.bu[1] = north * dt
+			p.Q[0, 0] = p.Q[1, 1] = this.positionVariance * dt
+			p.Q[2, 2] = p.Q[3, 3] = this.driftVariance * dt
+			p.predict()
+
+	def thrust(this):
+		""":return (east, north) m/s of the speed through water along the estimated heading"""
+		if not this.headingReady:
+			return 0.0, 0.0
+		h = math.radians(this.hdg.x[0])
+		return this.speed * math.sin(h), this.speed * math.cos(h)
+
+	def heading(this, degrees):
+		"""Fuse a magnetometer heading"""
+		h = this.hdg
+		if not this.headingReady:
+			h.x[0] = degrees
+			h.x[1] = 0
+			h.reset(this.headingFix.R[0, 0], 100.0)
+			this.headingReady = True
+			return
+		this.headingFix.z[0] = degrees
+		h.update(this.headingFix, angle = 0)
+		h.x[0] %= 360
+
+	def position(this, east, north):
+		"""Fuse a GPS position in metres on the local plane"""
+		p = this.pos
+		if not this.positionReady:
+			p.x.fill(0)
+			p.x[0] = east
+			p.x[1] = north
+			p.reset(this.gpsVariance, this.gpsVariance, 1.0, 1.0)
+			this.positionReady = True
+			return
+		this.positionFix.z[0] = east
+		this.positionFix.z[1] = north
+		p.update(this.positionFix)
+
+	def velocity(this, east, north):
+		"""Fuse a GPS velocity over ground (from SOG/COG) in m/s"""
+		if not this.positionReady:
+			return
+		thrustEast, thrustNorth = this.thrust()
+		this.velocityFix.z[0] = east - thrustEast
+		this.velocityFix.z[1] = north - thrustNorth
+		this.pos.update(this.velocityFix)
+
+	def recenter(this, east, north):
+		"""The local plane origin moved to (east, north), shift the position onto it"""
+		this.pos.x[0] -= east
+		this.pos.x[1] -= north
+
+	#################   Estimates
+
+	def headingEstimate(this):
+		""":return (heading deg, turn rate deg/s), heading None until the first magnetometer heading"""
+		if not this.headingReady:
+			return None, 0.0
+		return float(this.hdg.x[0]), float(this.hdg.x[1])
+
+	def positionEstimate(this):
+		""":return (east m, north m) on the local plane, None until the first GPS fix"""
+		if not this.positionReady:
+			return None
+		return float(this.pos.x[0]), float(this.pos.x[1])
+
+	def velocityEstimate(this):
+		""":return (east, north) m/s over ground"""
+		thrustEast, thrustNorth = this.thrust()
+		return thrustEast + float(this.pos.x[2]), thrustNorth + float(this.pos.x[3])
+
+	def driftEstimate(this):
+		""":return (east, north) m/s of drift, the velocity over ground with the motor's thrust removed"""
+		return float(this.pos.x[2]), float(this.pos.x[3])
@@ -0,0 +1,99 @@
+"""
+ Remote control gestures. Button down/up events become tap, double tap and hold gestures,
+ each emitted once. Holds fire from a timer at the moment their threshold is crossed instead
+ of being polled by the control loop, so an action bound to a hold runs exactly once however
+ long the button stays down.
+"""
+import logging
+import clock as clk
+
+logger = logging.getLogger(__name__)
+
+TAP = "tap"
+DOUBLE_TAP = "doubleTap"
+LONG = "long"
+EXTRA_LONG = "extraLong"
+
+class Recognizer(object):
+	"""
+	Bind actions with `bind`, then feed every button event to `down` and `up`.
+
+	 A press released before it fired a hold is a TAP, or a DOUBLE_TAP when the button went down
+	 within doubleTapSecs of the release of its previous tap and DOUBLE_TAP is bound. Holds
+	 (LONG, EXTRA_LONG or any other name) fire in order of their thresholds while the button is
+	 down, and a press that fired a hold is not a tap.
+
+	 `schedule(delay, callback)` calls back after delay seconds on the thread feeding events,
+	 e.g. loop.call_later. Hold timers are never cancelled: one firing after its press has ended
+	 is recognized as stale and ignored.
+	"""
+	def __init__(this, schedule, doubleTapSecs = 0.6, clock = None):
+		this.schedule = schedule
+		this.doubleTapSecs = doubleTapSecs
+		this.clock = clock or clk.get()
+		this.taps = {}
+		this.holds = {}
+		this.pressed = None
+		this.press = 0
+		this.downAt = 0
+		this.held = 0
+		this.lastTap = (None, 0)
+
+	def bind(this, buttonId, gesture, action, secs = None):
+		"""Call `action()` on `gesture` of the button. Holds need the secs the button is held for."""
+		if gesture in (TAP, DOUBLE_TAP):
+			this.taps[(buttonId, gesture)] = action
+			return
+		if secs is None:
+			raise ValueError(f"Hold gesture {gesture} of {buttonId} needs a threshold")
+		holds = [h for h in this.holds.get(buttonId, []) if h[1] != gesture]
+		holds.append((secs, gesture, action))
+		holds.sort(key = lambda h: h[0])
+		this.holds[buttonId] = holds
+
+	def down(this, buttonId, at):
+		if buttonId == this.pressed:
+			return
+		this.press += 1
+		this.pressed = buttonId
+		this.downAt = at
+		this.held = 0
+		this.armHold()
+
+	def up(this, buttonId, at):
+		if buttonId != this.pressed:
+			return
+		this.pressed = None
+		this.press += 1
+		if this.held:
+			return
+		gesture = TAP
+		lastButton, lastUpAt = this.lastTap
+		if lastButton == buttonId and this.downAt - lastUpAt <= this.doubleTapSecs and (buttonId, DOUBLE_TAP) in this.taps:
+			gesture = DOUBLE_TAP
+			this.lastTap = (None, 0)
+		else:
+			this.lastTap = (buttonId, at)
+		action = this.taps.get((buttonId, gesture))
+		if action:
+			this.emit(buttonId, gesture, action)
+
+	def armHold(this):
+		holds = this.holds.get(this.pressed)
+		if not holds or this.held >= len(holds):
+			return
+		press = this.press
+		delay = max(0, this.downAt + holds[this.held][0] - this.clock.now())
+		this.schedule(delay, lambda: this.onHold(press))
+
+	def onHold(this, press):
+		if press != this.press:
+			return #released or pressed again since
+		secs, gesture, action = this.holds[this.pressed][this.held]
+		this.held += 1
+		this.emit(this.pressed, gesture, action)
+		this.armHold()
+
+	def emit(this, buttonId, gesture, action):
+		logger.info("Gesture: %s %s", buttonId, gesture)
+		action()
@@ -0,0 +1,320 @@
+"""
+ gpsd client. gpsd owns the GPS serial port and streams JSON reports to clients that send
+ ?WATCH={"enable":true,"json":true}. Reports are newline terminated objects, framed incrementally
+ from whatever the socket hands back like nmea.NMEAParser frames sentences, and TPV (fix) and
+ SKY (satellites) reports are decoded into slotted records.
+
+ FakeGPSD serves the same protocol on a local port, for the simulator and for testing the client
+ without a receiver.
+"""
+import json
+import time
+import socket
+import select
+import logging
+import threading
+import utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 2947
+WATCH = b'?WATCH={"enable":true,"json":true};\n'
+#SKY reports list every satellite in view and run to a few KB
+MAX_REPORT_LENGTH = 16384
+
+#TPV fix modes
+MODE_UNKNOWN = 0
+MODE_NO_FIX = 1
+MODE_2D = 2
+MODE_3D = 3
+
+class TPVReport(object):
+	"""
+	Time-position-velocity report. Speed is m/s and track degrees true. The errors are gpsd's
+	 95% confidence estimates: eph/epv in metres, eps in m/s, epd in degrees. Fields gpsd left
+	 out are None.
+	"""
+	__slots__ = ('device', 'mode', 'time', 'latitude', 'longitude', 'altitude', 'speed', 'track',
+				'horizontalError', 'verticalError', 'speedError', 'trackError')
+
+	def __init__(this, device, mode, time, latitude, longitude, altitude, speed, track,
+				horizontalError, verticalError, speedError, trackError):
+		this.device = device
+		this.mode = mode
+		this.time = time
+		this.latitude = latitude
+		this.longitude = longitude
+		this.altitude = altitude
+		this.speed = speed
+		this.track = track
+		this.horizontalError = horizontalError
+		this.verticalError = verticalError
+		this.speedError = speedError
+		this.trackError = trackError
+
+	def __repr__(this):
+		return f"TPV(mode={this.mode}, {this.latitude},{this.longitude},{this.altitude}, speed={this.speed}, track={this.track}, eph={this.horizontalError})"
+
+class SKYReport(object):
+	"""Satellites seen and used in the fix, and the dilutions of precision"""
+	__slots__ = ('device', 'visible', 'used', 'hdop', 'vdop', 'pdop')
+
+	def __init__(this, device, visible, used, hdop, vdop, pdop):
+		this.device = device
+		this.visible = visible
+		this.used = used
+		this.hdop = hdop
+		this.vdop = vdop
+		this.pdop = pdop
+
+	def __repr__(this):
+		return f"SKY(used={this.used}/{this.visible}, hdop={this.hdop})"
+
+#################   Report Decoding
+
+def decodeTPV(r):
+	#gpsd 3.20+ reports altHAE/altMSL, older versions alt
+	altitude = r.get("altMSL", r.get("alt"))
+	eph = r.get("eph")
+	if eph is None and "epx" in r and "epy" in r:
+		eph = max(r["epx"], r["epy"])
+	return TPVReport(r.get("device"), int(r.get("mode", MODE_UNKNOWN)), r.get("time"), r.get("lat"), r.get("lon"),
+					altitude, r.get("speed"), r.get("track"), eph, r.get("epv"), r.get("eps"), r.get("epd"))
+
+def decodeSKY(r):
+	satellites = r.get("satellites")
+	if satellites is not None:
+		visible = len(satellites)
+		used = sum(1 for s in satellites if s.get("used"))
+	else:
+		#gpsd 3.23+ can send counts without the satellite list
+		visible = r.get("nSat")
+		used = r.get("uSat")
+	return SKYReport(r.get("device"), visible, used, r.get("hdop"), r.get("vdop"), r.get("pdop"))
+
+DECODERS = {
+	"TPV" : decodeTPV,
+	"SKY" : decodeSKY
+}
+
+#################   Parser
+
+class GPSDParser(object):
+
+	def __init__(this, decoders = DECODERS):
+		this.buffer = bytearray()
+		this.decoders = decoders
+		this.reports = 0
+		this.decodeErrors = 0
+		this.unsupported = 0
+
+	def reset(this):
+		"""Drop a partial report, e.g. after reconnecting"""
+		del this.buffer[:]
+
+	def feed(this, chunk):
+		"""
+		:param chunk        : bytes read from gpsd, may hold partial or multiple reports
+		:return list of TPV and SKY records decoded from every report completed by this chunk
+		"""
+		buf = this.buffer
+		buf += chunk
+		records = []
+		start = 0
+		while True:
+			end = buf.find(b'\n', start)
+			if end < 0:
+				break
+			record = this.decode(buf, start, end)
+			if record is not None:
+				records.append(record)
+			start = end + 1
+		if start:
+			del buf[:start]
+		if len(buf) > MAX_REPORT_LENGTH:
+			#No line ending in sight, resync on the next report
+			resync = buf.rfind(b'{"class"')
+			del buf[:resync if resync > 0 else len(buf)]
+		return records
+
+	def decode(this, buf, start, end):
+		line = bytes(buf[start:end]).strip()
+		if not line:
+			return None
+		try:
+			report = json.loads(line)
+			decoder = this.decoders.get(report.get("class"))
+			this.reports += 1
+			if decoder is None:
+				this.unsupported += 1
+				return None
+			return decoder(report)
+		except (ValueError, TypeError, AttributeError):
+			this.decodeErrors += 1
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug(f"Invalid gpsd report [{line}]")
+			return None
+
+#################   Client
+
+class Connection(object):
+	"""
+	Socket to gpsd with watching turned on. Reads are non-blocking: `read` waits in select for at
+	 most `timeout` and returns everything buffered, b'' when nothing arrived. Raises OSError once
+	 gpsd has gone away, `open` connects again.
+	"""
+	def __init__(this, host = DEFAULT_HOST, port = DEFAULT_PORT, timeout = 0.5):
+		this.host = host
+		this.port = port
+		this.timeout = timeout
+		this.sock = None
+		this.open()
+
+	def open(this):
+		this.close()
+		sock = socket.create_connection((this.host, this.port), this.timeout)
+		try:
+			sock.sendall(WATCH)
+			sock.setblocking(False)
+		except OSError:
+			sock.close()
+			raise
+		this.sock = sock
+
+	def read(this, timeout = None):
+		sock = this.sock
+		if sock is None:
+			raise ConnectionError("gpsd connection is closed")
+		readable, _, _ = select.select([sock], [], [], this.timeout if timeout is None else timeout)
+		if not readable:
+			return b''
+		data = b''
+		while True:
+			try:
+				chunk = sock.recv(4096)
+			except BlockingIOError:
+				return data
+			if not chunk:
+				if data:
+					return data
+				raise ConnectionError(f"gpsd at {this.host}:{this.port} closed the connection")
+			data += chunk
+
+	def close(this):
+		if this.sock:
+			this.sock.close()
+			this.sock = None
+
+	def __repr__(this):
+		return f"gpsd {this.host}:{this.port}"
+
+#################   Fake Server
+
+class FakeGPSD(utils.WorkerThread):
+	"""
+	Speaks enough of gpsd's protocol for the client: each connection is greeted with VERSION,
+	 ?WATCH is answered with DEVICES and WATCH, and watching clients get a SKY and a TPV report
+	 for `latitude`/`longitude`/`altitude`/`speed`/`track`/`mode` every 1/rateHz seconds. Set the
+	 attributes from outside to script a track, or push any report with `send`.
+	 Port 0 listens on a free port, see `port`.
+	"""
+	def __init__(this, host = DEFAULT_HOST, port = 0, latitude = 44.9778, longitude = -93.2650, rateHz = 1):
+		utils.WorkerThread.__init__(this, "Fake_GPSD_Thread")
+		this.daemon = True
+		this.latitude = latitude
+		this.longitude = longitude
+		this.altitude = 260.0
+		this.speed = 0.0
+		this.track = 0.0
+		this.mode = MODE_3D
+		this.horizontalError = 2.5
+		this.satellites = 9
+		this.period = 1.0 / rateHz if rateHz else None
+		this.device = "/dev/serial0"
+		this.server = socket.create_server((host, port))
+		this.host, this.port = this.server.getsockname()[:2]
+		this.lock = threading.Lock()
+		this.clients = []
+		this.watching = []
+
+	def report(this, cls, **fields):
+		return json.dumps(dict({"class" : cls}, **fields), separators = (",", ":")).encode() + b"\r\n"
+
+	def tpv(this, now):
+		return this.report("TPV", device = this.device, mode = this.mode,
+						time = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(now)),
+						lat = this.latitude, lon = this.longitude, altMSL = this.altitude, speed = this.speed,
+						track = this.track, eph = this.horizontalError, epv = this.horizontalError * 2,
+						eps = 0.5, epd = 10.0)
+
+	def sky(this):
+		satellites = [{"PRN" : prn, "el" : 45, "az" : prn * 20, "ss" : 35, "used" : prn <= this.satellites}
+					for prn in range(1, this.satellites + 3)]
+		return this.report("SKY", device = this.device, hdop = 0.9, vdop = 1.2, pdop = 1.5, satellites = satellites)
+
+	def send(this, data, clients = None):
+		"""Write raw report bytes to every watching client, dropping clients that went away"""
+		with this.lock:
+			for c in list(this.watching if clients is None else clients):
+				try:
+					c.sendall(data)
+				except OSError:
+					this.drop(c)
+
+	def drop(this, c):
+		if c in this.watching:
+			this.watching.remove(c)
+		if c in this.clients:
+			this.clients.remove(c)
+		c.close()
+
+	def accept(this):
+		c, _ = this.server.accept()
+		with this.lock:
+			this.clients.append(c)
+		this.send(this.report("VERSION", release = "3.22", rev = "fake", proto_major = 3, proto_minor = 14), [c])
+
+	def command(this, c):
+		try:
+			data = c.recv(4096)
+		except OSError:
+			data = b''
+		if not data:
+			with this.lock:
+				this.drop(c)
+			return
+		if b'?WATCH' in data:
+			this.send(this.report("DEVICES", devices = [{"class" : "DEVICE", "path" : this.device, "driver" : "NMEA0183"}]), [c])
+			this.send(this.report("WATCH", enable = True, json = True), [c])
+			with this.lock:
+				if c not in this.watching:
+					this.watching.append(c)
+
+	def run(this):
+		nextAt = time.monotonic()
+		while not this.isStopped():
+			timeout = None if this.period is None else max(0, nextAt - time.monotonic())
+			with this.lock:
+				sockets = [this.server] + this.clients
+			try:
+				readable, _, _ = select.select(sockets, [], [], 0.5 if timeout is None else min(timeout, 0.5))
+			except (OSError, ValueError):
+				if this.isStopped():
+					break
+				continue
+			for s in readable:
+				if s is this.server:
+					this.accept()
+				else:
+					this.command(s)
+			if this.period is not None and time.monotonic() >= nextAt:
+				this.send(this.sky() + this.tpv(time.time()))
+				nextAt += this.period
+		with this.lock:
+			for c in list(this.clients):
+				this.drop(c)
+
+	def close(this):
+		utils.stopThread(this)
+		this.server.close()
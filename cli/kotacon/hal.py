@@ -0,0 +1,348 @@
+"""
+ Hardware abstraction layer. Every device the controller touches is created through the
+ selected backend, so the whole controller can run on the Pi ("real") or on any Linux box
+ ("sim") with a pty fed NMEA stream or a fake gpsd, a scripted magnetometer, a scripted RF
+ remote and gpiozero's mock pin factory in place of the hardware.
+
+	python3 controller.py backend=sim [simRF=remote.txt] logFile=/tmp/kotacon.log
+"""
+import os
+import tty
+import math
+import time
+import random
+import logging
+import utils
+import nmea
+import metrics
+
+logger = logging.getLogger(__name__)
+
+#################   Relay Banks
+
+class RelayLine(object):
+	"""One relay of a bank, with the OutputDevice value/on/off interface"""
+	def __init__(this, bank, pin):
+		this.bank = bank
+		this.pin = pin
+
+	@property
+	def value(this):
+		return this.bank.state[this.pin]
+
+	@value.setter
+	def value(this, v):
+		this.bank.apply({this.pin : 1 if v else 0})
+
+	def on(this):
+		this.value = 1
+
+	def off(this):
+		this.value = 0
+
+class RelayBank(object):
+	"""
+	Relays written together. `apply` diffs the target states against the last written ones and
+	 hands only the changed lines to `write` as a single transition, timing each transition.
+	"""
+	def __init__(this, name, pins):
+		this.name = name
+		this.pins = list(pins)
+		this.state = dict.fromkeys(this.pins, 0)
+		this.latency = metrics.registry.histogram("relay_write", "Time to apply one relay bank transition", bank = name)
+
+	def line(this, pin):
+		return RelayLine(this, pin)
+
+	def apply(this, target):
+		""":param target: {pin : 0|1} for the lines to set, other lines keep their state"""
+		state = this.state
+		changes = {pin : v for pin, v in target.items() if state[pin] != v}
+		if not changes:
+			return
+		started = time.perf_counter_ns()
+		this.write(changes)
+		this.latency.since(started)
+		state.update(changes)
+
+	def close(this):
+		pass
+
+class GpiodRelayBank(RelayBank):
+	"""
+	All lines held in one libgpiod v2 line request, so a transition is one set_values ioctl and
+	 every changed line switches at the same instant. Requires pip3 install gpiod.
+	"""
+	def __init__(this, name, pins, active_high = True, initial_value = False, chip = "/dev/gpiochip0"):
+		import gpiod
+		from gpiod.line import Direction, Value
+		RelayBank.__init__(this, name, pins)
+		this.levels = (Value.INACTIVE, Value.ACTIVE)
+		this.request = gpiod.request_lines(chip, consumer = "kotacon-" + name,
+			config = {tuple(this.pins) : gpiod.LineSettings(direction = Direction.OUTPUT, active_low = not active_high,
+															output_value = this.levels[1 if initial_value else 0])})
+		this.state = dict.fromkeys(this.pins, 1 if initial_value else 0)
+
+	def write(this, changes):
+		levels = this.levels
+		this.request.set_values({pin : levels[v] for pin, v in changes.items()})
+
+	def close(this):
+		this.request.release()
+
+class DeviceRelayBank(RelayBank):
+	"""Bank over individual OutputDevices, for backends without line requests. Lines are written one by one."""
+	def __init__(this, name, devices):
+		RelayBank.__init__(this, name, devices.keys())
+		this.devices = devices
+		this.state = {pin : 1 if d.value else 0 for pin, d in devices.items()}
+
+	def write(this, changes):
+		devices = this.devices
+		for pin, v in changes.items():
+			devices[pin].value = v
+
+class RealBackend(object):
+	"""Wraps the libraries the controller has always used. Imports happen on first use."""
+	name = "real"
+
+	def __init__(this):
+		this.banks = []
+
+	def outputDevice(this, pin, **kwargs):
+		import gpiozero
+		return gpiozero.OutputDevice(pin, **kwargs)
+
+	def led(this, pin):
+		import gpiozero
+		return gpiozero.LED(pin)
+
+	def relayBank(this, name, pins, **kwargs):
+		"""One gpiod line request for the bank, falling back to gpiozero devices without libgpiod v2"""
+		try:
+			bank = GpiodRelayBank(name, pins, **kwargs)
+		except (ImportError, AttributeError, OSError) as e:
+			logger.warning("Writing %s relays one at a time, gpiod line request failed: %s", name, e)
+			bank = DeviceRelayBank(name, {pin : this.outputDevice(pin, **kwargs) for pin in pins})
+		this.banks.append(bank)
+		return bank
+
+	def gpsSerial(this, port, baudrate, timeout):
+		import serial
+		return serial.Serial(port, baudrate = baudrate, timeout = timeout)
+
+	def gpsdConnection(this, host, port, timeout):
+		import gpsd
+		return gpsd.Connection(host, port, timeout)
+
+	def magnetometer(this, rateHz):
+		import py_qmc5883l
+		odr = {
+			10 : py_qmc5883l.ODR_10HZ,
+			50 : py_qmc5883l.ODR_50HZ,
+			100 : py_qmc5883l.ODR_100HZ,
+			200 : py_qmc5883l.ODR_200HZ
+		}
+		return py_qmc5883l.QMC5883L(output_data_rate = odr.get(rateHz, py_qmc5883l.ODR_100HZ))
+
+	def rfReceiver(this, kind, pin, onCode):
+		import rfcontrols
+		return rfcontrols.RECEIVERS[kind](pin, onCode)
+
+	def close(this):
+		for bank in this.banks:
+			bank.close()
+
+#################   Simulated Devices
+
+class SimulatedGPS(utils.WorkerThread):
+	"""
+	Writes RMC/GGA/VTG sentences for `latitude`/`longitude`/`course`/`speedKnots` into the
+	 master side of a pty at `rateHz`. The controller opens the slave side with pyserial exactly
+	 as it would /dev/serial0. Set the attributes from outside to script a track.
+	"""
+	def __init__(this, latitude = 44.9778, longitude = -93.2650, rateHz = 1):
+		utils.WorkerThread.__init__(this, "Sim_GPS_Thread")
+		this.daemon = True
+		this.latitude = latitude
+		this.longitude = longitude
+		this.course = 0.0
+		this.speedKnots = 0.0
+		this.period = 1.0 / rateHz
+		this.master, this.slave = os.openpty()
+		tty.setraw(this.slave)
+		this.port = os.ttyname(this.slave)
+
+	def coordinate(value, degreeDigits):
+		value = abs(value)
+		degrees = int(value)
+		return f"{degrees:0{degreeDigits}d}{(value - degrees) * 60:07.4f}"
+
+	def sentences(this, now):
+		t = time.gmtime(now)
+		hms = time.strftime("%H%M%S", t) + f".{int(now * 100) % 100:02d}"
+		dmy = time.strftime("%d%m%y", t)
+		lat = SimulatedGPS.coordinate(this.latitude, 2) + ("," + ("N" if this.latitude >= 0 else "S"))
+		lon = SimulatedGPS.coordinate(this.longitude, 3) + ("," + ("E" if this.longitude >= 0 else "W"))
+		return (nmea.sentence(f"GNRMC,{hms},A,{lat},{lon},{this.speedKnots:.2f},{this.course:.1f},{dmy},,,A") +
+				nmea.sentence(f"GNVTG,{this.course:.1f},T,,M,{this.speedKnots:.2f},N,{this.speedKnots * 1.852:.2f},K,A") +
+				nmea.sentence(f"GNGGA,{hms},{lat},{lon},1,09,0.9,260.0,M,-31.0,M,,"))
+
+	def run(this):
+		while not this.isStopped():
+			os.write(this.master, this.sentences(time.time()))
+			this.stopFlag.wait(this.period)
+
+	def close(this):
+		this.stop()
+		os.close(this.master)
+		os.close(this.slave)
+
+class ScriptedMagnetometer(object):
+	"""
+	Stands in for py_qmc5883l.QMC5883L. Returns the raw field vector for `heading` (degrees,
+	 settable from outside) plus gaussian noise. Defaults to a slow sinusoidal yaw.
+	"""
+	def __init__(this, fieldStrength = 1500, noise = 15, heading = None):
+		this.fieldStrength = fieldStrength
+		this.noise = noise
+		this.heading = heading
+		this.startedAt = time.monotonic()
+		this.random = random.Random(0)
+
+	def currentHeading(this):
+		if this.heading is not None:
+			return this.heading
+		return (90 + 20 * math.sin((time.monotonic() - this.startedAt) / 30)) % 360
+
+	def get_magnet_raw(this):
+		a = math.radians(this.currentHeading())
+		r = this.random
+		return [this.fieldStrength * math.cos(a) + r.gauss(0, this.noise),
+				this.fieldStrength * math.sin(a) + r.gauss(0, this.noise),
+				-400 + r.gauss(0, this.noise)]
+
+	def get_bearing(this):
+		return this.currentHeading()
+
+class ScriptedRemote(utils.WorkerThread):
+	"""
+	Plays a remote control script into the RF receiver callback. Each script line is
+		<start secs> <code> <hold secs> [pulse] [protocol]
+	 and, like a real remote, a held button repeats its code every `repeatSecs`.
+	"""
+	def __init__(this, onCode, script = (), repeatSecs = 0.1):
+		utils.WorkerThread.__init__(this, "Sim_RF_Thread")
+		this.daemon = True
+		this.onCode = onCode
+		this.script = sorted(script)
+		this.repeatSecs = repeatSecs
+		this.start()
+
+	def waitReady(this, seconds):
+		#start() returns once the thread is running the script
+		return True
+
+	def load(path):
+		script = []
+		with open(path) as f:
+			for line in f:
+				parts = line.split("#")[0].split()
+				if parts:
+					startAt, code, hold = float(parts[0]), int(parts[1]), float(parts[2])
+					pulse = int(parts[3]) if len(parts) > 3 else 350
+					proto = int(parts[4]) if len(parts) > 4 else 1
+					script.append((startAt, code, hold, pulse, proto))
+		return script
+
+	def run(this):
+		origin = time.monotonic()
+		for startAt, code, hold, pulse, proto in this.script:
+			at = origin + startAt
+			endAt = at + hold
+			while at <= endAt:
+				if this.stopFlag.wait(max(0, at - time.monotonic())):
+					return
+				this.onCode(code, pulse, proto)
+				at += this.repeatSecs
+
+	def close(this):
+		this.stop()
+
+class SimBackend(object):
+	name = "sim"
+
+	def __init__(this, rfScript = None):
+		import gpiozero
+		from gpiozero.pins.mock import MockFactory
+		gpiozero.Device.pin_factory = MockFactory()
+		this.rfScript = ScriptedRemote.load(rfScript) if rfScript else []
+		this.gps = None
+		this.gpsd = None
+		this.compass = None
+		this.remote = None
+
+	def outputDevice(this, pin, **kwargs):
+		import gpiozero
+		return gpiozero.OutputDevice(pin, **kwargs)
+
+	def led(this, pin):
+		import gpiozero
+		return gpiozero.LED(pin)
+
+	def relayBank(this, name, pins, **kwargs):
+		return DeviceRelayBank(name, {pin : this.outputDevice(pin, **kwargs) for pin in pins})
+
+	def gpsSerial(this, port, baudrate, timeout):
+		import serial
+		this.gps = SimulatedGPS()
+		this.gps.start()
+		logger.info("Simulated GPS on %s (in place of %s)", this.gps.port, port)
+		return serial.Serial(this.gps.port, baudrate = baudrate, timeout = timeout)
+
+	def gpsdConnection(this, host, port, timeout):
+		import gpsd
+		this.gpsd = gpsd.FakeGPSD()
+		this.gpsd.start()
+		logger.info("Fake gpsd on %s:%s (in place of %s:%s)", this.gpsd.host, this.gpsd.port, host, port)
+		return gpsd.Connection(this.gpsd.host, this.gpsd.port, timeout)
+
+	def magnetometer(this, rateHz):
+		this.compass = ScriptedMagnetometer()
+		return this.compass
+
+	def rfReceiver(this, kind, pin, onCode):
+		this.remote = ScriptedRemote(onCode, this.rfScript)
+		return this.remote
+
+	def close(this):
+		if this.gps:
+			this.gps.close()
+		if this.gpsd:
+			this.gpsd.close()
+		if this.remote:
+			this.remote.close()
+
+#################   Selection
+
+backend = RealBackend()
+
+def use(name, argv = None):
+	"""Select the backend every device is created through. Call before creating any device."""
+	global backend
+	if name == "sim":
+		backend = SimBackend(rfScript = utils.argValue(argv, "simRF"))
+	elif name == "real":
+		backend = RealBackend()
+	else:
+		raise ValueError(f"Unknown hardware backend {name}")
+	logger.info("Using %s hardware backend", backend.name)
+	return backend
+
+def install(b):
+	"""Install a backend object directly, e.g. the simulator's in-memory devices"""
+	global backend
+	backend = b
+
+def get():
+	return backend
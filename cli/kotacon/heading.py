@@ -0,0 +1,270 @@
+"""
+ High rate heading sampling for the QMC5883L. The sensor is read at its output data rate on
+ a dedicated thread into a fixed size ring of raw X/Y/Z samples, and each new sample publishes
+ a filtered heading and turn rate. The control loop only copies the published tuple.
+"""
+import os
+import sys
+import json
+import math
+import time
+import struct
+import logging
+import numpy
+import utils
+import clock as clk
+
+logger = logging.getLogger(__name__)
+
+#QMC5883L registers: X/Y/Z LSB,MSB pairs at 0x00-0x05 followed by the status register
+REG_XOUT_LSB = 0x00
+REG_STATUS = 0x06
+STAT_DRDY = 0x01
+STAT_OVL = 0x02
+
+def burstRead(sensor):
+	"""
+	Poll status, then read all six data registers in one I2C block transfer instead of the
+	 library's three separate word reads. Status has to come first: reading the data registers
+	 clears DRDY.
+	:return raw (x, y, z) or None when no new sample is ready or the field overflowed
+	"""
+	bus = sensor.bus
+	stat = bus.read_byte_data(sensor.address, REG_STATUS)
+	if not stat & STAT_DRDY or stat & STAT_OVL:
+		return None
+	return struct.unpack("<hhh", bytes(bus.read_i2c_block_data(sensor.address, REG_XOUT_LSB, 6)))
+
+#################   Calibration
+
+class Calibration(object):
+	"""
+	Hard-iron offset and soft-iron matrix. corrected = matrix . (raw - offset), precomputed as
+	 corrected = matrix . raw - bias so each sample costs one matrix multiply and a subtract.
+	"""
+	def __init__(this, offset = (0, 0, 0), matrix = None, samples = 0, residual = None):
+		this.offset = numpy.array(offset, dtype = float)
+		this.matrix = numpy.eye(3) if matrix is None else numpy.array(matrix, dtype = float)
+		this.bias = this.matrix.dot(this.offset)
+		this.samples = samples
+		this.residual = residual
+
+	def apply(this, raw):
+		return this.matrix.dot(raw) - this.bias
+
+	def save(this, path):
+		tmp = path + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump({
+				"offset" : this.offset.tolist(),
+				"matrix" : this.matrix.tolist(),
+				"samples" : this.samples,
+				"residual" : this.residual,
+				"created" : time.strftime("%Y-%m-%d %X")
+			}, f, indent = 1)
+		os.replace(tmp, path)
+
+	def load(path):
+		with open(path) as f:
+			d = json.load(f)
+		return Calibration(d["offset"], d["matrix"], d.get("samples", 0), d.get("residual"))
+
+	def __repr__(this):
+		return f"offset={numpy.round(this.offset, 1).tolist()} matrix={numpy.round(this.matrix, 4).tolist()} samples={this.samples} residual={this.residual}"
+
+def sqrtMatrix(quadric):
+	"""
+	Symmetric square root M of a positive definite quadric A, so M.T M = A. Points on the
+	 ellipse/ellipsoid (p - c).T A (p - c) = 1 satisfy |M (p - c)| = 1, so M is the soft-iron
+	 matrix that maps the measured ellipsoid onto the unit sphere.
+	"""
+	w, v = numpy.linalg.eigh(quadric)
+	if numpy.any(w <= 0):
+		raise ValueError("Calibration samples do not describe an ellipse")
+	return v.dot(numpy.diag(numpy.sqrt(w))).dot(v.T)
+
+def fitEllipsoid(xyz):
+	"""Least squares fit of ax2+by2+cz2+2dxy+2exz+2fyz+2gx+2hy+2iz = 1"""
+	x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+	D = numpy.column_stack((x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z))
+	p = numpy.linalg.lstsq(D, numpy.ones(len(x)), rcond = None)[0]
+	Q = numpy.array([[p[0], p[3], p[4]], [p[3], p[1], p[5]], [p[4], p[5], p[2]]])
+	center = -numpy.linalg.solve(Q, p[6:9])
+	k = 1 + center.dot(Q).dot(center)
+	return center, sqrtMatrix(Q / k)
+
+def fitEllipse(xy):
+	"""Least squares fit of ax2+bxy+cy2+dx+ey = 1"""
+	x, y = xy[:, 0], xy[:, 1]
+	D = numpy.column_stack((x * x, x * y, y * y, x, y))
+	p = numpy.linalg.lstsq(D, numpy.ones(len(x)), rcond = None)[0]
+	Q = numpy.array([[p[0], p[1] / 2], [p[1] / 2, p[2]]])
+	center = -numpy.linalg.solve(2 * Q, p[3:5])
+	k = 1 + center.dot(Q).dot(center)
+	return center, sqrtMatrix(Q / k)
+
+def fitCalibration(samples, minSamples = 50):
+	"""
+	Fit hard and soft-iron correction to raw samples captured while the boat turns through at
+	 least a full circle. A boat spins nearly flat, so when Z barely varies a full ellipsoid is
+	 ill-conditioned; then only the X/Y ellipse is fitted and Z passes through offset-corrected.
+	 The corrected field keeps the mean raw field strength so readings stay in familiar units.
+	"""
+	xyz = numpy.array(samples, dtype = float)
+	if len(xyz) < minSamples:
+		raise ValueError(f"Need at least {minSamples} samples, got {len(xyz)}")
+	spread = xyz.max(axis = 0) - xyz.min(axis = 0)
+	if spread[2] > 0.5 * min(spread[0], spread[1]):
+		dims = 3
+		offset, matrix = fitEllipsoid(xyz)
+		matrix = matrix * numpy.linalg.norm(xyz - offset, axis = 1).mean()
+	else:
+		dims = 2
+		center, m2 = fitEllipse(xyz[:, :2])
+		offset = numpy.array([center[0], center[1], xyz[:, 2].mean()])
+		matrix = numpy.eye(3)
+		matrix[:2, :2] = m2 * numpy.linalg.norm(xyz[:, :2] - center, axis = 1).mean()
+	cal = Calibration(offset, matrix, len(xyz))
+	#Residual: spread of the corrected field strength over the fitted axes, relative to its mean
+	corrected = xyz.dot(cal.matrix.T) - cal.bias
+	strength = numpy.linalg.norm(corrected[:, :dims], axis = 1)
+	cal.residual = round(float(strength.std() / strength.mean()), 4)
+	return cal
+
+class HeadingSampler(utils.WorkerThread):
+	"""
+	Filtered heading is the circular mean of the window: the direction of the mean X/Y field
+	 vector, which unlike averaging angles has no trouble at the 0/360 wrap. Turn rate is the
+	 least squares slope of each sample's angle from that mean over the sample times.
+
+	 `latest` is a (heading degrees, turn rate degrees/sec, sample time on `clock`) tuple,
+	 heading is None until the first sample is read.
+	"""
+	def __init__(this, sensor, rateHz = 100, window = 25, declination = 0, calibration = None, clock = None):
+		utils.WorkerThread.__init__(this, "Heading_Thread")
+		this.clock = clock or clk.get()
+		this.sensor = sensor
+		this.burst = hasattr(sensor, "bus") and hasattr(sensor, "address")
+		this.calibration = calibration
+		this.capture = None
+		this.maxCapture = 0
+		this.period = 1.0 / rateHz
+		this.declination = declination
+		this.raw = numpy.zeros((window, 3))
+		this.times = numpy.zeros(window)
+		this.index = 0
+		this.count = 0
+		this.errors = 0
+		this.latest = (None, 0.0, 0)
+
+	def sample(this):
+		""":return raw (x, y, z) or None when the sensor has no data"""
+		if this.burst:
+			return burstRead(this.sensor)
+		x, y, z = this.sensor.get_magnet_raw()
+		if x is None or y is None or z is None:
+			return None
+		return (x, y, z)
+
+	def setCalibration(this, calibration):
+		logger.info("Applying heading calibration: %s", calibration)
+		this.calibration = calibration
+		this.count = 0
+
+	def startCapture(this, maxSamples):
+		"""Collect raw samples for calibration alongside normal filtering"""
+		this.maxCapture = maxSamples
+		this.capture = []
+
+	def stopCapture(this):
+		samples = this.capture or []
+		this.capture = None
+		return samples
+
+	def add(this, xyz, now):
+		capture = this.capture
+		if capture is not None and len(capture) < this.maxCapture:
+			capture.append(xyz)
+		i = this.index
+		this.raw[i] = this.calibration.apply(xyz) if this.calibration else xyz
+		this.times[i] = now
+		this.index = (i + 1) % len(this.times)
+		if this.count < len(this.times):
+			this.count += 1
+
+	def update(this, xyz, now):
+		"""Add a raw sample and publish the refiltered heading"""
+		this.add(xyz, now)
+		heading, rate = this.filter()
+		this.latest = (heading, rate, now)
+
+	def rawHeading(this):
+		""":return heading of the newest sample alone, None before the first sample"""
+		if this.count == 0:
+			return None
+		x, y = this.raw[this.index - 1, :2]
+		return (math.degrees(math.atan2(y, x)) + this.declination) % 360
+
+	def filter(this):
+		""":return (heading, turnRate) over the samples in the ring"""
+		n = this.count
+		x = this.raw[:n, 0]
+		y = this.raw[:n, 1]
+		mean = math.atan2(y.mean(), x.mean())
+		heading = (math.degrees(mean) + this.declination) % 360
+		if n < 3:
+			return heading, 0.0
+		#Angle of every sample relative to the mean, wrapped to +/-pi
+		offsets = numpy.arctan2(y, x) - mean
+		offsets = (offsets + math.pi) % (2 * math.pi) - math.pi
+		t = this.times[:n] - this.times[:n].mean()
+		spread = numpy.dot(t, t)
+		rate = numpy.dot(t, offsets) / spread if spread > 0 else 0.0
+		return heading, math.degrees(rate)
+
+	def run(this):
+		logger.info("Heading Sampler Starting at %s Hz", 1.0 / this.period)
+		clock = this.clock
+		nextAt = clock.now()
+		while not this.isStopped():
+			try:
+				xyz = this.sample()
+			except OSError as e:
+				this.errors += 1
+				logger.warning("Heading sensor read failed: %s", e)
+				xyz = None
+			now = clock.now()
+			if xyz:
+				this.update(xyz, now)
+			nextAt += this.period
+			if nextAt < now:
+				nextAt = now
+			this.stopFlag.wait(nextAt - now)
+
+#################   Command Line Calibration
+
+def calibrate(seconds = 60, rateHz = 50, path = None):
+	"""Stream raw samples for `seconds` while the boat spins, fit, report and optionally save"""
+	import py_qmc5883l
+	sensor = py_qmc5883l.QMC5883L(output_data_rate = py_qmc5883l.ODR_50HZ)
+	sampler = HeadingSampler(sensor, rateHz)
+	sampler.startCapture(int(seconds * rateHz * 2))
+	print(f"Capturing for {seconds}s, turn the boat through at least one full circle...")
+	sampler.start()
+	try:
+		time.sleep(seconds)
+	finally:
+		utils.stopThread(sampler)
+	cal = fitCalibration(sampler.stopCapture())
+	print(f"Calibration: {cal}")
+	if path:
+		cal.save(path)
+		print(f"Saved to {path}")
+	return cal
+
+if __name__ == "__main__":
+	#python3 heading.py calibrate [seconds] [file]
+	if len(sys.argv) > 1 and sys.argv[1] == "calibrate":
+		calibrate(float(sys.argv[2]) if len(sys.argv) > 2 else 60, path = sys.argv[3] if len(sys.argv) > 3 else "/var/lib/kotacon/magcal.json")
+	else:
+		print("Usage: python3 heading.py calibrate [seconds] [file]")
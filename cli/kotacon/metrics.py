@@ -0,0 +1,182 @@
+"""
+ Control loop instrumentation. Stages time themselves with perf_counter_ns into fixed bucket,
+ log-linear (HDR style) histograms: buckets double every power of two and each power is split
+ into SUB_BUCKETS linear steps, so every reading is kept to within 1/SUB_BUCKETS relative error
+ from a microsecond to tens of seconds. Recording is a bisect and a few increments.
+
+ The registry is served as Prometheus text on a UNIX socket and dumped to the log on SIGUSR1.
+
+	curl --unix-socket /var/lib/kotacon/metrics.sock http://localhost/metrics
+"""
+import os
+import time
+import logging
+import asyncio
+import utils
+
+logger = logging.getLogger(__name__)
+
+SUB_BUCKETS = 4
+
+def hdrBounds(lowest = 1 << 10, highest = 1 << 35, subBuckets = SUB_BUCKETS):
+	""":return log-linear bucket edges from lowest to highest (ns by default: ~1us to ~34s)"""
+	bounds = []
+	power = lowest
+	while power < highest:
+		step = power // subBuckets
+		bounds.extend(power + step * i for i in range(1, subBuckets + 1))
+		power *= 2
+	return bounds
+
+NS_BOUNDS = hdrBounds()
+#Scrapes export the cumulative count at each power of two, the full resolution stays in the log dump
+EXPORT_BOUNDS = frozenset(NS_BOUNDS[SUB_BUCKETS - 1::SUB_BUCKETS])
+
+class LatencyHistogram(utils.Histogram):
+	"""utils.Histogram over NS_BOUNDS, recording nanoseconds"""
+	def __init__(this, name):
+		utils.Histogram.__init__(this, name, NS_BOUNDS, "ns")
+
+	def since(this, startedNs):
+		""":return now in perf_counter_ns after recording the time since startedNs"""
+		now = time.perf_counter_ns()
+		this.record(now - startedNs)
+		return now
+
+	def summary(this):
+		if this.count == 0:
+			return f"{this.name}: no samples"
+		return (f"{this.name}: n={this.count} mean={this.mean() / 1000:.1f}us p50={this.percentile(50) / 1000:.1f}us "
+				f"p90={this.percentile(90) / 1000:.1f}us p99={this.percentile(99) / 1000:.1f}us max={this.max / 1000:.1f}us")
+
+class Gauge(object):
+	"""Value read from `read` when sampled, keeping the largest value seen when trackMax is set"""
+	def __init__(this, name, read, trackMax = False):
+		this.name = name
+		this.read = read
+		this.trackMax = trackMax
+		this.value = 0
+		this.max = 0
+
+	def sample(this):
+		this.value = this.read()
+		if this.trackMax and this.value > this.max:
+			this.max = this.value
+
+class Registry(object):
+	def __init__(this):
+		this.histograms = {}
+		this.gauges = {}
+		this.help = {}
+
+	def histogram(this, metric, help, **labels):
+		"""Get or create the histogram for metric{labels}, so instrumented objects can be recreated"""
+		key = (metric, tuple(sorted(labels.items())))
+		h = this.histograms.get(key)
+		if h is None:
+			name = metric + "".join(f" {k}={v}" for k, v in key[1])
+			h = this.histograms[key] = LatencyHistogram(name)
+			this.help[metric] = help
+		return h
+
+	def gauge(this, metric, help, read, trackMax = False, **labels):
+		"""Gauge for metric{labels}, trackMax also exports the largest value seen at a tick as metric_max"""
+		key = (metric, tuple(sorted(labels.items())))
+		g = this.gauges[key] = Gauge(metric + "".join(f" {k}={v}" for k, v in key[1]), read, trackMax)
+		this.help[metric] = help
+		return g
+
+	def sample(this):
+		"""Sample every gauge, called once per control tick so maxima are tracked"""
+		for g in this.gauges.values():
+			try:
+				g.sample()
+			except Exception as e:
+				logger.debug("Gauge %s failed: %s", g.name, e)
+
+	def labelText(labels, extra = ()):
+		pairs = list(labels) + list(extra)
+		return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+	def exposition(this):
+		"""Prometheus text format. Histograms are exported in seconds."""
+		lines = []
+		seen = set()
+		for (metric, labels), h in sorted(this.histograms.items()):
+			name = f"kotacon_{metric}_seconds"
+			if name not in seen:
+				seen.add(name)
+				lines.append(f"# HELP {name} {this.help[metric]}")
+				lines.append(f"# TYPE {name} histogram")
+			cumulative = 0
+			for bound, count in zip(h.bounds, h.counts):
+				cumulative += count
+				if bound in EXPORT_BOUNDS:
+					lines.append(f"{name}_bucket{Registry.labelText(labels, [('le', f'{bound / 1e9:.9g}')])} {cumulative}")
+			lines.append(f"{name}_bucket{Registry.labelText(labels, [('le', '+Inf')])} {h.count}")
+			lines.append(f"{name}_sum{Registry.labelText(labels)} {h.total / 1e9:.9g}")
+			lines.append(f"{name}_count{Registry.labelText(labels)} {h.count}")
+		for (metric, labels), g in sorted(this.gauges.items()):
+			name = f"kotacon_{metric}"
+			if name not in seen:
+				seen.add(name)
+				lines.append(f"# HELP {name} {this.help[metric]}")
+				lines.append(f"# TYPE {name} gauge")
+			lines.append(f"{name}{Registry.labelText(labels)} {g.value}")
+		for (metric, labels), g in sorted(this.gauges.items()):
+			if not g.trackMax:
+				continue
+			name = f"kotacon_{metric}_max"
+			if name not in seen:
+				seen.add(name)
+				lines.append(f"# HELP {name} Largest {this.help[metric][0].lower()}{this.help[metric][1:]} seen at a tick")
+				lines.append(f"# TYPE {name} gauge")
+			lines.append(f"{name}{Registry.labelText(labels)} {g.max}")
+		return "\n".join(lines) + "\n"
+
+	def summary(this):
+		lines = [h.summary() for key, h in sorted(this.histograms.items())]
+		lines.extend(f"{g.name}: {g.value}" + (f" (max {g.max})" if g.trackMax else "") for key, g in sorted(this.gauges.items()))
+		return "\n".join(lines)
+
+	def dump(this):
+		#WARNING so a requested dump shows at the default log level
+		logger.warning("Metrics:\n%s", this.summary())
+
+registry = Registry()
+
+#################   Endpoint
+
+def removeSocket(path):
+	try:
+		os.unlink(path)
+	except FileNotFoundError:
+		pass
+
+async def serve(path, reg = None):
+	"""
+	Serve the registry on a UNIX socket. HTTP GETs (curl --unix-socket) get an HTTP response,
+	 a client that sends nothing (socat, nc -U) gets the bare text.
+	:return asyncio server, close it to stop serving
+	"""
+	reg = reg or registry
+	async def handle(reader, writer):
+		try:
+			try:
+				request = await asyncio.wait_for(reader.readline(), 0.2)
+			except asyncio.TimeoutError:
+				request = b""
+			body = reg.exposition().encode()
+			if request.startswith(b"GET"):
+				writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+							+ f"Content-Length: {len(body)}\r\n\r\n".encode())
+			writer.write(body)
+			await writer.drain()
+		except (ConnectionError, OSError) as e:
+			logger.debug("Metrics client failed: %s", e)
+		finally:
+			writer.close()
+	removeSocket(path)
+	server = await asyncio.start_unix_server(handle, path)
+	logger.info("Serving metrics on %s", path)
+	return server
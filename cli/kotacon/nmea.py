@@ -0,0 +1,227 @@
+"""
+ Incremental NMEA 0183 parser. Bytes are fed in whatever chunks the serial port hands back,
+ sentences are framed on '$' ... '\n' directly in a bytearray, the *hh checksum is verified and
+ the supported sentences are decoded into slotted fix records. Any talker id is accepted, so
+ $GPRMC, $GNRMC, $GLRMC etc. all decode as RMC.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_SENTENCE_LENGTH = 128
+
+class RMCFix(object):
+	__slots__ = ('talker', 'time', 'valid', 'latitude', 'longitude', 'speedKnots', 'course', 'date')
+
+	def __init__(this, talker, time, valid, latitude, longitude, speedKnots, course, date):
+		this.talker = talker
+		this.time = time
+		this.valid = valid
+		this.latitude = latitude
+		this.longitude = longitude
+		this.speedKnots = speedKnots
+		this.course = course
+		this.date = date
+
+	def __repr__(this):
+		return f"RMC(time={this.time}, valid={this.valid}, {this.latitude},{this.longitude}, sog={this.speedKnots}, cog={this.course})"
+
+class GGAFix(object):
+	__slots__ = ('talker', 'time', 'latitude', 'longitude', 'quality', 'satellites', 'hdop', 'altitude')
+
+	def __init__(this, talker, time, latitude, longitude, quality, satellites, hdop, altitude):
+		this.talker = talker
+		this.time = time
+		this.latitude = latitude
+		this.longitude = longitude
+		this.quality = quality
+		this.satellites = satellites
+		this.hdop = hdop
+		this.altitude = altitude
+
+	def __repr__(this):
+		return f"GGA(time={this.time}, {this.latitude},{this.longitude},{this.altitude}, quality={this.quality}, sats={this.satellites})"
+
+class VTGFix(object):
+	__slots__ = ('talker', 'course', 'courseMagnetic', 'speedKnots', 'speedKph')
+
+	def __init__(this, talker, course, courseMagnetic, speedKnots, speedKph):
+		this.talker = talker
+		this.course = course
+		this.courseMagnetic = courseMagnetic
+		this.speedKnots = speedKnots
+		this.speedKph = speedKph
+
+	def __repr__(this):
+		return f"VTG(cog={this.course}, sog={this.speedKnots})"
+
+class GSAFix(object):
+	__slots__ = ('talker', 'mode', 'fixType', 'satellites', 'pdop', 'hdop', 'vdop')
+
+	def __init__(this, talker, mode, fixType, satellites, pdop, hdop, vdop):
+		this.talker = talker
+		this.mode = mode
+		this.fixType = fixType
+		this.satellites = satellites
+		this.pdop = pdop
+		this.hdop = hdop
+		this.vdop = vdop
+
+	def __repr__(this):
+		return f"GSA(fix={this.fixType}, sats={len(this.satellites)}, pdop={this.pdop})"
+
+class HDTFix(object):
+	__slots__ = ('talker', 'heading')
+
+	def __init__(this, talker, heading):
+		this.talker = talker
+		this.heading = heading
+
+	def __repr__(this):
+		return f"HDT(heading={this.heading})"
+
+#################   Field Decoding
+
+def toFloat(field):
+	return float(field) if field else None
+
+def toInt(field):
+	return int(field) if field else None
+
+def toTime(field):
+	"""hhmmss.ss -> seconds since midnight UTC"""
+	if len(field) < 6:
+		return None
+	return int(field[0:2]) * 3600 + int(field[2:4]) * 60 + float(field[4:])
+
+def toCoordinate(field, hemisphere):
+	"""(d)ddmm.mmmm + N/S/E/W -> signed decimal degrees"""
+	if not field:
+		return None
+	dot = field.find(b'.')
+	if dot < 0:
+		dot = len(field)
+	if dot < 3:
+		raise ValueError(f"Invalid coordinate {field}")
+	value = int(field[:dot - 2]) + float(field[dot - 2:]) / 60
+	if hemisphere == b'S' or hemisphere == b'W':
+		return -value
+	elif hemisphere == b'N' or hemisphere == b'E':
+		return value
+	raise ValueError(f"Invalid hemisphere {hemisphere}")
+
+def decodeRMC(talker, f):
+	if len(f) < 10:
+		return None
+	return RMCFix(talker, toTime(f[1]), f[2] == b'A', toCoordinate(f[3], f[4]), toCoordinate(f[5], f[6]),
+				toFloat(f[7]), toFloat(f[8]), toInt(f[9]))
+
+def decodeGGA(talker, f):
+	if len(f) < 10:
+		return None
+	return GGAFix(talker, toTime(f[1]), toCoordinate(f[2], f[3]), toCoordinate(f[4], f[5]),
+				toInt(f[6]) or 0, toInt(f[7]) or 0, toFloat(f[8]), toFloat(f[9]))
+
+def decodeVTG(talker, f):
+	if len(f) < 8:
+		return None
+	return VTGFix(talker, toFloat(f[1]), toFloat(f[3]), toFloat(f[5]), toFloat(f[7]))
+
+def decodeGSA(talker, f):
+	if len(f) < 18:
+		return None
+	return GSAFix(talker, f[1], toInt(f[2]) or 1, [int(s) for s in f[3:15] if s],
+				toFloat(f[15]), toFloat(f[16]), toFloat(f[17]))
+
+def decodeHDT(talker, f):
+	if len(f) < 2:
+		return None
+	return HDTFix(talker, toFloat(f[1]))
+
+DECODERS = {
+	b'RMC' : decodeRMC,
+	b'GGA' : decodeGGA,
+	b'VTG' : decodeVTG,
+	b'GSA' : decodeGSA,
+	b'HDT' : decodeHDT
+}
+
+HEX = b'0123456789ABCDEFabcdef'
+
+#################   Parser
+
+class NMEAParser(object):
+
+	def __init__(this, decoders = DECODERS):
+		this.buffer = bytearray()
+		this.decoders = decoders
+		this.sentences = 0
+		this.checksumErrors = 0
+		this.decodeErrors = 0
+		this.unsupported = 0
+
+	def feed(this, chunk):
+		"""
+		:param chunk        : bytes read from the GPS, may hold partial or multiple sentences
+		:return list of fix records decoded from every sentence completed by this chunk
+		"""
+		buf = this.buffer
+		buf += chunk
+		records = []
+		start = 0
+		while True:
+			end = buf.find(b'\n', start)
+			if end < 0:
+				break
+			record = this.decode(buf, start, end)
+			if record is not None:
+				records.append(record)
+			start = end + 1
+		if start:
+			del buf[:start]
+		if len(buf) > MAX_SENTENCE_LENGTH:
+			#No line ending in sight, resync on the next sentence start
+			resync = buf.rfind(b'$')
+			del buf[:resync if resync > 0 else len(buf)]
+		return records
+
+	def decode(this, buf, start, end):
+		begin = buf.find(b'$', start, end)
+		if begin < 0:
+			return None
+		star = buf.find(b'*', begin, end)
+		if star < 0 or end - star < 3:
+			this.checksumErrors += 1
+			return None
+		body = bytes(buf[begin + 1:star])
+		expected = buf[star + 1:star + 3]
+		checksum = 0
+		for b in body:
+			checksum ^= b
+		if expected[0] not in HEX or expected[1] not in HEX or checksum != int(expected, 16):
+			this.checksumErrors += 1
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug(f"NMEA checksum mismatch [{bytes(buf[begin:end]).strip()}]")
+			return None
+		this.sentences += 1
+		decoder = this.decoders.get(body[2:5])
+		if decoder is None:
+			this.unsupported += 1
+			return None
+		fields = body.split(b',')
+		try:
+			return decoder(fields[0][:2], fields)
+		except ValueError:
+			this.decodeErrors += 1
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug(f"Invalid NMEA fields [{body}]")
+			return None
+
+def sentence(body):
+	"""Frame an NMEA body (no '$' or checksum) as a complete sentence. Used for simulation and benchmarks."""
+	if isinstance(body, str):
+		body = body.encode("ascii")
+	checksum = 0
+	for b in body:
+		checksum ^= b
+	return b'$' + body + b'*%02X\r\n' % checksum
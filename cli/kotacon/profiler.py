@@ -0,0 +1,146 @@
+"""
+ On demand profiling of the running controller.
+
+ "sample" mode walks every thread's stack from sys._current_frames() at `rateHz` on its own
+ thread, so the RF, status, heading, GPS and timer threads are covered along with the event
+ loop, at a cost of a few hundred microseconds per sample. Stacks are written in folded format
+ ("thread;outer;...;inner count" per line) for flamegraph.pl, speedscope or inferno.
+
+ "cprofile" mode runs cProfile on the event loop thread and writes a .pstats file
+ (snakeviz, flameprof, gprof2dot).
+
+ Start with profile=sample|cprofile [profileSecs=N] [profileHz=N] on the controller command line,
+ or toggle at runtime with SIGUSR2 or by holding STOP on the remote.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import cProfile
+import utils
+
+logger = logging.getLogger(__name__)
+
+MODES = ["sample", "cprofile"]
+
+class StackSampler(utils.WorkerThread):
+	"""Counts folded stacks of every other thread until stopped or `seconds` have passed"""
+	def __init__(this, rateHz, seconds, onDone):
+		utils.WorkerThread.__init__(this, "Profiler_Thread")
+		this.daemon = True
+		this.period = 1.0 / rateHz
+		this.seconds = seconds
+		this.onDone = onDone
+		this.stacks = {}
+		this.samples = 0
+		this.names = {}
+
+	def frameName(frame):
+		code = frame.f_code
+		return f"{code.co_name} ({os.path.basename(code.co_filename)})"
+
+	def sample(this):
+		own = threading.get_ident()
+		for ident, frame in sys._current_frames().items():
+			if ident == own:
+				continue
+			name = this.names.get(ident)
+			if name is None:
+				this.names = {t.ident : t.name for t in threading.enumerate()}
+				name = this.names.get(ident, str(ident))
+			stack = []
+			while frame is not None:
+				stack.append(StackSampler.frameName(frame))
+				frame = frame.f_back
+			stack.append(name)
+			key = ";".join(reversed(stack))
+			this.stacks[key] = this.stacks.get(key, 0) + 1
+		this.samples += 1
+
+	def run(this):
+		endAt = time.monotonic() + this.seconds if this.seconds else None
+		nextAt = time.monotonic()
+		while not this.isStopped():
+			this.sample()
+			now = time.monotonic()
+			if endAt and now >= endAt:
+				break
+			nextAt += this.period
+			if nextAt < now:
+				nextAt = now
+			this.stopFlag.wait(nextAt - now)
+		this.onDone(this)
+
+class Profiler(object):
+	"""
+	One profiling window at a time. `later(delay, callback)` must run callbacks on the event
+	 loop thread; cProfile only sees the thread it was enabled on.
+	"""
+	def __init__(this, outDir, mode = "sample", seconds = 60, rateHz = 100):
+		if mode not in MODES:
+			raise ValueError(f"Unknown profile mode {mode}, expected one of {MODES}")
+		this.outDir = outDir
+		this.mode = mode
+		this.seconds = seconds
+		this.rateHz = rateHz
+		this.sampler = None
+		this.profile = None
+		this.startedAt = None
+		this.lock = threading.Lock()
+
+	def running(this):
+		return this.sampler is not None or this.profile is not None
+
+	def toggle(this, later = None):
+		if this.running():
+			this.stop()
+		else:
+			this.start(later)
+
+	def start(this, later = None):
+		with this.lock:
+			if this.running():
+				return
+			this.startedAt = time.strftime("%Y%m%d-%H%M%S")
+			logger.warning("Profiling (%s) started for %s", this.mode, f"{this.seconds}s" if this.seconds else "until toggled off")
+			if this.mode == "sample":
+				this.sampler = StackSampler(this.rateHz, this.seconds, this.samplerDone)
+				this.sampler.start()
+			else:
+				this.profile = cProfile.Profile()
+				this.profile.enable()
+				if this.seconds and later:
+					profile = this.profile
+					later(this.seconds, lambda: this.stop(profile))
+
+	def stop(this, profile = None):
+		""":param profile: only stop if this cProfile window is still the one running"""
+		if this.sampler:
+			sampler = this.sampler
+			sampler.stop()
+			sampler.join(3)
+		elif this.profile and (profile is None or profile is this.profile):
+			with this.lock:
+				profile, this.profile = this.profile, None
+			profile.disable()
+			this.write(lambda path: profile.dump_stats(path), "pstats")
+
+	def samplerDone(this, sampler):
+		with this.lock:
+			if this.sampler is sampler:
+				this.sampler = None
+		def folded(path):
+			with open(path, "w") as f:
+				for stack, count in sorted(sampler.stacks.items()):
+					f.write(f"{stack} {count}\n")
+		this.write(folded, "folded", f"{sampler.samples} samples")
+
+	def write(this, writer, ext, detail = ""):
+		path = os.path.join(this.outDir, f"profile-{this.startedAt}.{ext}")
+		try:
+			writer(path)
+			logger.warning("Profiling stopped, wrote %s%s", path, f" ({detail})" if detail else "")
+		except OSError as e:
+			logger.warning("Unable to write profile %s: %s", path, e)
+		return path
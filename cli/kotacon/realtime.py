@@ -0,0 +1,163 @@
+"""
+ Opt-in real-time mode. On a busy Pi, gpsd, journald and SD card flushes preempt the control
+ loop and the RF receiver, which shows up as late ticks, late turn stops and skewed button
+ timing. Enable it with realtime=1 on the controller command line (see kotacon.service):
+	rtControlCpus=3      : cores for the event loop thread and the turn timer
+	rtRxCpus=2           : cores for the RF receiver threads
+	rtPriority=50        : SCHED_FIFO priority of the control threads
+	rtRxPriority=60      : SCHED_FIFO priority of the RF threads
+	rtLockMemory=0|1     : mlockall current and future pages so a tick never waits on a page fault
+	rtGC=idle|off|auto   : idle turns automatic collection off and collects between ticks,
+	                       off never collects, auto leaves the collector alone
+ Every step is best effort. One that is not permitted (no CAP_SYS_NICE or CAP_IPC_LOCK, a core
+ that does not exist) is logged and skipped and the controller runs without it.
+
+ Threads created by a real-time thread inherit its cores and priority, so apply the mode once
+ the long lived threads are running.
+"""
+import os
+import gc
+import ctypes
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+GC_MODES = ["idle", "off", "auto"]
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+def parseCpus(spec):
+	"""Core list like "2,3" or "0-1,3" as a set of ints"""
+	cpus = set()
+	for part in str(spec).split(","):
+		part = part.strip()
+		if not part:
+			continue
+		if "-" in part:
+			first, last = part.split("-")
+			cpus.update(range(int(first), int(last) + 1))
+		else:
+			cpus.add(int(part))
+	return cpus
+
+def nativeId(thread = None):
+	""":return the kernel thread id of thread (the calling thread when None), None if it has none yet"""
+	if thread is None:
+		return threading.get_native_id()
+	return getattr(thread, "native_id", None)
+
+def pin(tid, cpus):
+	os.sched_setaffinity(tid, cpus)
+
+def fifo(tid, priority):
+	if not hasattr(os, "SCHED_FIFO"):
+		raise OSError("SCHED_FIFO is not supported on this platform")
+	os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(priority))
+
+def libc():
+	return ctypes.CDLL(None, use_errno = True)
+
+def lockMemory():
+	if libc().mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+
+def unlockMemory():
+	libc().munlockall()
+
+class RealtimeMode(object):
+	"""
+	Settings for the real-time mode. `start` applies the process wide parts (memory lock and
+	 collector) and `thread` pins and prioritizes one thread. Call `idle` from the control loop
+	 once a tick has finished, it runs the collections rtGC=idle moved out of the tick.
+	"""
+	def __init__(this, controlCpus = (3,), rxCpus = (2,), priority = 50, rxPriority = 60, memoryLock = True,
+				gcMode = "idle", gcFullSecs = 60):
+		if gcMode not in GC_MODES:
+			raise ValueError(f"Unknown rtGC={gcMode}, choose from {GC_MODES}")
+		this.controlCpus = set(controlCpus)
+		this.rxCpus = set(rxCpus)
+		this.priority = priority
+		this.rxPriority = rxPriority
+		this.memoryLock = memoryLock
+		this.gcMode = gcMode
+		this.gcFullSecs = gcFullSecs
+		this.fullAt = None
+		this.applied = []
+		this.failed = []
+		this.locked = False
+		this.gcWasEnabled = None
+		this.collections = 0
+
+	def attempt(this, what, action, *args):
+		try:
+			action(*args)
+		except (OSError, ValueError) as e:
+			logger.warning("Real-time: %s not applied: %s", what, e)
+			this.failed.append(what)
+			return False
+		this.applied.append(what)
+		return True
+
+	def start(this, controlThreads = (), rxThreads = ()):
+		"""
+		Lock memory, take over the collector, then pin and prioritize each running thread.
+		 None in controlThreads is the calling thread. A target that is not a Python thread but
+		 has an `onThread` hook (rfcontrols.CallbackRFDevice) is set up from that hook, on the
+		 thread that delivers its callbacks.
+		"""
+		if this.memoryLock:
+			this.locked = this.attempt("mlockall", lockMemory)
+		if this.gcMode != "auto":
+			this.gcWasEnabled = gc.isenabled()
+			gc.disable()
+			this.applied.append(f"gc={this.gcMode}")
+		for t in controlThreads:
+			this.thread(t, this.controlCpus, this.priority)
+		for t in rxThreads:
+			if t is None or nativeId(t) is not None:
+				this.thread(t, this.rxCpus, this.rxPriority)
+			elif hasattr(t, "onThread"):
+				name = type(t).__name__
+				t.onThread = lambda: this.thread(None, this.rxCpus, this.rxPriority, f"{name} callbacks")
+				logger.info("Real-time: %s callbacks are set up on their first call", name)
+			else:
+				logger.warning("Real-time: %s not applied: not a thread", t)
+				this.failed.append(type(t).__name__)
+		logger.info("Real-time mode: %s", ", ".join(this.applied) or "nothing applied")
+
+	def thread(this, thread, cpus, priority, name = None):
+		"""Pin thread (the calling thread when None) to cpus and run it at SCHED_FIFO priority"""
+		tid = nativeId(thread)
+		if tid is None:
+			logger.warning("Real-time: %s not applied: it has not started", name or thread)
+			this.failed.append(name or str(thread))
+			return
+		if name is None:
+			name = thread.name if thread is not None else threading.current_thread().name
+		this.attempt(f"{name} on cpus {sorted(cpus)}", pin, tid, cpus)
+		this.attempt(f"{name} SCHED_FIFO {priority}", fifo, tid, priority)
+
+	def idle(this, now):
+		"""Between ticks: collect the youngest generation, and everything every gcFullSecs"""
+		if this.gcMode != "idle":
+			return
+		if this.fullAt is None:
+			this.fullAt = now + this.gcFullSecs
+		if now >= this.fullAt:
+			gc.collect()
+			this.fullAt = now + this.gcFullSecs
+		else:
+			gc.collect(0)
+		this.collections += 1
+
+	def stop(this):
+		"""Undo the process wide parts, threads keep their cores and priority until they exit"""
+		if this.locked:
+			unlockMemory()
+			this.locked = False
+		if this.gcWasEnabled:
+			gc.enable()
+		this.gcWasEnabled = None
@@ -0,0 +1,240 @@
+"""
+ Flight recorder. A fixed rate snapshot of the navigation and control state is packed into a
+ 32 byte record in a preallocated, memory mapped ring file, so hours of a trip survive in a few
+ MB. Records are written in place with struct.pack_into: no per sample allocation, no write
+ syscalls, and the kernel writes the dirty pages back in batches, which keeps SD card wear low.
+
+	python3 recorder.py csv [file] > trip.csv
+	python3 recorder.py gpx [file] > trip.gpx
+"""
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import utils
+import rfcontrols
+import clock as clk
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"KTR1"
+#magic, version, record size, capacity, records written, created
+HEADER = struct.Struct("<4sHHIQd4x")
+COUNT_OFFSET = 12
+COUNT = struct.Struct("<Q")
+"""
+ time             d  time.time()
+ rawHeading       H  centidegrees of the newest magnetometer sample
+ heading          H  centidegrees, filtered
+ turnRate         h  centidegrees/sec
+ headingLock      H  centidegrees, NO_VALUE when not locked
+ latitude         i  1e-7 degrees
+ longitude        i  1e-7 degrees
+ fixAge           H  tenths of a second since the fix, capped
+ turnTimeHeading  h  milliseconds
+ curSpeed         B  speed setting
+ relays           B  relay bitmask, see RELAYS
+ mode             B  MODE_*
+ button           B  (BUTTONS index + 1) << 1 | position of the last button event since the previous record, 0 for none
+"""
+RECORD = struct.Struct("<dHHhHiiHhBBBB")
+NO_VALUE = 0xFFFF
+MAX_FIX_AGE = 0xFFFE
+
+MODE_MANUAL = 0
+MODE_HEADING_LOCK = 1
+MODE_ANCHOR_LOCK = 2
+MODE_CALIBRATING = 3
+MODES = ["manual", "heading", "anchor", "calibrating"]
+
+RELAYS = ["turnMaster", "turnPower", "turnGround", "speedMaster", "speedR1", "speedR2", "speedR3", "speedR4"]
+BUTTONS = [rfcontrols.GO_BTN, rfcontrols.STOP_BTN, rfcontrols.LEFT_BTN, rfcontrols.RIGHT_BTN]
+
+def centi(degrees):
+	return int(round(degrees * 100)) % 36000
+
+class RingFile(object):
+	"""Fixed size ring of RECORDs behind a HEADER, mapped into memory"""
+	def __init__(this, path, capacity = None, writable = True):
+		this.path = path
+		this.writable = writable
+		size = None if capacity is None else HEADER.size + capacity * RECORD.size
+		flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+		this.fd = os.open(path, flags, 0o644)
+		try:
+			existing = os.fstat(this.fd).st_size
+			header = os.pread(this.fd, HEADER.size, 0) if existing >= HEADER.size else None
+			valid = header is not None and header[:4] == MAGIC and HEADER.unpack(header)[2] == RECORD.size
+			if not writable:
+				if not valid:
+					raise ValueError(f"{path} is not a flight recorder file")
+				size = existing
+			elif not valid or existing != size:
+				#New file or a different layout/capacity: start a fresh recording
+				logger.info("Creating %s record flight recorder ring %s (%s KB)", capacity, path, size // 1024)
+				os.ftruncate(this.fd, 0)
+				os.ftruncate(this.fd, size)
+				os.pwrite(this.fd, HEADER.pack(MAGIC, 1, RECORD.size, capacity, 0, time.time()), 0)
+			this.map = mmap.mmap(this.fd, size, access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+		except:
+			os.close(this.fd)
+			raise
+		magic, version, recordSize, this.capacity, this.count, this.created = HEADER.unpack_from(this.map, 0)
+
+	def append(this, *fields):
+		RECORD.pack_into(this.map, HEADER.size + (this.count % this.capacity) * RECORD.size, *fields)
+		this.count += 1
+		COUNT.pack_into(this.map, COUNT_OFFSET, this.count)
+
+	def records(this):
+		"""Yield records oldest first"""
+		count = COUNT.unpack_from(this.map, COUNT_OFFSET)[0]
+		first = max(0, count - this.capacity)
+		for n in range(first, count):
+			yield RECORD.unpack_from(this.map, HEADER.size + (n % this.capacity) * RECORD.size)
+
+	def close(this):
+		if this.writable:
+			this.map.flush()
+		this.map.close()
+		os.close(this.fd)
+
+class Recorder(utils.WorkerThread):
+	"""
+	Snapshots `nav` and `controls` every 1/rateHz seconds. Attributes are read without locks:
+	 each is a single reference, and a record that straddles an update is still a valid sample.
+	 Call `button` from the event loop to stamp a button event into the next record.
+	 Records are stamped with the wall clock; pacing and fix ages use `clock`, which must be the clock `nav` runs on.
+	"""
+	def __init__(this, path, nav, controls, rateHz = 10, hours = 6, clock = None):
+		utils.WorkerThread.__init__(this, "Recorder_Thread")
+		this.clock = clock or clk.get()
+		this.nav = nav
+		this.controls = controls
+		this.period = 1.0 / rateHz
+		this.ring = RingFile(path, int(hours * 3600 * rateHz))
+		this.pendingButton = 0
+		direction = controls.direction
+		speed = controls.speed
+		this.relays = [direction.masterRelay, direction.powerRelay, direction.groundRelay, speed.masterRelay] + speed.resistorRelays
+
+	def button(this, buttonId, position):
+		if buttonId in BUTTONS:
+			this.pendingButton = (BUTTONS.index(buttonId) + 1) << 1 | position
+
+	def snapshot(this, now):
+		nav = this.nav
+		controls = this.controls
+		mode = MODE_MANUAL
+		if nav.calibrating:
+			mode = MODE_CALIBRATING
+		elif nav.anchorLock is not None:
+			mode = MODE_ANCHOR_LOCK
+		elif nav.headingLock is not None:
+			mode = MODE_HEADING_LOCK
+		relays = 0
+		for i, relay in enumerate(this.relays):
+			if relay.value:
+				relays |= 1 << i
+		sampler = nav.headingSampler
+		rawHeading = sampler.rawHeading() if sampler else None
+		position, positionAt = nav.position, nav.positionAt
+		fixAge = MAX_FIX_AGE if not positionAt else min(MAX_FIX_AGE, int((this.clock.now() - positionAt) * 10))
+		button, this.pendingButton = this.pendingButton, 0
+		this.ring.append(now,
+					NO_VALUE if rawHeading is None else centi(rawHeading),
+					centi(nav.heading),
+					max(-32768, min(32767, int(nav.turnRate * 100))),
+					NO_VALUE if nav.headingLock is None else centi(nav.headingLock),
+					int(round(position.latitude * 1e7)),
+					int(round(position.longitude * 1e7)),
+					fixAge,
+					max(-32768, min(32767, int(controls.turnTimeHeading * 1000))),
+					controls.speed.curSpeed,
+					relays,
+					mode,
+					button)
+
+	def run(this):
+		logger.info("Flight Recorder Starting at %s Hz into %s", 1.0 / this.period, this.ring.path)
+		clock = this.clock
+		nextAt = clock.now()
+		while not this.isStopped():
+			try:
+				this.snapshot(time.time())
+			except Exception as e:
+				logger.warning("Flight recorder snapshot failed: %s", e)
+			nextAt += this.period
+			now = clock.now()
+			if nextAt < now:
+				nextAt = now
+			this.stopFlag.wait(nextAt - now)
+		this.ring.close()
+
+#################   Export
+
+CSV_COLUMNS = ["time", "rawHeading", "heading", "turnRate", "headingLock", "latitude", "longitude", "fixAge",
+				"turnTimeHeading", "curSpeed"] + RELAYS + ["mode", "button", "position"]
+
+def decode(record):
+	""":return record as a row of CSV_COLUMNS values, None where a value was not recorded"""
+	t, rawHeading, heading, turnRate, lock, lat, lon, fixAge, tth, speed, relays, mode, button = record
+	row = [
+		f"{t:.2f}",
+		None if rawHeading == NO_VALUE else rawHeading / 100,
+		heading / 100,
+		turnRate / 100,
+		None if lock == NO_VALUE else lock / 100,
+		None if lat == 0 and lon == 0 else lat / 1e7,
+		None if lat == 0 and lon == 0 else lon / 1e7,
+		None if fixAge == MAX_FIX_AGE else fixAge / 10,
+		tth / 1000,
+		speed]
+	row.extend((relays >> i) & 1 for i in range(len(RELAYS)))
+	row.append(MODES[mode] if mode < len(MODES) else mode)
+	if button:
+		row.append(BUTTONS[(button >> 1) - 1])
+		row.append("down" if button & 1 == rfcontrols.BUTTON_DOWN else "up")
+	else:
+		row.extend((None, None))
+	return row
+
+def exportCSV(ring, out):
+	out.write(",".join(CSV_COLUMNS) + "\n")
+	for record in ring.records():
+		out.write(",".join("" if v is None else str(v) for v in decode(record)) + "\n")
+
+def exportGPX(ring, out):
+	"""One track point per change of position"""
+	out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+	out.write('<gpx version="1.1" creator="kotacon" xmlns="http://www.topografix.com/GPX/1/1">\n<trk><name>kotacon</name><trkseg>\n')
+	last = None
+	for record in ring.records():
+		t, lat, lon = record[0], record[5], record[6]
+		if (lat == 0 and lon == 0) or (lat, lon) == last:
+			continue
+		last = (lat, lon)
+		stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + f".{int(t * 100) % 100:02d}Z"
+		out.write(f'<trkpt lat="{lat / 1e7:.7f}" lon="{lon / 1e7:.7f}"><time>{stamp}</time></trkpt>\n')
+	out.write("</trkseg></trk>\n</gpx>\n")
+
+EXPORTERS = {
+	"csv" : exportCSV,
+	"gpx" : exportGPX
+}
+
+def main(argv):
+	if not argv or argv[0] not in EXPORTERS:
+		print("Usage: python3 recorder.py csv|gpx [file]")
+		return
+	import values
+	ring = RingFile(argv[1] if len(argv) > 1 else values.RECORDER_FILE, writable = False)
+	try:
+		EXPORTERS[argv[0]](ring, sys.stdout)
+	finally:
+		ring.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
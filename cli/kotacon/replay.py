@@ -0,0 +1,350 @@
+"""
+ Offline replay of captured trips. A recording's GPS, magnetometer and button streams are fed
+ through the real Navigation, Control and Runtime button handling on a virtual clock, as fast
+ as the CPU allows. The decisions those objects log (locks, corrections, turn starts/stops)
+ are captured as a timestamped trace, alongside tick timing stats.
+
+ A recording is either a flight recorder ring (recorder.bin) or a stem naming any of
+	<stem>.nmea      raw NMEA capture, timed by its RMC/GGA timestamps
+	<stem>.mag       "<secs> <x> <y> <z>" raw magnetometer samples
+	<stem>.buttons   "<secs> <Go|Stop|Left|Right> <down|up>" button events
+ where secs count from the start of the recording.
+
+	python3 replay.py trip [trace=trip.trace]
+	python3 replay.py trip1 trip2 ... [workers=4] [traceDir=traces]
+"""
+import os
+import sys
+import math
+import time
+import heapq
+import itertools
+import logging
+import concurrent.futures
+import utils
+import values
+import hal
+import nmea
+import status
+import controls as ctl
+import autopilot
+import rfcontrols
+import runtime
+import gestures
+import simulator
+import recorder
+import clock as clk
+
+logger = logging.getLogger(__name__)
+
+#Buckets (us) for the wall time of one control tick
+TICK_BUCKETS_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+#Event kinds, in the order events at the same instant are applied
+GPS = 0
+MAG = 1
+BUTTON = 2
+
+#################   Recordings
+
+class Recording(object):
+	"""Time ordered (secs, kind, payload) events plus the wall clock time the recording started"""
+	def __init__(this, name):
+		this.name = name
+		this.events = []
+		this.startedAt = 0
+		this.sampleHz = values.HEADING_SAMPLE_HZ
+
+	def load(path):
+		if path.endswith(".bin"):
+			return Recording.fromRecorder(path)
+		r = Recording(os.path.basename(path))
+		found = False
+		for ext, loader in ((".nmea", r.loadNMEA), (".mag", r.loadMag), (".buttons", r.loadButtons)):
+			if os.path.exists(path + ext):
+				loader(path + ext)
+				found = True
+		if not found:
+			raise FileNotFoundError(f"No {path}.nmea, {path}.mag or {path}.buttons")
+		r.events.sort(key = lambda e: (e[0], e[1]))
+		return r
+
+	def loadNMEA(this, path):
+		parser = nmea.NMEAParser()
+		with open(path, "rb") as f:
+			data = f.read()
+		origin = None
+		last = 0
+		batch = []
+		for fix in parser.feed(data):
+			t = getattr(fix, "time", None)
+			if t is not None:
+				if origin is None:
+					origin = t
+				t -= origin
+				if t < last - 43200:
+					t += 86400 #passed midnight UTC
+				if t != last and batch:
+					this.events.append((last, GPS, batch))
+					batch = []
+				last = t
+			batch.append(fix)
+		if batch:
+			this.events.append((last, GPS, batch))
+		logger.info("%s: %s NMEA sentences, %s checksum errors", path, parser.sentences, parser.checksumErrors)
+
+	def loadMag(this, path):
+		count = 0
+		first = last = 0
+		with open(path) as f:
+			for line in f:
+				parts = line.split("#")[0].split()
+				if len(parts) >= 4:
+					t = float(parts[0])
+					this.events.append((t, MAG, (float(parts[1]), float(parts[2]), float(parts[3]))))
+					if count == 0:
+						first = t
+					last = t
+					count += 1
+		if count > 1 and last > first:
+			this.sampleHz = (count - 1) / (last - first)
+
+	def loadButtons(this, path):
+		with open(path) as f:
+			for line in f:
+				parts = line.split("#")[0].split()
+				if len(parts) >= 3:
+					position = rfcontrols.BUTTON_DOWN if parts[2].lower() == "down" else rfcontrols.BUTTON_UP
+					this.events.append((float(parts[0]), BUTTON, (parts[1], position)))
+
+	def fromRecorder(path):
+		"""Rebuild the streams from flight recorder snapshots: raw heading as a unit field vector"""
+		r = Recording(os.path.basename(path))
+		ring = recorder.RingFile(path, writable = False)
+		try:
+			origin = None
+			lastFix = None
+			times = []
+			for record in ring.records():
+				t, rawHeading, lat, lon, button = record[0], record[1], record[5], record[6], record[12]
+				if origin is None:
+					origin = t
+					r.startedAt = t
+				t -= origin
+				times.append(t)
+				if (lat or lon) and (lat, lon) != lastFix:
+					lastFix = (lat, lon)
+					r.events.append((t, GPS, [nmea.RMCFix(b"GP", None, True, lat / 1e7, lon / 1e7, None, None, None)]))
+				if rawHeading != recorder.NO_VALUE:
+					a = math.radians(rawHeading / 100)
+					r.events.append((t, MAG, (1000 * math.cos(a), 1000 * math.sin(a), 0.0)))
+				if button:
+					r.events.append((t, BUTTON, (recorder.BUTTONS[(button >> 1) - 1], button & 1)))
+		finally:
+			ring.close()
+		if len(times) > 1 and times[-1] > 0:
+			r.sampleHz = (len(times) - 1) / times[-1]
+		r.events.sort(key = lambda e: (e[0], e[1]))
+		return r
+
+#################   Replay
+
+class RecordedMagnetometer(object):
+	"""Stands in for the sensor under replay. It has no data of its own: recorded samples are pushed into the HeadingSampler."""
+	def get_magnet_raw(this):
+		return [None, None, None]
+
+class ReplayBackend(simulator.SimulatorBackend):
+	"""In-memory relays, no sensors: the replay loop pushes samples into Navigation itself"""
+	name = "replay"
+
+	def __init__(this):
+		simulator.SimulatorBackend.__init__(this, None, None)
+
+	def magnetometer(this, rateHz):
+		return RecordedMagnetometer()
+
+class ReplayRuntime(runtime.Runtime):
+	"""Runtime whose delayed calls go through the replay's virtual event queue"""
+	def __init__(this, nav, controls, schedule, **kwargs):
+		this.schedule = schedule
+		runtime.Runtime.__init__(this, nav, controls, **kwargs)
+
+	def later(this, delay, callback):
+		this.schedule(delay, callback)
+
+class TraceHandler(logging.Handler):
+	"""Collects log records from the objects under replay as decision trace lines"""
+	def __init__(this, clock, origin, nav, controls):
+		logging.Handler.__init__(this, logging.INFO)
+		this.clock = clock
+		this.origin = origin
+		this.nav = nav
+		this.controls = controls
+		this.lines = []
+		this.turns = 0
+		this.errors = 0
+
+	def error(this, e):
+		"""An exception escaping the objects under replay is part of the trace, the replay carries on"""
+		this.errors += 1
+		this.lines.append(f"{this.clock.now() - this.origin:9.2f} ERROR     {type(e).__name__}: {e}")
+
+	def emit(this, record):
+		message = record.getMessage()
+		if "Turn Started" in message:
+			this.turns += 1
+		this.lines.append(f"{this.clock.now() - this.origin:9.2f} {record.name:9} hdg={this.nav.heading:6.1f} "
+						f"tth={this.controls.turnTimeHeading:+.2f} {message}")
+
+class Result(object):
+	def __init__(this, name, seconds, wallSecs, events, tickTimes, trace, turns, errors):
+		this.name = name
+		this.errors = errors
+		this.seconds = seconds
+		this.wallSecs = wallSecs
+		this.events = events
+		this.tickTimes = tickTimes
+		this.trace = trace
+		this.decisions = len(trace)
+		this.turns = turns
+
+	def __repr__(this):
+		return (f"{this.name}: {this.seconds:.0f}s replayed in {this.wallSecs:.2f}s ({this.seconds / max(this.wallSecs, 1e-9):,.0f}x), "
+				f"{this.events} events, {this.decisions} decisions, {this.turns} turns, {this.errors} errors, "
+				f"tick p50={this.tickTimes.percentile(50):.0f}us p99={this.tickTimes.percentile(99):.0f}us max={this.tickTimes.max:.0f}us")
+
+def replay(recording, tickSecs = 0.25):
+	"""Run one recording through Navigation/Control/Runtime on a virtual clock"""
+	started = time.perf_counter()
+	origin = recording.startedAt or 1000.0
+	clock = clk.ManualClock(origin)
+	backend = ReplayBackend()
+	previous = hal.get()
+	previousClock = clk.get()
+	hal.install(backend)
+	clk.install(clock)
+	loggers = [ctl.logger, autopilot.logger, runtime.logger, gestures.logger]
+	saved = [(l.level, l.propagate) for l in loggers]
+	pending = []
+	order = itertools.count()
+	try:
+		status_q = status.StatusChannel()
+		timer = simulator.VirtualTimer()
+		controls = ctl.Control(status_q, values.MAX_TURN_TIME_SECS, values.TURN_ACTUATION_DELAY_SECS, timer, clock)
+		controls.direction = ctl.Direction(values.TURN_MASTER_RELAY_PIN, values.TURN_POWER_RELAY_PIN, values.TURN_GROUND_RELAY_PIN)
+		controls.speed = ctl.Speed(status_q, values.SPEED_MASTER_RELAY_PIN, values.SPEED_R1_RELAY_PIN,
+									values.SPEED_R2_RELAY_PIN, values.SPEED_R3_RELAY_PIN, values.SPEED_R4_RELAY_PIN)
+		window = max(1, round(values.HEADING_WINDOW * recording.sampleHz / values.HEADING_SAMPLE_HZ))
+		nav = autopilot.Navigation(status_q, values.TURN_DEBOUNCE_SECS, headingRateHz = recording.sampleHz, headingWindow = window,
+									clock = clock)
+		def schedule(delay, callback):
+			heapq.heappush(pending, (clock.now() + delay, next(order), callback))
+		rt = ReplayRuntime(nav, controls, schedule, tickSecs = tickSecs, clock = clock,
+						calibrateHoldSecs = values.CALIBRATE_HOLD_SECS, calibrationSecs = values.CALIBRATION_SECS)
+		buttons = {}
+		trace = TraceHandler(clock, origin, nav, controls)
+		for l in loggers:
+			l.setLevel(logging.INFO)
+			l.propagate = False
+			l.addHandler(trace)
+		controls.stop()
+
+		sampler = nav.headingSampler
+		tickTimes = utils.Histogram("Tick", TICK_BUCKETS_US, "us")
+		events = recording.events
+		end = origin + (events[-1][0] if events else 0) + tickSecs
+		nextTick = origin
+		i = 0
+		while True:
+			nextEvent = origin + events[i][0] if i < len(events) else None
+			at = nextTick
+			if nextEvent is not None and nextEvent < at:
+				at = nextEvent
+			if timer.deadline is not None and timer.deadline < at:
+				at = timer.deadline
+			if pending and pending[0][0] < at:
+				at = pending[0][0]
+			if at > end:
+				break
+			clock.set(max(clock.now(), at))
+			if timer.deadline is not None and timer.deadline <= clock.now():
+				timer.fire()
+			while pending and pending[0][0] <= clock.now():
+				heapq.heappop(pending)[2]()
+			#Events before the tick at the same instant, as they would have been queued first
+			while i < len(events) and origin + events[i][0] <= clock.now():
+				t, kind, payload = events[i]
+				i += 1
+				try:
+					if kind == MAG:
+						if sampler:
+							sampler.update(payload, clock.now())
+					elif kind == GPS:
+						nav.gpsReader.publish(payload)
+					else:
+						buttonId, position = payload
+						button = buttons.setdefault(buttonId, rfcontrols.RemoteButton(buttonId, 0))
+						rt.handleButton(rfcontrols.ButtonEvent(clock.now(), button, position))
+				except Exception as e:
+					trace.error(e)
+			if nextTick <= clock.now():
+				nextTick += tickSecs
+				tickStarted = time.perf_counter_ns()
+				try:
+					rt.tick()
+				except Exception as e:
+					trace.error(e)
+				tickTimes.record((time.perf_counter_ns() - tickStarted) / 1000)
+		rt.loop.close()
+	finally:
+		for l, (level, propagate) in zip(loggers, saved):
+			l.removeHandler(trace)
+			l.setLevel(level)
+			l.propagate = propagate
+		hal.install(previous)
+		clk.install(previousClock)
+	return Result(recording.name, end - origin, time.perf_counter() - started, len(events), tickTimes, trace.lines, trace.turns, trace.errors)
+
+def replayFile(path, traceDir = None):
+	"""Process pool entry point. Traces are written to traceDir rather than returned."""
+	result = replay(Recording.load(path))
+	if traceDir:
+		with open(os.path.join(traceDir, result.name + ".trace"), "w") as f:
+			f.write("\n".join(result.trace) + "\n")
+		result.trace = result.trace[-1:] if result.trace else []
+	return result
+
+def replayAll(paths, workers = None, traceDir = None):
+	""":return Results in the order of paths, replayed in parallel processes"""
+	if traceDir:
+		os.makedirs(traceDir, exist_ok = True)
+	with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+		return list(pool.map(replayFile, paths, [traceDir] * len(paths)))
+
+def main(argv):
+	paths = [a for a in argv if "=" not in a]
+	if not paths:
+		print("Usage: python3 replay.py recording [recording...] [trace=file] [workers=N] [traceDir=dir]")
+		return
+	if len(paths) == 1:
+		result = replay(Recording.load(paths[0]))
+		tracePath = utils.argValue(argv, "trace")
+		if tracePath:
+			with open(tracePath, "w") as f:
+				f.write("\n".join(result.trace) + "\n")
+		else:
+			print("\n".join(result.trace))
+		print(result)
+		return
+	workers = utils.argValue(argv, "workers")
+	started = time.perf_counter()
+	results = replayAll(paths, int(workers) if workers else None, utils.argValue(argv, "traceDir"))
+	for result in results:
+		print(result)
+	total = sum(r.seconds for r in results)
+	wall = time.perf_counter() - started
+	print(f"{len(results)} recordings, {total / 3600:.1f} hours replayed in {wall:.1f}s ({total / wall:,.0f}x)")
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,9 +1,11 @@
-from rpi_rf import RFDevice
 import time
 import logging
 import threading
+import queue
 import utils
 import status
+import hal
+import clock as clk
 
 logger = logging.getLogger(__name__)
 
@@ -29,27 +31,29 @@ class RemoteButton(object):
 		this.pulseRangeMin = pulseRangeMin
 		this.pulseRangeMax = pulseRangeMax
 
+	def accepts(this, pulse, proto, enforceProtocol):
+		return this.pulseRangeMin <= pulse <= this.pulseRangeMax and (this.protocol == proto or not enforceProtocol)
+
 class RemoteControl(object):
 	def __init__(this, name):
 		this.name = name
 		this.buttons = []
+		this.index = {}
 		this.enforceProtocol = False
 		
 
 	def addButton(this, button):
 		this.buttons.append(button)
+		#First button registered for a code wins, matching the order buttons were added
+		this.index.setdefault(button.code, button)
 
 	def of(this, code, pulse, proto):
-		for b in this.buttons:
-			if b.code == code:
-				if pulse < b.pulseRangeMin or pulse > b.pulseRangeMax:
-					logger.debug(f"Pulse Length {pulse} out of range for {b.id} [{b.pulseRangeMin} - {b.pulseRangeMax}]")		
-				elif b.protocol == proto:
-					return b
-				else:
-					logger.debug(f"Protocol Mismatch ({proto}) for {b.id} [{b.protocol}")
-					if not this.enforceProtocol:
-						return b
+		b = this.index.get(code)
+		if b is None:
+			return None
+		if b.accepts(pulse, proto, this.enforceProtocol):
+			return b
+		logger.debug("Rejected code %s for %s: pulse=%s [%s - %s] protocol=%s [%s]", code, b.id, pulse, b.pulseRangeMin, b.pulseRangeMax, proto, b.protocol)
 		return None
 
 
@@ -77,66 +81,249 @@ class Yosoo4ButtonRemote(RemoteControl):
 		this.addButton(RemoteButton(RIGHT_BTN, 101102))
 
 
-class RxThread(utils.WorkerThread):
+class ButtonEvent(object):
+	"""
+	A button going down or up at `time` on the RxThread clock. receivedNs is the perf_counter_ns
+	 the code that caused it was decoded at, None for events that did not come over RF.
+	"""
+	__slots__ = ('time', 'button', 'position', 'receivedNs')
+
+	def __init__(this, time, button, position, receivedNs = None):
+		this.time = time
+		this.button = button
+		this.position = position
+		this.receivedNs = receivedNs
+
+	def __repr__(this):
+		return f"{this.button.id} {'down' if this.position == BUTTON_DOWN else 'up'} at {this.time:.3f}"
+
+#################   Receivers
+
+class CallbackRFDevice(object):
+	"""
+	rpi_rf decodes codes inside its GPIO edge callback. Hook that callback so every decoded
+	 code is pushed to `onCode` immediately instead of being polled from rx_code_timestamp.
+	 The callback runs on RPi.GPIO's own edge thread, which Python has no handle on: set
+	 `onThread` to have it called once on that thread at the next edge.
+	"""
+	def __init__(this, rxPin, onCode):
+		from rpi_rf import RFDevice
+		this.device = RFDevice(rxPin)
+		this.onCode = onCode
+		this.onThread = None
+		#enable_rx registers device.rx_callback, so wrap it before enabling
+		this.decode = this.device.rx_callback
+		this.device.rx_callback = this.rxCallback
+		this.device.enable_rx()
+
+	def rxCallback(this, gpio):
+		if this.onThread:
+			onThread, this.onThread = this.onThread, None
+			onThread()
+		device = this.device
+		timestamp = device.rx_code_timestamp
+		this.decode(gpio)
+		if device.rx_code_timestamp != timestamp:
+			this.onCode(device.rx_code, device.rx_pulselength, device.rx_proto)
+
+	def waitReady(this, seconds):
+		#enable_rx has run in the constructor, edges are decoded from here on
+		return bool(this.device.rx_enabled)
+
+	def close(this):
+		this.device.disable_rx()
+
+class Protocol(object):
+	__slots__ = ('pulseLength', 'syncHigh', 'syncLow', 'zeroHigh', 'zeroLow', 'oneHigh', 'oneLow')
+
+	def __init__(this, pulseLength, syncHigh, syncLow, zeroHigh, zeroLow, oneHigh, oneLow):
+		this.pulseLength = pulseLength
+		this.syncHigh = syncHigh
+		this.syncLow = syncLow
+		this.zeroHigh = zeroHigh
+		this.zeroLow = zeroLow
+		this.oneHigh = oneHigh
+		this.oneLow = oneLow
+
+#Same waveform table as rpi_rf/rc-switch, index = protocol number
+PROTOCOLS = (None,
+	Protocol(350, 1, 31, 1, 3, 3, 1),
+	Protocol(650, 1, 10, 1, 2, 2, 1),
+	Protocol(100, 30, 71, 4, 11, 9, 6),
+	Protocol(380, 1, 6, 1, 3, 3, 1),
+	Protocol(500, 6, 14, 1, 2, 2, 1),
+	Protocol(200, 1, 10, 1, 5, 1, 1))
+
+class PulseDecoder(object):
+	"""
+	rc-switch style decoder fed with edge timestamps. A gap longer than SYNC_GAP_US ends a
+	 transmission; the same gap repeating twice means a full code sits in the timing buffer.
+	 Timings live in a preallocated list so decoding an edge allocates nothing.
+	"""
+	MAX_CHANGES = 67
+	SYNC_GAP_US = 5000
+
+	def __init__(this, tolerance = 80):
+		this.tolerance = tolerance
+		this.timings = [0] * (this.MAX_CHANGES + 1)
+		this.changeCount = 0
+		this.repeatCount = 0
+		this.lastEdgeUs = 0
+
+	def edge(this, timestampUs):
+		""":return (code, pulseLength, protocol) when this edge completes a code, else None"""
+		duration = timestampUs - this.lastEdgeUs
+		this.lastEdgeUs = timestampUs
+		decoded = None
+		if duration > this.SYNC_GAP_US:
+			if abs(duration - this.timings[0]) < 200:
+				this.repeatCount += 1
+				this.changeCount -= 1
+				if this.repeatCount == 2:
+					for proto in range(1, len(PROTOCOLS)):
+						decoded = this.waveform(proto, this.changeCount)
+						if decoded:
+							break
+					this.repeatCount = 0
+			this.changeCount = 0
+		if this.changeCount >= this.MAX_CHANGES:
+			this.changeCount = 0
+			this.repeatCount = 0
+		this.timings[this.changeCount] = duration
+		this.changeCount += 1
+		return decoded
 
-	def __init__(this, status_q, rxPin, remote, q, waitForButtonUp = 0.35):
+	def waveform(this, proto, changeCount):
+		p = PROTOCOLS[proto]
+		timings = this.timings
+		delay = timings[0] // p.syncLow
+		tolerance = delay * this.tolerance / 100
+		code = 0
+		for i in range(1, changeCount, 2):
+			high = timings[i]
+			low = timings[i + 1]
+			if abs(high - delay * p.zeroHigh) < tolerance and abs(low - delay * p.zeroLow) < tolerance:
+				code <<= 1
+			elif abs(high - delay * p.oneHigh) < tolerance and abs(low - delay * p.oneLow) < tolerance:
+				code = (code << 1) | 1
+			else:
+				return None
+		if changeCount > 6 and code != 0:
+			return (code, delay, proto)
+		return None
+
+class GpiodReceiver(utils.WorkerThread):
+	"""
+	In-house receiver: the kernel timestamps each edge on the RX line and this thread sleeps
+	 in wait_edge_events until edges arrive, then runs them through a PulseDecoder.
+	 Requires the libgpiod v2 python bindings (pip3 install gpiod).
+	"""
+	def __init__(this, rxPin, onCode, chip = "/dev/gpiochip0"):
+		utils.WorkerThread.__init__(this, "RF_Edge_Thread")
+		import gpiod
+		from gpiod.line import Edge
+		this.rxPin = rxPin
+		this.onCode = onCode
+		this.decoder = PulseDecoder()
+		this.listening = threading.Event()
+		this.request = gpiod.request_lines(chip, consumer = "kotacon-rf",
+			config = {rxPin : gpiod.LineSettings(edge_detection = Edge.BOTH)})
+		this.start()
+
+	def waitReady(this, seconds):
+		return this.listening.wait(seconds)
+
+	def run(this):
+		decoder = this.decoder
+		this.listening.set()
+		while not this.isStopped():
+			if not this.request.wait_edge_events(0.5):
+				continue
+			for event in this.request.read_edge_events():
+				decoded = decoder.edge(event.timestamp_ns // 1000)
+				if decoded:
+					this.onCode(*decoded)
+		this.request.release()
+
+	def close(this):
+		utils.stopThread(this)
+
+RECEIVERS = {
+	"rpi_rf" : CallbackRFDevice,
+	"gpiod" : GpiodReceiver
+}
+
+class RxThread(utils.WorkerThread):
+	"""
+	Turns decoded RF codes into button down/up events. Codes are pushed by the receiver as they
+	 are decoded and the thread blocks until the next code or until the held button's release
+	 deadline (last code + waitForButtonUp), so it only wakes when something happens.
+	 Event "time" and the release deadline are on `clock`.
+	"""
+	def __init__(this, status_q, rxPin, remote, q, waitForButtonUp = 0.35, receiver = "rpi_rf", clock = None):
 		utils.WorkerThread.__init__(this, "RF_RX_Thread")
+		this.clock = clock or clk.get()
 		this.status_q = status_q
-		this.rfDevice = RFDevice(rxPin)
-		this.rfDevice.enable_rx()
+		this.codes = queue.SimpleQueue()
+		this.receiver = hal.get().rfReceiver(receiver, rxPin, this.onCode)
 		this.remote = remote
 		this.q = q
 		this.waitForButtonUp = waitForButtonUp
 
-	def buttonChange(this, button, position):
-		msg = {
-			"time" : time.time(),
-			"button" : button,
-			"position" : position
-		}
-		this.q.put(msg)
+	def waitReady(this, seconds):
+		""":return True once the receiver is decoding edges, waiting up to seconds"""
+		return this.receiver.waitReady(seconds)
+
+	def onCode(this, code, pulse, proto):
+		#Called on the receiver's thread, stamped for button to relay latency
+		this.codes.put((code, pulse, proto, time.perf_counter_ns()))
+
+	def stop(this):
+		utils.WorkerThread.stop(this)
+		this.codes.put(None)
+
+	def buttonChange(this, button, position, receivedNs):
+		this.q.put(ButtonEvent(this.clock.now(), button, position, receivedNs))
 
 	def run(this):
 		logger.info(f"Listening for RF transmissions. Button Timeout = {this.waitForButtonUp}")
 		this.status_q.put(status.StatusUpdate.ready())
-		timestamp = None
+		clock = this.clock
 		lastButton = None
-		lastButtonDown = None
-		while True and not this.isStopped():
+		releaseAt = 0
+		while not this.isStopped():
+			timeout = None if lastButton is None else max(0, releaseAt - clock.now())
+			try:
+				received = this.codes.get(timeout = timeout)
+			except queue.Empty:
+				received = None
+			now = clock.now()
 			button = None
-			now = time.time()
-			if this.rfDevice.rx_code_timestamp != timestamp:
-				timestamp = this.rfDevice.rx_code_timestamp
-				code = this.rfDevice.rx_code
-				pulse = this.rfDevice.rx_pulselength
-				proto = this.rfDevice.rx_proto
+			if received:
+				code, pulse, proto, receivedNs = received
 				button = this.remote.of(code, pulse, proto)
-				logger.log(0,f"Received RF[{timestamp}] {code} pulselength={pulse} protocol={proto}")
+				logger.log(0, "Received RF %s pulselength=%s protocol=%s", code, pulse, proto)
+			else:
+				receivedNs = time.perf_counter_ns()
 			if lastButton:
 				if button and button.id != lastButton.id:
-					logger.info(f"Button Up: {lastButton.id} (new button press)")
-					this.buttonChange(lastButton, BUTTON_UP)
+					logger.info("Button Up: %s (new button press)", lastButton.id)
+					this.buttonChange(lastButton, BUTTON_UP, receivedNs)
 					#
-					logger.info(f"Button Down: {button.id}")
-					this.buttonChange(button, BUTTON_DOWN)
+					logger.info("Button Down: %s", button.id)
+					this.buttonChange(button, BUTTON_DOWN, receivedNs)
 					lastButton = button
-					lastButtonDown = now
-				else:
-					if button and button.id == lastButton.id:
-						lastButtonDown = now
-					if (now - lastButtonDown) > this.waitForButtonUp:
-						logger.info(f"Button Up: {lastButton.id}")
-						this.buttonChange(lastButton, BUTTON_UP)
-						lastButton = None
+					releaseAt = now + this.waitForButtonUp
+				elif button:
+					releaseAt = now + this.waitForButtonUp
+				elif now >= releaseAt:
+					logger.info("Button Up: %s", lastButton.id)
+					this.buttonChange(lastButton, BUTTON_UP, receivedNs)
+					lastButton = None
 
 			elif button:
-				logger.info(f"Button Down: {button.id}")
-				this.buttonChange(button, BUTTON_DOWN)
+				logger.info("Button Down: %s", button.id)
+				this.buttonChange(button, BUTTON_DOWN, receivedNs)
 				lastButton = button
-				lastButtonDown = now
-
-			time.sleep(.01)
-
-
-
-
+				releaseAt = now + this.waitForButtonUp
+		this.receiver.close()
@@ -0,0 +1,245 @@
+import asyncio
+import signal
+import time
+import logging
+import controls as ctl
+import rfcontrols
+import metrics
+import gestures
+import clock as clk
+
+logger = logging.getLogger(__name__)
+
+class Runtime(object):
+	"""
+	Event driven core of the controller. Worker threads hand events to the asyncio loop with
+	 call_soon_threadsafe, so a button press is handled the moment it arrives instead of on the
+	 next pass of a polling loop. The navigation tick runs when the GPS reader publishes a fix,
+	 through the same call_soon_threadsafe hand off, and otherwise every tickSecs on a deadline
+	 kept on the loop's monotonic clock, which is the rate the filtered heading is steered on.
+	 The process sleeps in epoll between events.
+
+	 Use `put` as the RxThread queue: it has the same signature as queue.Queue.put and takes
+	 rfcontrols.ButtonEvents.
+
+	 Each stage of the tick and each button event is timed into metrics.registry, which is
+	 served on `metricsSocket` and dumped to the log on SIGUSR1.
+
+	 Button presses act immediately, holds and taps go through a gestures.Recognizer whose
+	 timers run on the loop. bindGestures sets up the default actions, holding:
+		GO    longPressSecs: heading lock, goExtraLongSecs: stop and anchor lock
+		STOP  longPressSecs: release locks and stop, stopExtraLongSecs: reset turn heading,
+		      profileHoldSecs: toggle the profiler
+		LEFT  calibrateHoldSecs: magnetometer calibration
+	 Hold thresholds are measured on `clock` from the time of the button event.
+
+	 With a realtime.RealtimeMode, its `idle` runs after every tick, in the slack before the
+	 next deadline.
+	"""
+	def __init__(this, nav, controls, tickSecs = 0.25, calibrateHoldSecs = 10, calibrationSecs = 60, recorder = None,
+				metricsSocket = None, profiler = None, profileHoldSecs = 20, onReady = None, clock = None,
+				longPressSecs = 2, goExtraLongSecs = 5, stopExtraLongSecs = 10, doubleTapSecs = 0.6, realtime = None):
+		this.clock = clock or clk.get()
+		this.nav = nav
+		this.onReady = onReady
+		this.controls = controls
+		this.recorder = recorder
+		this.profiler = profiler
+		this.profileHoldSecs = profileHoldSecs
+		this.realtime = realtime
+		this.metricsSocket = metricsSocket
+		reg = metrics.registry
+		stageHelp = "Time spent in each stage of the control loop"
+		this.tickStage = reg.histogram("stage_duration", stageHelp, stage = "tick")
+		this.navReadStage = reg.histogram("stage_duration", stageHelp, stage = "nav_read")
+		this.correctionStage = reg.histogram("stage_duration", stageHelp, stage = "coarse_correction")
+		this.checkTurnStage = reg.histogram("stage_duration", stageHelp, stage = "check_turn")
+		this.buttonStage = reg.histogram("stage_duration", stageHelp, stage = "button")
+		this.tickLateness = reg.histogram("tick_lateness", "How late the control tick woke after its deadline")
+		this.buttonToRelay = reg.histogram("button_to_relay", "Time from the RF code being decoded to the relay writes it caused")
+		this.tickSecs = tickSecs
+		this.calibrateHoldSecs = calibrateHoldSecs
+		this.calibrationSecs = calibrationSecs
+		this.longPressSecs = longPressSecs
+		this.goExtraLongSecs = goExtraLongSecs
+		this.stopExtraLongSecs = stopExtraLongSecs
+		this.loop = asyncio.new_event_loop()
+		this.stopped = None
+		this.waiter = None
+		this.gestures = gestures.Recognizer(this.later, doubleTapSecs, this.clock)
+		this.bindGestures()
+
+	def put(this, msg, block = True, timeout = None):
+		this.loop.call_soon_threadsafe(this.handleButton, msg)
+
+	def fixed(this):
+		"""Called on the GPS reader's thread when it has published a fix"""
+		this.loop.call_soon_threadsafe(this.wake, True)
+
+	def wake(this, byFix):
+		waiter = this.waiter
+		if waiter is not None and not waiter.done():
+			waiter.set_result(byFix)
+
+	def later(this, delay, callback):
+		"""Run callback on the loop after delay seconds"""
+		return this.loop.call_later(delay, callback)
+
+	def bindGestures(this):
+		g = this.gestures
+		g.bind(rfcontrols.GO_BTN, gestures.LONG, this.nav.setHeadingLock, this.longPressSecs)
+		g.bind(rfcontrols.GO_BTN, gestures.EXTRA_LONG, this.anchorLock, this.goExtraLongSecs)
+		g.bind(rfcontrols.STOP_BTN, gestures.LONG, this.releaseLocks, this.longPressSecs)
+		g.bind(rfcontrols.STOP_BTN, gestures.EXTRA_LONG, this.controls.resetTurnHeading, this.stopExtraLongSecs)
+		if this.profiler:
+			g.bind(rfcontrols.STOP_BTN, "profile", this.toggleProfiler, this.profileHoldSecs)
+		#Holding LEFT spins the boat, which is what magnetometer calibration needs
+		g.bind(rfcontrols.LEFT_BTN, "calibrate", this.startCalibration, this.calibrateHoldSecs)
+
+	def stop(this):
+		if this.stopped:
+			this.stopped.set()
+
+	def run(this):
+		asyncio.set_event_loop(this.loop)
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			this.loop.add_signal_handler(sig, this.stop)
+		this.loop.add_signal_handler(signal.SIGUSR1, metrics.registry.dump)
+		if this.profiler:
+			this.loop.add_signal_handler(signal.SIGUSR2, this.toggleProfiler)
+		try:
+			this.loop.run_until_complete(this.main())
+		finally:
+			for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2):
+				this.loop.remove_signal_handler(sig)
+			this.loop.close()
+
+	async def main(this):
+		logger.info("Runtime Starting")
+		this.stopped = asyncio.Event()
+		server = None
+		if this.metricsSocket:
+			try:
+				server = await metrics.serve(this.metricsSocket)
+			except OSError as e:
+				logger.warning(f"Metrics endpoint disabled: {e}")
+		ticker = asyncio.ensure_future(this.ticker())
+		gps = this.nav.gpsReader
+		if gps:
+			gps.onFix = this.fixed
+		if this.onReady:
+			this.onReady()
+		await this.stopped.wait()
+		logger.info("Runtime Stopping")
+		if gps:
+			gps.onFix = None
+		ticker.cancel()
+		try:
+			await ticker
+		except asyncio.CancelledError:
+			pass
+		if server:
+			server.close()
+			await server.wait_closed()
+			metrics.removeSocket(this.metricsSocket)
+
+	async def ticker(this):
+		#Deadlines are kept on the loop clock so the tick period does not drift with handler time
+		loop = this.loop
+		deadline = loop.time()
+		byFix = False
+		while True:
+			if byFix:
+				#A fix starts the period over, so it is not followed by a timed tick moments later
+				deadline = loop.time()
+			else:
+				this.tickLateness.record(max(0, int((loop.time() - deadline) * 1e9)))
+			this.tick()
+			deadline += this.tickSecs
+			now = loop.time()
+			if this.realtime:
+				this.realtime.idle(now)
+				now = loop.time()
+			if deadline < now:
+				deadline = now
+			this.waiter = loop.create_future()
+			timer = loop.call_at(deadline, this.wake, False)
+			try:
+				byFix = await this.waiter
+			finally:
+				timer.cancel()
+				this.waiter = None
+
+	def tick(this):
+		started = time.perf_counter_ns()
+		#Read Navigation Data
+		this.nav.read(this.controls)
+		t = this.navReadStage.since(started)
+
+		#Check autopilot needs
+		this.nav.applyCoarseCorrection(this.controls)
+		t = this.correctionStage.since(t)
+
+		#Check that turning is not stuck
+		this.controls.checkTurn()
+		this.checkTurnStage.since(t)
+
+		metrics.registry.sample()
+		this.tickStage.since(started)
+
+	def handleButton(this, m):
+		started = time.perf_counter_ns()
+		logger.debug("Button Event: %s", m)
+		controls = this.controls
+		button = m.button
+		if this.recorder:
+			this.recorder.button(button.id, m.position)
+		#Every handled press and a LEFT/RIGHT release write relays
+		actuated = True
+		if m.position == rfcontrols.BUTTON_DOWN:
+			this.gestures.down(button.id, m.time)
+			if button.id == rfcontrols.GO_BTN:
+				controls.speed.bump()
+			elif button.id == rfcontrols.STOP_BTN:
+				controls.speed.bump(-1)
+			elif button.id == rfcontrols.LEFT_BTN:
+				controls.turnLeft()
+			elif button.id == rfcontrols.RIGHT_BTN:
+				controls.turnRight()
+			else:
+				actuated = False
+				logger.warning(f"Unsupported button {button.id}")
+		else:
+			this.gestures.up(button.id, m.time)
+			if button.id in (rfcontrols.GO_BTN, rfcontrols.STOP_BTN):
+				actuated = False
+			elif button.id == rfcontrols.LEFT_BTN:
+				controls.stopTurn()
+			elif button.id == rfcontrols.RIGHT_BTN:
+				controls.stopTurn()
+			else:
+				actuated = False
+				logger.warning(f"Unsupported button {button.id}")
+		now = this.buttonStage.since(started)
+		if actuated and m.receivedNs is not None:
+			this.buttonToRelay.record(now - m.receivedNs)
+
+	def anchorLock(this):
+		this.controls.stop()
+		this.nav.setAnchorLock()
+
+	def releaseLocks(this):
+		nav = this.nav
+		controls = this.controls
+		nav.setHeadingLock(False)
+		nav.setAnchorLock(False)
+		controls.stop()
+		controls.speed.set(ctl.Speed.MIN)
+
+	def toggleProfiler(this):
+		#Runs on the loop thread, which is the thread cProfile mode profiles
+		this.profiler.toggle(this.loop.call_later)
+
+	def startCalibration(this):
+		if this.nav.startCalibration(this.calibrationSecs):
+			this.later(this.calibrationSecs, this.nav.finishCalibration)
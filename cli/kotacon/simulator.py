@@ -0,0 +1,471 @@
+"""
+ Closed loop boat simulator for measuring the autopilot without going on the water.
+
+ `simulate` drives the real Navigation and Control objects against a BoatModel through
+ in-memory relays and a simulated compass/GPS, on a virtual clock that jumps from event to
+ event, so an hour on the water takes a second or two. `compare` runs each heading control law
+ on the same boats. `monteCarlo` runs the same boat model and either heading control law
+ vectorized with numpy across many seeds and parameter sets.
+
+	python3 simulator.py [seconds] [stepDegrees] [continuous|bucketed]
+	python3 simulator.py compare [runs] [seconds]
+	python3 simulator.py montecarlo [runs] [seconds] [headingControl=continuous|bucketed]
+"""
+import sys
+import math
+import time
+import random
+import logging
+import numpy
+import hal
+import status
+import controls as ctl
+import autopilot
+import values
+import clock as clk
+import utils
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+#A run has settled once the heading stays within tolerance for at least this long before it ends
+SETTLE_HOLD_SECS = 30
+
+#################   Virtual Time
+
+class VirtualTimer(object):
+	"""Replaces Control's TimerThread: the simulation loop fires the armed deadline itself"""
+	def __init__(this):
+		this.deadline = None
+		this.callback = None
+
+	def arm(this, deadline, callback):
+		this.deadline = deadline
+		this.callback = callback
+
+	def cancel(this):
+		this.deadline = None
+		this.callback = None
+
+	def fire(this):
+		deadline, callback = this.deadline, this.callback
+		this.cancel()
+		callback(deadline)
+
+#################   Simulated Devices
+
+class SimRelay(object):
+	"""In-memory gpiozero.OutputDevice/LED that counts its state changes"""
+	def __init__(this, pin, active_high = True, initial_value = False):
+		this.pin = pin
+		this.state = 1 if initial_value else 0
+		this.changes = 0
+
+	@property
+	def value(this):
+		return this.state
+
+	@value.setter
+	def value(this, v):
+		v = 1 if v else 0
+		if v != this.state:
+			this.state = v
+			this.changes += 1
+
+	def on(this):
+		this.value = 1
+
+	def off(this):
+		this.value = 0
+
+class BoatCompass(object):
+	"""Raw magnetometer field for the boat's true heading plus noise"""
+	def __init__(this, boat, rnd, fieldStrength = 1500, noise = 15):
+		this.boat = boat
+		this.random = rnd
+		this.fieldStrength = fieldStrength
+		this.noise = noise
+
+	def get_magnet_raw(this):
+		a = math.radians(this.boat.heading)
+		r = this.random
+		return [this.fieldStrength * math.cos(a) + r.gauss(0, this.noise),
+				this.fieldStrength * math.sin(a) + r.gauss(0, this.noise),
+				-400 + r.gauss(0, this.noise)]
+
+class SilentRemote(object):
+	"""RF receiver with hal.ScriptedRemote's interface that never receives a code"""
+	def __init__(this, onCode):
+		this.onCode = onCode
+
+	def waitReady(this, seconds):
+		return True
+
+	def close(this):
+		pass
+
+class SimulatorBackend(object):
+	name = "simulator"
+
+	def __init__(this, boat, rnd):
+		this.boat = boat
+		this.random = rnd
+		this.relays = []
+
+	def outputDevice(this, pin, **kwargs):
+		relay = SimRelay(pin, **kwargs)
+		this.relays.append(relay)
+		return relay
+
+	def led(this, pin):
+		return this.outputDevice(pin)
+
+	def relayBank(this, name, pins, **kwargs):
+		return hal.DeviceRelayBank(name, {pin : this.outputDevice(pin, **kwargs) for pin in pins})
+
+	def gpsSerial(this, port, baudrate, timeout):
+		return None #fixes are published straight into the GPSReader
+
+	def magnetometer(this, rateHz):
+		return BoatCompass(this.boat, this.random)
+
+	def rfReceiver(this, kind, pin, onCode):
+		return SilentRemote(onCode)
+
+	def close(this):
+		pass
+
+#################   Boat
+
+class BoatModel(object):
+	"""
+	Bow mounted trolling motor steering a small boat.
+	 - The motor head slews at maxMotorAngle/maxTurnTime deg/s while a turn relay is on, so
+	   turnTimeHeading maps linearly onto the motor angle.
+	 - Speed through water approaches maxSpeed * setting/15 with time constant speedTau.
+	 - Yaw rate approaches yawGain * speed * sin(motorAngle) (rad/s) with time constant yawTau,
+	   plus a wandering wind/wave yaw disturbance.
+	 - Position moves with speed along heading plus a constant wind/current drift.
+	"""
+	def __init__(this, rnd, maxTurnTime = values.MAX_TURN_TIME_SECS, maxMotorAngle = 90.0, maxSpeed = 1.5,
+				speedTau = 3.0, yawGain = 0.4, yawTau = 1.0, yawNoise = 0.5, drift = (0.1, 0.05)):
+		this.random = rnd
+		this.motorSlew = maxMotorAngle / maxTurnTime
+		this.maxMotorAngle = maxMotorAngle
+		this.maxSpeed = maxSpeed
+		this.speedTau = speedTau
+		this.yawGain = yawGain
+		this.yawTau = yawTau
+		this.yawNoise = yawNoise
+		this.drift = drift
+		this.heading = 0.0
+		this.motorAngle = 0.0
+		this.speed = 0.0
+		this.yawRate = 0.0
+		this.disturbance = 0.0
+		this.east = 0.0
+		this.north = 0.0
+
+	def step(this, dt, turnDirection, speedSetting):
+		this.motorAngle = max(-this.maxMotorAngle, min(this.maxMotorAngle, this.motorAngle + turnDirection * this.motorSlew * dt))
+		target = this.maxSpeed * speedSetting / ctl.Speed.MAX
+		this.speed += (target - this.speed) * min(1.0, dt / this.speedTau)
+		#Disturbance is a mean reverting random walk in deg/s
+		this.disturbance += -this.disturbance * dt / 10 + this.random.gauss(0, this.yawNoise) * math.sqrt(dt)
+		yaw = math.degrees(this.yawGain * this.speed * math.sin(math.radians(this.motorAngle))) + this.disturbance
+		this.yawRate += (yaw - this.yawRate) * min(1.0, dt / this.yawTau)
+		this.heading = (this.heading + this.yawRate * dt) % 360
+		h = math.radians(this.heading)
+		this.east += (this.speed * math.sin(h) + this.drift[0]) * dt
+		this.north += (this.speed * math.cos(h) + this.drift[1]) * dt
+
+def wrap(angle):
+	return (angle + 180) % 360 - 180
+
+class Result(object):
+	def __init__(this, seconds, errors, tolerance, relayChanges, wallSecs, drift):
+		this.seconds = seconds
+		this.drift = drift
+		this.wallSecs = wallSecs
+		this.relayChanges = relayChanges
+		this.errors = errors
+		this.settlingTime = settlingTime(errors, tolerance, seconds)
+		this.reachTime = next((t for t, e in errors if abs(e) <= tolerance), None)
+		tail = [abs(e) for t, e in errors if t >= seconds * 0.75]
+		this.steadyStateError = sum(tail) / len(tail) if tail else None
+		this.actuationsPerMinute = relayChanges / (seconds / 60)
+
+	def __repr__(this):
+		settle = "not settled" if this.settlingTime is None else f"{this.settlingTime:.1f}s"
+		reach = "never" if this.reachTime is None else f"{this.reachTime:.1f}s"
+		return (f"reached={reach} settling={settle} steadyStateError={this.steadyStateError:.2f}deg "
+				f"relayActuations={this.actuationsPerMinute:.1f}/min drift={this.drift:.0f}m speedup={this.seconds / this.wallSecs:,.0f}x")
+
+def settlingTime(errors, tolerance, seconds, holdSecs = SETTLE_HOLD_SECS):
+	"""
+	:return time after which |error| stays within tolerance, None if it never settles or only
+	 entered the band in the last holdSecs of the run
+	"""
+	settledAt = None
+	for t, e in errors:
+		if abs(e) > tolerance:
+			settledAt = None
+		elif settledAt is None:
+			settledAt = t
+	if settledAt is not None and settledAt > seconds - holdSecs:
+		return None
+	return settledAt
+
+#################   Closed Loop
+
+def simulate(seconds = 300, stepDegrees = 45, seed = 0, speedSetting = 8, tickSecs = 0.25, sensorHz = 20,
+			physicsDt = 0.05, gpsSecs = 1.0, tolerance = 5.0, boat = None, configure = None, headingControl = "continuous"):
+	"""
+	Lock heading, then offset the lock by stepDegrees and let the autopilot recover.
+	 `configure(nav, controls)` can adjust the objects under test before the run starts.
+	 Samples go into the real HeadingSampler ring at sensorHz; the filter only runs before each
+	 control tick since nothing else reads the published heading.
+	"""
+	rnd = random.Random(seed)
+	boat = boat or BoatModel(rnd)
+	backend = SimulatorBackend(boat, rnd)
+	clock = clk.ManualClock()
+	previous = hal.get()
+	previousClock = clk.get()
+	hal.install(backend)
+	clk.install(clock)
+	started = time.perf_counter()
+	try:
+		status_q = status.StatusChannel()
+		timer = VirtualTimer()
+		controls = ctl.Control(status_q, values.MAX_TURN_TIME_SECS, values.TURN_ACTUATION_DELAY_SECS, timer, clock)
+		controls.direction = ctl.Direction(values.TURN_MASTER_RELAY_PIN, values.TURN_POWER_RELAY_PIN, values.TURN_GROUND_RELAY_PIN)
+		controls.speed = ctl.Speed(status_q, values.SPEED_MASTER_RELAY_PIN, values.SPEED_R1_RELAY_PIN,
+									values.SPEED_R2_RELAY_PIN, values.SPEED_R3_RELAY_PIN, values.SPEED_R4_RELAY_PIN)
+		nav = autopilot.Navigation(status_q, values.TURN_DEBOUNCE_SECS, headingRateHz = sensorHz, headingWindow = max(1, sensorHz // 4),
+									headingControl = headingControl, clock = clock)
+		if configure:
+			configure(nav, controls)
+		compass = nav.headingSensor
+		sampler = nav.headingSampler
+		direction = controls.direction
+		speed = controls.speed
+		lat0, lon0 = 44.9778, -93.2650
+		lonScale = METERS_PER_DEGREE * math.cos(math.radians(lat0))
+
+		controls.speed.set(speedSetting, turnOn = True)
+		for i in range(sampler.raw.shape[0]):
+			sampler.update(compass.get_magnet_raw(), clock.now())
+		nav.read()
+		nav.setHeadingLock()
+		nav.headingLock = (nav.headingLock + stepDegrees) % 360
+		lock = nav.headingLock
+		initialChanges = sum(r.changes for r in backend.relays)
+
+		origin = clock.now()
+		startEast, startNorth = boat.east, boat.north
+		end = origin + seconds
+		nextSensor = origin
+		nextTick = origin
+		nextGps = origin
+		errors = []
+		while clock.now() < end:
+			nextEvent = min(nextSensor, nextTick, nextGps, clock.now() + physicsDt)
+			if timer.deadline is not None and timer.deadline < nextEvent:
+				nextEvent = timer.deadline
+			#Relay state is constant between events, so integrate the boat up to the next one
+			dt = nextEvent - clock.now()
+			if dt > 0:
+				turn = 0
+				if direction.masterRelay.value:
+					turn = 1 if direction.powerRelay.value else -1
+				boat.step(dt, turn, speed.curSpeed if speed.masterRelay.value else 0)
+				clock.set(nextEvent)
+			if timer.deadline is not None and timer.deadline <= clock.now():
+				timer.fire()
+			if nextSensor <= clock.now():
+				sampler.add(compass.get_magnet_raw(), clock.now())
+				nextSensor += 1.0 / sensorHz
+			if nextGps <= clock.now():
+				nav.gpsReader.record(lat0 + boat.north / METERS_PER_DEGREE, lon0 + boat.east / lonScale, 0)
+				nextGps += gpsSecs
+			if nextTick <= clock.now():
+				heading, rate = sampler.filter()
+				sampler.latest = (heading, rate, clock.now())
+				nav.read(controls)
+				nav.applyCoarseCorrection(controls)
+				controls.checkTurn()
+				errors.append((clock.now() - origin, wrap(lock - boat.heading)))
+				nextTick += tickSecs
+		relayChanges = sum(r.changes for r in backend.relays) - initialChanges
+		drift = math.hypot(boat.east - startEast, boat.north - startNorth)
+	finally:
+		hal.install(previous)
+		clk.install(previousClock)
+	return Result(seconds, errors, tolerance, relayChanges, time.perf_counter() - started, drift)
+
+#################   Vectorized Monte Carlo
+
+def monteCarlo(runs = 1000, seconds = 300, seed = 0, tickSecs = 0.25, dt = 0.05, tolerance = 5.0,
+			maxTurnTime = values.MAX_TURN_TIME_SECS, debounceSecs = values.TURN_DEBOUNCE_SECS, headingControl = values.HEADING_CONTROL):
+	"""
+	Every run is a column in numpy arrays: the BoatModel dynamics and the heading control law
+	 selected by headingControl (Navigation.steer with a HeadingController's gains, or the
+	 bucketed correction of applyBucketedCorrection) driving Control are re-expressed as array
+	 operations and advanced together. The continuous law is fed the boat's true yaw rate where
+	 the controller uses the estimator's. Each run draws its own step size, speed setting, yaw
+	 gain, disturbance level and seed.
+	:return dict of per-run arrays: settlingTime (nan = not settled), steadyStateError, actuationsPerMinute
+	"""
+	if headingControl not in autopilot.HEADING_CONTROLS:
+		raise ValueError(f"Unknown heading control {headingControl}, expected one of {autopilot.HEADING_CONTROLS}")
+	rng = numpy.random.default_rng(seed)
+	n = runs
+	step = rng.uniform(10, 120, n) * rng.choice([-1, 1], n)
+	speedSetting = rng.integers(4, ctl.Speed.MAX + 1, n)
+	yawGain = rng.uniform(0.25, 0.6, n)
+	yawNoise = rng.uniform(0.1, 1.0, n)
+	maxMotorAngle = 90.0
+	maxSpeed = 1.5
+
+	heading = numpy.zeros(n)
+	lock = numpy.mod(step, 360)
+	turnTime = numpy.zeros(n)			#Control.turnTimeHeading
+	turnDir = numpy.zeros(n)			#-1 left, 0 stopped, 1 right
+	turnEnd = numpy.zeros(n)
+	lastTurnSentAt = numpy.full(n, -1e9)
+	speed = numpy.zeros(n)
+	yawRate = numpy.zeros(n)
+	disturbance = numpy.zeros(n)
+	actuations = numpy.zeros(n)
+	settledAt = numpy.full(n, numpy.nan)
+	tailError = numpy.zeros(n)
+	tailCount = 0
+
+	targetSpeed = maxSpeed * speedSetting / ctl.Speed.MAX
+	speedFactor = speedSetting / ctl.Speed.MAX
+	debounce = debounceSecs / speedFactor
+	buckets = numpy.array([90, 45, 22.5, 11.25, 5.75])
+	fractions = numpy.array([1, .75, .5, .25, .125])
+	law = autopilot.HeadingController()
+	gain = numpy.minimum(law.maxGain, 0.5 / speedFactor)
+	integral = numpy.zeros(n)
+	ticksPerControl = max(1, int(round(tickSecs / dt)))
+	steps = int(seconds / dt)
+	for k in range(steps):
+		now = k * dt
+		if k % ticksPerControl == 0:
+			#Coarse correction as applied by Navigation: the wrapped lock - heading
+			cc = autopilot.wrapAngle(lock - heading)
+			if headingControl == "continuous":
+				#HeadingController.update: the motor target from error and rate, integrating only while
+				# the target is free to move the way the error asks (anti-windup)
+				unclamped = gain * (law.kp * cc - law.kd * yawRate) + law.ki * integral
+				target = numpy.clip(unclamped, -maxTurnTime, maxTurnTime)
+				free = (target == unclamped) | ((unclamped > maxTurnTime) != (cc > 0))
+				if k:
+					integral = numpy.where(free, numpy.clip(integral + cc * tickSecs, -law.integralLimit, law.integralLimit), integral)
+				move = (turnDir == 0) & (numpy.abs(target - turnTime) >= law.deadband)
+				left = move & (target < turnTime)
+				right = move & (target > turnTime)
+				runFor = numpy.abs(target - turnTime)
+			else:
+				mag = numpy.abs(cc)
+				tsecs = numpy.zeros(n)
+				for b, f in zip(buckets[::-1], fractions[::-1]):
+					tsecs = numpy.where(mag > b, maxTurnTime * f, tsecs)
+				start = (tsecs > 0) & (now - lastTurnSentAt >= debounce) & (turnDir == 0)
+				left = start & (cc < 0)
+				right = start & (cc > 0)
+				roomLeft = turnTime + maxTurnTime
+				roomRight = maxTurnTime - turnTime
+				left &= roomLeft > 0
+				right &= roomRight > 0
+				runFor = numpy.where(left, numpy.minimum(tsecs, roomLeft), numpy.minimum(tsecs, roomRight))
+				lastTurnSentAt = numpy.where(left | right, now + tsecs, lastTurnSentAt)
+			turnDir = numpy.where(left, -1, numpy.where(right, 1, turnDir))
+			turnEnd = numpy.where(left | right, now + runFor, turnEnd)
+			#Each automated turn is 3 turn relays on and off again
+			actuations += numpy.where(left | right, 6, 0)
+			err = numpy.abs((lock - heading + 180) % 360 - 180)
+			outside = err > tolerance
+			settledAt = numpy.where(outside, numpy.nan, numpy.where(numpy.isnan(settledAt), now, settledAt))
+			if now >= seconds * 0.75:
+				tailError += err
+				tailCount += 1
+
+		#Stop turns whose time is up, then integrate the boat
+		done = (turnDir != 0) & (now >= turnEnd)
+		turnDir = numpy.where(done, 0, turnDir)
+		turnTime = numpy.clip(turnTime + turnDir * dt, -maxTurnTime, maxTurnTime)
+		motorAngle = numpy.radians(turnTime / maxTurnTime * maxMotorAngle)
+		speed += (targetSpeed - speed) * (dt / 3.0)
+		disturbance += -disturbance * dt / 10 + rng.normal(0, 1, n) * yawNoise * math.sqrt(dt)
+		yaw = numpy.degrees(yawGain * speed * numpy.sin(motorAngle)) + disturbance
+		yawRate += (yaw - yawRate) * dt
+		heading = numpy.mod(heading + yawRate * dt, 360)
+
+	settledAt = numpy.where(settledAt > seconds - SETTLE_HOLD_SECS, numpy.nan, settledAt)
+	return {
+		"settlingTime" : settledAt,
+		"steadyStateError" : tailError / max(1, tailCount),
+		"actuationsPerMinute" : actuations / (seconds / 60)
+	}
+
+def compare(runs = 20, seconds = 300, seed = 0):
+	"""
+	Every heading control law against the same boats: each run draws a step, speed setting and
+	 seed and simulates it once per law.
+	:return dict of law -> dict of per-run arrays like monteCarlo
+	"""
+	rnd = random.Random(seed)
+	cases = [(rnd.uniform(10, 120) * rnd.choice([-1, 1]), rnd.randint(4, ctl.Speed.MAX), rnd.randrange(1 << 30)) for i in range(runs)]
+	results = {}
+	for law in autopilot.HEADING_CONTROLS:
+		rs = [simulate(seconds, step, caseSeed, speed, headingControl = law) for step, speed, caseSeed in cases]
+		results[law] = {
+			"reachTime" : numpy.array([numpy.nan if r.reachTime is None else r.reachTime for r in rs]),
+			"settlingTime" : numpy.array([numpy.nan if r.settlingTime is None else r.settlingTime for r in rs]),
+			"steadyStateError" : numpy.array([r.steadyStateError for r in rs]),
+			"actuationsPerMinute" : numpy.array([r.actuationsPerMinute for r in rs])
+		}
+	return results
+
+def summarize(name, values):
+	finite = values[numpy.isfinite(values)]
+	if len(finite) == 0:
+		return f"{name}: none"
+	p = numpy.percentile(finite, [50, 90, 99])
+	return f"{name}: p50={p[0]:.2f} p90={p[1]:.2f} p99={p[2]:.2f} ({len(finite)}/{len(values)} runs)"
+
+def main(argv):
+	if argv and argv[0] == "montecarlo":
+		#montecarlo [runs] [seconds] [headingControl=continuous|bucketed]
+		law = utils.argValue(argv, "headingControl", values.HEADING_CONTROL)
+		argv = [a for a in argv if "=" not in a]
+		runs = int(argv[1]) if len(argv) > 1 else 1000
+		seconds = float(argv[2]) if len(argv) > 2 else 300
+		started = time.perf_counter()
+		r = monteCarlo(runs, seconds, headingControl = law)
+		wall = time.perf_counter() - started
+		print(f"Monte Carlo ({law}): {runs} runs x {seconds:.0f}s in {wall:.1f}s ({runs * seconds / wall:,.0f}x real time)")
+		print("  " + summarize("settling time (s)", r["settlingTime"]))
+		print("  " + summarize("steady state error (deg)", r["steadyStateError"]))
+		print("  " + summarize("relay actuations/min", r["actuationsPerMinute"]))
+	elif argv and argv[0] == "compare":
+		runs = int(argv[1]) if len(argv) > 1 else 20
+		seconds = float(argv[2]) if len(argv) > 2 else 300
+		for law, r in compare(runs, seconds).items():
+			print(f"{law}: {runs} runs x {seconds:.0f}s")
+			print("  " + summarize("time to reach tolerance (s)", r["reachTime"]))
+			print("  " + summarize("settling time (s)", r["settlingTime"]))
+			print("  " + summarize("steady state error (deg)", r["steadyStateError"]))
+			print("  " + summarize("relay actuations/min", r["actuationsPerMinute"]))
+	else:
+		seconds = float(argv[0]) if argv else 300
+		stepDegrees = float(argv[1]) if len(argv) > 1 else 45
+		law = argv[2] if len(argv) > 2 else "continuous"
+		print(f"Heading lock step of {stepDegrees} deg over {seconds:.0f}s ({law}): {simulate(seconds, stepDegrees, headingControl = law)}")
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,8 +1,9 @@
-import time
 import logging
+import threading
 import utils
-import gpiozero
+import hal
 import queue
+import clock as clk
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +13,7 @@ MODE_STARTUP = 1
 MODE_READY = 2
 MODE_HEADING_LOCK = 10
 MODE_ANCHOR_LOCK = 11
+MODE_CALIBRATING = 12
 
 TURNING = 101
 NOT_TURNING =102
@@ -23,101 +25,257 @@ MOTOR_OFF = 200
 
 
 class StatusUpdate(object):
+	"""
+	Status events are interned: the factories hand out shared instances, so posting a status
+	 change allocates nothing. Never modify an update, use `of` for other combinations.
+	"""
+	__slots__ = ('mode', 'turn', 'motor')
+	interned = {}
+
 	def __init__(this, mode, turn = None, motor = None):
 		this.mode = mode
 		this.turn = turn
 		this.motor = motor
 
+	def of(mode, turn = None, motor = None):
+		""":return the interned update for these fields"""
+		key = (mode, turn, motor)
+		u = StatusUpdate.interned.get(key)
+		if u is None:
+			u = StatusUpdate.interned[key] = StatusUpdate(mode, turn, motor)
+		return u
+
 	#Modes
 	def ready():
-		return StatusUpdate(MODE_READY)
+		return UPDATE_READY
 
 	def headingLock(failed = False):
-		return StatusUpdate(MODE_HEADING_LOCK)
+		return UPDATE_HEADING_LOCK
 
 	def anchorLock(failed = False):
-		return StatusUpdate(MODE_ANCHOR_LOCK)
+		return UPDATE_ANCHOR_LOCK
 
 	def error():
-		return StatusUpdate(MODE_ERROR)
+		return UPDATE_ERROR
+
+	def calibrating():
+		return UPDATE_CALIBRATING
 
 	#Turn Status
 
 	def turningStarted():
-		return StatusUpdate(None, turn = TURNING)
+		return UPDATE_TURNING_STARTED
 
 	def turningStopped():
-		return StatusUpdate(None, turn = NOT_TURNING)
+		return UPDATE_TURNING_STOPPED
 
 	def turningMaxed():
-		return StatusUpdate(None, turn = MAX_TURN_REACHED)
+		return UPDATE_TURNING_MAXED
 
 	def turningReset():
-		return StatusUpdate(None, turn = TURNING_RESET)
+		return UPDATE_TURNING_RESET
 
 	#Motor Speed Status
 
 	def speed(setting, motorOn):
-		return StatusUpdate(None, motor = MOTOR_OFF + (setting if motorOn else 0))
+		return StatusUpdate.of(None, motor = MOTOR_OFF + (setting if motorOn else 0))
 
 	def __repr__(this):
 		return f"mode={this.mode}, turn={this.turn}, motor={this.motor}"
 
+UPDATE_NONE = StatusUpdate.of(None)
+UPDATE_READY = StatusUpdate.of(MODE_READY)
+UPDATE_HEADING_LOCK = StatusUpdate.of(MODE_HEADING_LOCK)
+UPDATE_ANCHOR_LOCK = StatusUpdate.of(MODE_ANCHOR_LOCK)
+UPDATE_ERROR = StatusUpdate.of(MODE_ERROR)
+UPDATE_CALIBRATING = StatusUpdate.of(MODE_CALIBRATING)
+UPDATE_TURNING_STARTED = StatusUpdate.of(None, turn = TURNING)
+UPDATE_TURNING_STOPPED = StatusUpdate.of(None, turn = NOT_TURNING)
+UPDATE_TURNING_MAXED = StatusUpdate.of(None, turn = MAX_TURN_REACHED)
+UPDATE_TURNING_RESET = StatusUpdate.of(None, turn = TURNING_RESET)
+
+class StatusChannel(object):
+	"""
+	Bounded, latest-value-wins replacement for a status queue.Queue. Updates only carry the
+	 fields that changed, so the channel holds at most one pending mode, turn and motor value and
+	 a burst of updates (e.g. Speed.bump) collapses into the newest state of each field.
+	 put/get mirror queue.Queue, get raises queue.Empty on timeout.
+	"""
+	def __init__(this):
+		this.cond = threading.Condition()
+		this.mode = None
+		this.turn = None
+		this.motor = None
+		this.pending = False
+		this.coalesced = 0
+
+	def put(this, u, block = True, timeout = None):
+		with this.cond:
+			if u.mode is not None:
+				if this.mode is not None:
+					this.coalesced += 1
+				this.mode = u.mode
+			if u.turn is not None:
+				if this.turn is not None:
+					this.coalesced += 1
+				this.turn = u.turn
+			if u.motor is not None:
+				if this.motor is not None:
+					this.coalesced += 1
+				this.motor = u.motor
+			this.pending = True
+			this.cond.notify()
+
+	def get(this, block = True, timeout = None):
+		with this.cond:
+			if not this.pending and block:
+				this.cond.wait(timeout)
+			if not this.pending:
+				raise queue.Empty
+			u = StatusUpdate.of(this.mode, this.turn, this.motor)
+			this.mode = None
+			this.turn = None
+			this.motor = None
+			this.pending = False
+			return u
+
+	def qsize(this):
+		return 1 if this.pending else 0
+
+class LedScheduler(object):
+	"""
+	Computes every status LED's state from its pattern and the current time, so one timer
+	 (the StatusThread's wait) drives all LEDs instead of a gpiozero blink thread per LED.
+	 Only LEDs whose state differs from what was last written touch the GPIO.
+	"""
+	EPSILON = 0.001
+
+	def __init__(this, leds):
+		this.leds = leds
+		this.patterns = [False] * len(leds)
+		this.startedAt = [0] * len(leds)
+		this.written = [None] * len(leds)
+		this.writes = 0
+
+	def set(this, i, pattern, now):
+		"""pattern is True/False for steady on/off or an (onTime, offTime, n) blink tuple"""
+		if pattern != this.patterns[i]:
+			this.patterns[i] = pattern
+			this.startedAt[i] = now
+
+	def on(this, i, now):
+		this.set(i, True, now)
+
+	def off(this, i, now):
+		this.set(i, False, now)
+
+	def blink(this, i, now, on_time = 1, off_time = 1, n = None):
+		this.set(i, (on_time, off_time, n), now)
+
+	def state(this, i, now):
+		""":return (on, time of next change or None)"""
+		pattern = this.patterns[i]
+		if pattern is True or pattern is False:
+			return pattern, None
+		onTime, offTime, n = pattern
+		period = onTime + offTime
+		elapsed = now - this.startedAt[i] + this.EPSILON
+		cycle = int(elapsed // period)
+		if n and cycle >= n:
+			return False, None
+		phase = elapsed - cycle * period
+		if phase < onTime:
+			return True, now + onTime - phase
+		return False, now + period - phase
+
+	def update(this, now):
+		""":return time the next LED changes state, None if all are steady"""
+		nextChange = None
+		for i, led in enumerate(this.leds):
+			value, changeAt = this.state(i, now)
+			if value != this.written[i]:
+				if value:
+					led.on()
+				else:
+					led.off()
+				this.written[i] = value
+				this.writes += 1
+			if changeAt is not None and (nextChange is None or changeAt < nextChange):
+				nextChange = changeAt
+		return nextChange
+
 class StatusThread(utils.WorkerThread):
+	"""Drives the status LEDs from the updates on `q`, timing blink patterns on `clock`"""
 	BUTTON_DOWN = 1
 	BUTTON_UP = 0
 
-	def __init__(this, q, pin1, pin2, pin3):
+	MODE_LED = 0
+	TURN_LED = 1
+	MOTOR_LED = 2
+
+	def __init__(this, q, pin1, pin2, pin3, clock = None):
 		utils.WorkerThread.__init__(this, "Status_Thread")
+		this.clock = clock or clk.get()
 		this.q = q
-		this.modeLed = gpiozero.LED(pin1)
-		this.turnLed = gpiozero.LED(pin2)
-		this.motorLed = gpiozero.LED(pin3)
+		this.modeLed = hal.get().led(pin1)
+		this.turnLed = hal.get().led(pin2)
+		this.motorLed = hal.get().led(pin3)
+		this.leds = LedScheduler([this.modeLed, this.turnLed, this.motorLed])
+
+	def stop(this):
+		utils.WorkerThread.stop(this)
+		#Wake the blocking get so the thread notices the stop flag
+		this.q.put(UPDATE_NONE)
+
+	def apply(this, u, now):
+		leds = this.leds
+		if MODE_ERROR == u.mode:
+			leds.blink(this.MODE_LED, now, on_time=0.5, off_time=0.5)
+		elif MODE_CALIBRATING == u.mode:
+			leds.blink(this.MODE_LED, now, on_time=0.2, off_time=0.2)
+		elif MODE_ANCHOR_LOCK == u.mode:
+			leds.blink(this.MODE_LED, now, on_time=1.5, off_time=0.5)
+		elif MODE_HEADING_LOCK == u.mode:
+			leds.blink(this.MODE_LED, now)
+		elif MODE_READY == u.mode:
+			leds.on(this.MODE_LED, now)
+
+		if TURNING == u.turn:
+			leds.on(this.TURN_LED, now)
+		elif NOT_TURNING == u.turn:
+			leds.off(this.TURN_LED, now)
+		elif MAX_TURN_REACHED == u.turn:
+			leds.blink(this.TURN_LED, now, on_time = 0.5, off_time=0.5)
+		elif TURNING_RESET == u.turn:
+			leds.blink(this.TURN_LED, now, on_time = 0.5, off_time = 0.5, n=5)
+
+		if u.motor:
+			if u.motor <= MOTOR_OFF:
+				leds.off(this.MOTOR_LED, now)
+			elif u.motor < (MOTOR_OFF + 5):
+				leds.blink(this.MOTOR_LED, now, on_time = 1, off_time=0.5)
+			elif u.motor < (MOTOR_OFF + 10):
+				leds.blink(this.MOTOR_LED, now, on_time = 0.5, off_time=0.5)
+			elif u.motor < (MOTOR_OFF + 15):
+				leds.blink(this.MOTOR_LED, now, on_time = 0.25, off_time=0.25)
+			else:
+				leds.on(this.MOTOR_LED, now)
 
 	def run(this):
 		logger.info("Status Loop Starting")
-		this.modeLed.blink(on_time=1.5, off_time=1.5)
-		this.turnLed.off()
-		this.motorLed.off()
-		while True and not this.isStopped():
+		now = this.clock.now()
+		this.leds.blink(this.MODE_LED, now, on_time=1.5, off_time=1.5)
+		nextChange = this.leds.update(now)
+		while not this.isStopped():
+			#Sleep until the next update or the next LED transition, whichever comes first
+			timeout = None if nextChange is None else max(0, nextChange - this.clock.now())
 			try:
-				u = this.q.get_nowait()
-				logger.debug(f"Status Update: {u}")
-				
-				if MODE_ERROR == u.mode:
-					this.modeLed.blink(on_time=0.5, off_time=0.5)
-				elif MODE_ANCHOR_LOCK == u.mode:					
-					this.modeLed.blink(on_time=1.5, off_time=0.5)
-				elif MODE_HEADING_LOCK == u.mode:
-					this.modeLed.blink()
-				elif MODE_READY == u.mode:
-					this.modeLed.on()
-
-				if TURNING == u.turn:
-					this.turnLed.on()
-				elif NOT_TURNING == u.turn:
-					this.turnLed.off()
-				elif MAX_TURN_REACHED == u.turn:
-					this.turnLed.blink(on_time = 0.5, off_time=0.5)
-				elif TURNING_RESET == u.turn:
-					this.turnLed.blink(on_time = 0.5, off_time = 0.5, n=5)
-
-				if u.motor:
-					if u.motor <= MOTOR_OFF:
-						this.motorLed.off()
-					elif u.motor < (MOTOR_OFF + 5):
-						this.motorLed.blink(on_time = 1, off_time=0.5)
-					elif u.motor < (MOTOR_OFF + 10):
-						this.motorLed.blink(on_time = 0.5, off_time=0.5)
-					elif u.motor < (MOTOR_OFF + 15):
-						this.motorLed.blink(on_time = 0.25, off_time=0.25)
-					else:
-						this.motorLed.on()
-
+				u = this.q.get(timeout = timeout)
+				logger.debug("Status Update: %s", u)
+				this.apply(u, this.clock.now())
 			except queue.Empty:
 				pass
-			time.sleep(0.01)
+			nextChange = this.leds.update(this.clock.now())
 		this.modeLed.off()
 		this.turnLed.off()
 		this.motorLed.off()
-			
\ No newline at end of file
@@ -1,16 +1,157 @@
+import os
 import time
+import bisect
 import signal
+import socket
 import sys
 import threading
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import clock as clk
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 uLogger = logging.getLogger(__name__)
 
 def getLogger(name):
 	return logging.getLogger(f"com.sysfian.{name}")
 
-def initLogger(logFile, argv, maxKilobytes = 25, backupCount = 4):
+def argValue(argv, name, default = None):
+	"""Value of a name=value command line argument, default when absent"""
+	prefix = name + "="
+	if argv:
+		for arg in argv:
+			if arg.startswith(prefix):
+				return arg[len(prefix):]
+	return default
+
+class FormattingQueueHandler(QueueHandler):
+	"""
+	Formats each record once on the calling thread and queues it as a (level, text) tuple for
+	 the listener, which then only writes. Queued LogRecords are objects the collector tracks,
+	 so a backlog behind a burst of records made collections on the calling thread scan all of
+	 them. The tuples are untracked by the first young collection. Records below the log level
+	 never get here, so lazy %-style arguments still cost nothing when they are filtered.
+	"""
+	def emit(this, record):
+		try:
+			this.queue.put_nowait((record.levelno, this.format(record)))
+		except Exception:
+			this.handleError(record)
+
+class TextStreamHandler(logging.StreamHandler):
+	"""StreamHandler that also writes text formatted by a FormattingQueueHandler"""
+	def write(this, levelno, text):
+		this.acquire()
+		try:
+			this.stream.write(text + this.terminator)
+			this.flush()
+		except (OSError, ValueError):
+			pass
+		finally:
+			this.release()
+
+class BatchingFileHandler(RotatingFileHandler):
+	"""
+	Rotating file handler that flushes its stream at most every flushSecs instead of after each
+	 record, so a burst of records becomes one write. Records at ERROR or above flush immediately.
+
+	 RotatingFileHandler checks for rollover by formatting each record a second time, stat'ing
+	 the file twice and seeking to its end, and the seek flushes the write buffer. Here the size
+	 is counted as text is written instead.
+	"""
+	def __init__(this, logFile, flushSecs, **kwargs):
+		RotatingFileHandler.__init__(this, logFile, **kwargs)
+		this.flushSecs = flushSecs
+		this.lastFlush = time.monotonic()
+		this.size = os.path.getsize(this.baseFilename) if os.path.exists(this.baseFilename) else 0
+
+	def emit(this, record):
+		try:
+			text = this.format(record)
+		except Exception:
+			this.handleError(record)
+			return
+		this.write(record.levelno, text)
+
+	def write(this, levelno, text):
+		text += this.terminator
+		this.acquire()
+		try:
+			if this.stream is None:
+				this.stream = this._open()
+			if this.maxBytes > 0 and this.size + len(text) >= this.maxBytes:
+				this.doRollover()
+				this.size = 0
+			this.stream.write(text)
+			this.size += len(text)
+			if levelno >= logging.ERROR:
+				this.flushNow()
+		except (OSError, ValueError):
+			pass
+		finally:
+			this.release()
+
+	def flush(this):
+		if time.monotonic() - this.lastFlush >= this.flushSecs:
+			this.flushNow()
+
+	def flushNow(this):
+		RotatingFileHandler.flush(this)
+		this.lastFlush = time.monotonic()
+
+	def close(this):
+		this.acquire()
+		try:
+			if this.stream:
+				this.flushNow()
+		finally:
+			this.release()
+		RotatingFileHandler.close(this)
+
+class BatchingQueueListener(QueueListener):
+	"""
+	Writes the (level, text) tuples queued by a FormattingQueueHandler, and flushes batching
+	 handlers when the queue has been idle for flushSecs.
+	"""
+	def __init__(this, q, flushSecs, *handlers):
+		QueueListener.__init__(this, q, *handlers, respect_handler_level = True)
+		this.flushSecs = flushSecs
+
+	def dequeue(this, block):
+		while True:
+			try:
+				return this.queue.get(block, this.flushSecs)
+			except queue.Empty:
+				for h in this.handlers:
+					if isinstance(h, BatchingFileHandler):
+						h.acquire()
+						try:
+							if h.stream:
+								h.flushNow()
+						finally:
+							h.release()
+
+	def handle(this, item):
+		levelno, text = item
+		for h in this.handlers:
+			if levelno >= h.level:
+				h.write(levelno, text)
+		#Hand the GIL back after every record: a thread waiting for it would otherwise wait out
+		#a whole switch interval while a backlog drains
+		time.sleep(0)
+
+logListener = None
+
+def initLogger(logFile, argv, maxKilobytes = 25, backupCount = 4, queued = True, flushSecs = 2.0):
+	"""
+	Configure the root logger from command line arguments:
+		logLevel=DEBUG|INFO|WARNING|...
+		logQueue=0|1        : write log output on a background listener thread (default on)
+		logFlushSecs=N      : max seconds buffered file output is held before it is written
+		logMaxKB=N, logBackups=N : rotation size and backup count
+	"""
+	global logListener
 	levels = {
 		'NOTSET' : logging.NOTSET,
 		'DEBUG' : logging.DEBUG,
@@ -19,27 +160,48 @@ def initLogger(logFile, argv, maxKilobytes = 25, backupCount = 4):
 		'ERROR' : logging.ERROR,
 		'CRITICAL' : logging.CRITICAL
 	}
-	lstr = 'WARNING'
-	if argv:
-		for arg in argv:
-			if arg.find("logLevel=") != -1:
-				lstr = arg[9:]
+	lstr = argValue(argv, "logLevel", 'WARNING')
 	level = levels[lstr] if lstr in levels else logging.INFO
-	print(f"Setting log level to {level} from arg {lstr}")
+	queued = argValue(argv, "logQueue", "1" if queued else "0") != "0"
+	flushSecs = float(argValue(argv, "logFlushSecs", flushSecs))
+	maxKilobytes = int(argValue(argv, "logMaxKB", maxKilobytes))
+	backupCount = int(argValue(argv, "logBackups", backupCount))
 	logger = logging.getLogger("")
 	logger.setLevel(level)
-	fh = RotatingFileHandler(logFile, maxBytes = maxKilobytes * 1024, backupCount = backupCount)
+	if queued:
+		fh = BatchingFileHandler(logFile, flushSecs, maxBytes = maxKilobytes * 1024, backupCount = backupCount)
+	else:
+		fh = RotatingFileHandler(logFile, maxBytes = maxKilobytes * 1024, backupCount = backupCount)
 	fh.setLevel(level)
-	ch = logging.StreamHandler()
+	ch = TextStreamHandler() if queued else logging.StreamHandler()
 	ch.setLevel(logging.NOTSET)
 	formatter = logging.Formatter('[%(asctime)s][%(threadName)s][%(levelname)s] %(name)s:  %(message)s', datefmt ="%Y-%m-%d %X" )
 	ch.setFormatter(formatter)
 	fh.setFormatter(formatter)
-	logger.addHandler(ch)
-	logger.addHandler(fh)
-	uLogger.info(f"************************************Initialized Root Logger")
+	if queued:
+		q = queue.SimpleQueue()
+		qh = FormattingQueueHandler(q)
+		qh.setFormatter(formatter)
+		logger.addHandler(qh)
+		logListener = BatchingQueueListener(q, flushSecs, ch, fh)
+		logListener.start()
+		atexit.register(stopLogger)
+	else:
+		logger.addHandler(ch)
+		logger.addHandler(fh)
+	uLogger.info(f"************************************Initialized Root Logger (level={lstr}, queued={queued}, flush={flushSecs}s, {maxKilobytes}KB x {backupCount})")
 	return logger
 
+def stopLogger():
+	"""Drain the log queue and flush file output. Safe to call more than once."""
+	global logListener
+	listener = logListener
+	logListener = None
+	if listener:
+		listener.stop()
+		for h in listener.handlers:
+			h.close()
+
 def indent(msg, indentLevel=0):
 	for i in range(indentLevel):
 		msg = "     " + msg
@@ -66,6 +228,31 @@ def signal_handler(sig, cleanup_func):
 	cleanup_func()
 	sys.exit(0) 
 
+def sdNotify(state):
+	"""Send a systemd notification such as READY=1 when running as a Type=notify service, no-op otherwise"""
+	path = os.environ.get("NOTIFY_SOCKET")
+	if not path:
+		return False
+	if path.startswith("@"):
+		path = "\0" + path[1:] #abstract namespace
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+			s.connect(path)
+			s.sendall(state.encode())
+	except OSError as e:
+		uLogger.warning(f"sd_notify {state!r} failed: {e}")
+		return False
+	return True
+
+def startupTimes():
+	""":return (seconds since this process started, seconds since boot)"""
+	sinceBoot = time.clock_gettime(time.CLOCK_BOOTTIME)
+	with open("/proc/self/stat") as f:
+		#Fields after the parenthesized command name start at field 3, starttime is field 22
+		fields = f.read().rsplit(")", 1)[1].split()
+	startedAt = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+	return sinceBoot - startedAt, sinceBoot
+
 class WorkerThread(threading.Thread):
 
 	def __init__(this, name):
@@ -85,3 +272,101 @@ def stopThread(thread, timeoutSecs = 3):
 	thread.join(timeoutSecs)
 	if thread.is_alive():
 		uLogger.warning(f"{thread.name} failed to terminate!!")
+
+class TimerThread(WorkerThread):
+	"""
+	Fires one armed callback at a deadline on `clock` (the clock module's default when None),
+	 waking only when the deadline is due or re-armed. Arming again replaces the pending
+	 deadline. The callback runs on this thread and receives the deadline it was armed with so
+	 stale firings can be recognized.
+	"""
+	def __init__(this, name, clock = None):
+		WorkerThread.__init__(this, name)
+		this.clock = clock or clk.get()
+		this.daemon = True
+		this.cond = threading.Condition()
+		this.deadline = None
+		this.callback = None
+
+	def arm(this, deadline, callback):
+		with this.cond:
+			this.deadline = deadline
+			this.callback = callback
+			this.cond.notify()
+
+	def cancel(this):
+		with this.cond:
+			this.deadline = None
+			this.callback = None
+			this.cond.notify()
+
+	def stop(this):
+		WorkerThread.stop(this)
+		with this.cond:
+			this.cond.notify()
+
+	def run(this):
+		while not this.isStopped():
+			with this.cond:
+				if this.deadline is None:
+					this.cond.wait()
+					continue
+				remaining = this.deadline - this.clock.now()
+				if remaining > 0:
+					this.cond.wait(remaining)
+					continue
+				deadline, callback = this.deadline, this.callback
+				this.deadline = None
+				this.callback = None
+			callback(deadline)
+
+class Histogram(object):
+	"""
+	Fixed bucket histogram. `bounds` are the inclusive upper edges of each bucket, values above
+	 the last edge land in an overflow bucket. Recording is a bisect and an increment.
+	"""
+	def __init__(this, name, bounds, unit = ""):
+		this.name = name
+		this.bounds = list(bounds)
+		this.unit = unit
+		this.reset()
+
+	def reset(this):
+		this.counts = [0] * (len(this.bounds) + 1)
+		this.count = 0
+		this.total = 0
+		this.min = None
+		this.max = None
+
+	def record(this, value):
+		this.counts[bisect.bisect_left(this.bounds, value)] += 1
+		this.count += 1
+		this.total += value
+		if this.min is None or value < this.min:
+			this.min = value
+		if this.max is None or value > this.max:
+			this.max = value
+
+	def percentile(this, pct):
+		"""Upper edge of the bucket holding the pct'th percentile, capped at the largest recorded value"""
+		if this.count == 0:
+			return None
+		rank = pct / 100 * this.count
+		seen = 0
+		for i, c in enumerate(this.counts):
+			seen += c
+			if seen >= rank and c:
+				return min(this.bounds[i], this.max) if i < len(this.bounds) else this.max
+		return this.max
+
+	def mean(this):
+		return this.total / this.count if this.count else None
+
+	def __repr__(this):
+		if this.count == 0:
+			return f"{this.name}: no samples"
+		buckets = " ".join(f"<={b}:{c}" for b, c in zip(this.bounds, this.counts) if c)
+		if this.counts[-1]:
+			buckets += f" >{this.bounds[-1]}:{this.counts[-1]}"
+		return (f"{this.name}: n={this.count} min={this.min:.3f}{this.unit} mean={this.mean():.3f}{this.unit} "
+				f"p50={this.percentile(50):.3f}{this.unit} p99={this.percentile(99):.3f}{this.unit} max={this.max:.3f}{this.unit} [{buckets}]")
@@ -1,4 +1,4 @@
-import board
+# Pins are BCM GPIO numbers (board.Dn == n), so nothing here imports hardware libraries
 
 LOG_FILE = '/var/lib/kotacon/kotacon.log'
 
@@ -6,27 +6,92 @@ LOG_FILE = '/var/lib/kotacon/kotacon.log'
 # Maximum time the trolling motor can be turned one direction from the middle
 MAX_TURN_TIME_SECS = 3.5
 TURN_DEBOUNCE_SECS = 1.5
+# Time the motor keeps turning after the turn relays drop. Scheduled turn stops are issued this much early
+TURN_ACTUATION_DELAY_SECS = 0.05
 
-STATUS_PIN1 = board.D13
-STATUS_PIN2 = board.D19
-STATUS_PIN3 = board.D26
+STATUS_PIN1 = 13
+STATUS_PIN2 = 19
+STATUS_PIN3 = 26
 
-TURN_MASTER_RELAY_PIN = board.D18
-TURN_POWER_RELAY_PIN = board.D23
-TURN_GROUND_RELAY_PIN = board.D24
+TURN_MASTER_RELAY_PIN = 18
+TURN_POWER_RELAY_PIN = 23
+TURN_GROUND_RELAY_PIN = 24
 
-SPEED_MASTER_RELAY_PIN = board.D25
-SPEED_R1_RELAY_PIN = board.D8
-SPEED_R2_RELAY_PIN = board.D7
-SPEED_R3_RELAY_PIN = board.D1
-SPEED_R4_RELAY_PIN = board.D12
+SPEED_MASTER_RELAY_PIN = 25
+SPEED_R1_RELAY_PIN = 8
+SPEED_R2_RELAY_PIN = 7
+SPEED_R3_RELAY_PIN = 1
+SPEED_R4_RELAY_PIN = 12
 
-RX_PIN = board.D11
+RX_PIN = 11
+# RF decoder: "rpi_rf" (RPi.GPIO edge callbacks) or "gpiod" (kernel timestamped edges, needs pip3 install gpiod)
+RX_RECEIVER = "rpi_rf"
 
 #Heading Sensor QMC5883L
 #Must use SDA & SCL Pins and I2C must be enabled on Pi
+HEADING_SAMPLE_HZ = 100
+HEADING_WINDOW = 25
+# Hard/soft-iron correction, written by heading.py calibrate or by holding LEFT for CALIBRATE_HOLD_SECS
+MAG_CALIBRATION_FILE = '/var/lib/kotacon/magcal.json'
+CALIBRATE_HOLD_SECS = 10
+CALIBRATION_SECS = 60
+
+# Flight recorder: 32 byte snapshots in a memory mapped ring (10 Hz for 6 hours is ~7 MB)
+RECORDER_FILE = '/var/lib/kotacon/recorder.bin'
+RECORDER_HZ = 10
+RECORDER_HOURS = 6
+
+# Prometheus text metrics for the control loop, also dumped to the log on SIGUSR1
+METRICS_SOCKET = '/var/lib/kotacon/metrics.sock'
+
+# Remote gestures: holding GO for LONG_PRESS_SECS locks the heading, GO_EXTRA_LONG_SECS stops and anchors.
+# Holding STOP for LONG_PRESS_SECS releases the locks and stops, STOP_EXTRA_LONG_SECS resets the turn heading.
+# A second tap within DOUBLE_TAP_SECS of releasing the first is a double tap.
+LONG_PRESS_SECS = 2
+GO_EXTRA_LONG_SECS = 5
+STOP_EXTRA_LONG_SECS = 10
+DOUBLE_TAP_SECS = 0.6
+
+# Profiles written by profile=sample|cprofile, SIGUSR2 or holding STOP for PROFILE_HOLD_SECS
+PROFILE_DIR = '/var/lib/kotacon'
+PROFILE_SECS = 60
+PROFILE_HOLD_SECS = 20
+
+# realtime=1 pins the event loop and turn timer to REALTIME_CONTROL_CPUS and the RF threads to REALTIME_RX_CPUS
+# at SCHED_FIFO REALTIME_PRIORITY / REALTIME_RX_PRIORITY. With rtGC=idle a full collection runs every REALTIME_GC_FULL_SECS.
+REALTIME_CONTROL_CPUS = "3"
+REALTIME_RX_CPUS = "2"
+REALTIME_PRIORITY = 50
+REALTIME_RX_PRIORITY = 60
+REALTIME_GC_FULL_SECS = 60
+
+# Heading hold law: "continuous" (PD with a trimming integral) or "bucketed" (fixed turn times by error size)
+HEADING_CONTROL = "continuous"
+
+# Anchor lock deadband: motor off within ANCHOR_RADIUS_METERS, drive back once past ANCHOR_RELEASE_METERS.
+# Distances are anticipated ANCHOR_LEAD_SECS ahead from a line through the last ANCHOR_FIXES GPS fixes.
+# Driving back starts at ANCHOR_SPEED and steps up one setting per ANCHOR_METERS_PER_SPEED of distance.
+ANCHOR_RADIUS_METERS = 3
+ANCHOR_RELEASE_METERS = 8
+ANCHOR_LEAD_SECS = 3
+ANCHOR_FIXES = 15
+ANCHOR_SPEED = 4
+ANCHOR_METERS_PER_SPEED = 2
 
 #GPS Module connects to RX/TX pins
+# GPS_SOURCE "gpsd" reads gpsd's JSON stream at GPSD_HOST:GPSD_PORT, "serial" reads GPS_SERIAL_PORT directly.
+# gpsd falls back to the serial port when it cannot be reached.
+GPS_SOURCE = "gpsd"
+GPSD_HOST = "127.0.0.1"
+GPSD_PORT = 2947
+GPS_SERIAL_PORT = '/dev/serial0'
+GPS_BAUD_RATE = 9600
+
+# Startup waits up to these for the first GPS bytes (gpsd's greeting or NMEA), a first magnetometer sample
+# and the RF receiver decoding edges. A device that misses its wait is used anyway and reported not ready.
+GPS_READY_SECS = 2
+HEADING_READY_SECS = 1
+RF_READY_SECS = 1
 
 
 
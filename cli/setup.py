@@ -18,6 +18,7 @@ setuptools.setup(
 		'adafruit-circuitpython-dht',
 		'pyserial',
 		'rpi_rf',
-		'py_qmc5883l'
+		'py_qmc5883l',
+		'numpy'
 	],
 )
\ No newline at end of file
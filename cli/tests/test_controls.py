@@ -0,0 +1,76 @@
+import hal
+import controls as ctl
+
+MASTER, POWER, GROUND = 5, 6, 13
+
+class RecordingDevice(object):
+	"""OutputDevice stand-in that logs every write to the shared list"""
+	def __init__(this, pin, writes):
+		this.pin = pin
+		this.writes = writes
+		this.state = 0
+
+	@property
+	def value(this):
+		return this.state
+
+	@value.setter
+	def value(this, v):
+		this.state = 1 if v else 0
+		this.writes.append((this.pin, this.state))
+
+class RecordingBackend(object):
+	"""Writes lines one at a time like the gpiozero fallback and the simulator"""
+	def __init__(this):
+		this.writes = []
+
+	def relayBank(this, name, pins, **kwargs):
+		return hal.DeviceRelayBank(name, {pin : RecordingDevice(pin, this.writes) for pin in pins})
+
+def direction():
+	backend = RecordingBackend()
+	previous = hal.get()
+	hal.install(backend)
+	try:
+		return ctl.Direction(MASTER, POWER, GROUND), backend.writes
+	finally:
+		hal.install(previous)
+
+def assertNoShort(writes):
+	state = {MASTER : 0, POWER : 0, GROUND : 0}
+	for pin, v in writes:
+		if pin in (POWER, GROUND):
+			assert not state[MASTER], f"{'power' if pin == POWER else 'ground'} switched with the master on in {writes}"
+		state[pin] = v
+		assert not (state[MASTER] and state[POWER] != state[GROUND]), f"3/6 shorted in {writes}"
+
+def test_stopped_to_left():
+	d, writes = direction()
+	d.turnLeft()
+	assert writes == [(MASTER, 1)]
+
+def test_stopped_to_right():
+	d, writes = direction()
+	d.turnRight()
+	assertNoShort(writes)
+	assert writes == [(POWER, 1), (GROUND, 1), (MASTER, 1)]
+
+def test_reversals():
+	d, writes = direction()
+	d.turnLeft()
+	del writes[:]
+	d.turnRight()
+	assertNoShort([(MASTER, 1)] + writes)
+	assert writes == [(MASTER, 0), (POWER, 1), (GROUND, 1), (MASTER, 1)]
+	del writes[:]
+	d.turnLeft()
+	assert writes == [(MASTER, 0), (POWER, 0), (GROUND, 0), (MASTER, 1)]
+
+def test_same_direction_and_stop():
+	d, writes = direction()
+	d.turnRight()
+	del writes[:]
+	d.turnRight()
+	assert writes == []
+	d.stop()
+	assert writes == [(MASTER, 0), (POWER, 0), (GROUND, 0)]
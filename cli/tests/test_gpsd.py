@@ -0,0 +1,128 @@
+import time
+import socket
+import pytest
+import hal
+import gpsd
+import autopilot
+import status
+import utils
+
+def waitFor(condition, seconds = 5):
+	deadline = time.monotonic() + seconds
+	while not condition():
+		if time.monotonic() >= deadline:
+			return False
+		time.sleep(0.01)
+	return True
+
+@pytest.fixture
+def server():
+	s = gpsd.FakeGPSD(rateHz = 20)
+	s.start()
+	yield s
+	s.close()
+
+def reader(server):
+	r = autopilot.GPSDReader(gpsd.Connection(server.host, server.port, 0.2))
+	r.start()
+	return r
+
+def test_3d_fix(server):
+	server.latitude, server.longitude, server.altitude = 44.5, -93.25, 300.0
+	server.satellites = 7
+	server.horizontalError = 1.5
+	r = reader(server)
+	try:
+		assert waitFor(lambda: r.latest.isValid() and r.latest.satellites is not None)
+		fix = r.latest
+		assert (fix.latitude, fix.longitude, fix.altitude) == (44.5, -93.25, 300.0)
+		assert fix.mode == gpsd.MODE_3D
+		assert fix.satellites == 7
+		assert fix.hdop == 0.9
+		assert fix.horizontalError == 1.5
+	finally:
+		utils.stopThread(r)
+
+def test_2d_fix(server):
+	server.mode = gpsd.MODE_2D
+	r = reader(server)
+	try:
+		assert waitFor(lambda: r.latest.isValid())
+		assert r.latest.mode == gpsd.MODE_2D
+	finally:
+		utils.stopThread(r)
+
+def test_no_fix_is_ignored(server):
+	server.mode = gpsd.MODE_NO_FIX
+	r = reader(server)
+	try:
+		assert waitFor(lambda: r.parser.reports >= 10)
+		assert not r.latest.isValid()
+		server.mode = gpsd.MODE_3D
+		assert waitFor(lambda: r.latest.isValid())
+	finally:
+		utils.stopThread(r)
+
+def test_report_split_across_chunks(server):
+	parser = gpsd.GPSDParser()
+	data = server.sky() + server.tpv(0)
+	records = []
+	for i in range(0, len(data), 5):
+		records += parser.feed(data[i:i + 5])
+	assert [type(r) for r in records] == [gpsd.SKYReport, gpsd.TPVReport]
+	assert records[0].used == server.satellites
+	assert records[1].mode == gpsd.MODE_3D
+	assert parser.buffer == b''
+
+def test_corrupt_report(server):
+	parser = gpsd.GPSDParser()
+	records = parser.feed(b'{"class":"TPV","mode":3,"lat":\n' + b'not json\n' + server.tpv(0))
+	assert len(records) == 1 and isinstance(records[0], gpsd.TPVReport)
+	assert parser.decodeErrors == 2
+
+def test_reconnects_after_restart(server):
+	r = reader(server)
+	try:
+		assert waitFor(lambda: r.latest.isValid())
+		port = server.port
+		server.close()
+		restarted = gpsd.FakeGPSD(port = port, latitude = 45.0, rateHz = 20)
+		restarted.start()
+		try:
+			assert waitFor(lambda: r.latest.latitude == 45.0)
+		finally:
+			restarted.close()
+	finally:
+		utils.stopThread(r)
+
+class FakeSerial(object):
+	def read(this, size = 1):
+		return b''
+
+	def close(this):
+		pass
+
+class FallbackBackend(object):
+	def gpsdConnection(this, host, port, timeout):
+		return gpsd.Connection(host, port, timeout)
+
+	def gpsSerial(this, port, baudrate, timeout):
+		this.serialPort = port
+		return FakeSerial()
+
+def closedPort():
+	with socket.socket() as s:
+		s.bind((gpsd.DEFAULT_HOST, 0))
+		return s.getsockname()[1]
+
+def test_falls_back_to_serial_when_refused():
+	backend = FallbackBackend()
+	previous = hal.get()
+	hal.install(backend)
+	try:
+		nav = autopilot.Navigation(status.StatusChannel(), 1.5, openDevices = False)
+		nav.openGPS("/dev/serial0", 9600, 0.5, "gpsd", gpsd.DEFAULT_HOST, closedPort())
+	finally:
+		hal.install(previous)
+	assert type(nav.gpsReader) is autopilot.GPSReader
+	assert backend.serialPort == "/dev/serial0"
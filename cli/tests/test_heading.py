@@ -0,0 +1,45 @@
+import struct
+import heading
+
+class FakeBus(object):
+	"""QMC5883L registers over smbus: reading any data register clears DRDY, like the chip does"""
+	def __init__(this):
+		this.registers = [0] * 7
+
+	def sample(this, x, y, z):
+		this.registers[:6] = list(struct.pack("<hhh", x, y, z))
+		this.registers[6] |= heading.STAT_DRDY
+
+	def read_byte_data(this, address, register):
+		return this.read(register, 1)[0]
+
+	def read_i2c_block_data(this, address, register, length):
+		return this.read(register, length)
+
+	def read(this, register, length):
+		data = []
+		for r in range(register, register + length):
+			data.append(this.registers[r])
+			if r < 6:
+				this.registers[6] &= ~heading.STAT_DRDY
+		return data
+
+class FakeSensor(object):
+	def __init__(this):
+		this.bus = FakeBus()
+		this.address = 0x0d
+
+def test_burst_read_returns_each_sample_once():
+	sensor = FakeSensor()
+	assert heading.burstRead(sensor) is None
+	sensor.bus.sample(100, -200, 300)
+	assert heading.burstRead(sensor) == (100, -200, 300)
+	assert heading.burstRead(sensor) is None
+	sensor.bus.sample(-1, 2, -3)
+	assert heading.burstRead(sensor) == (-1, 2, -3)
+
+def test_burst_read_skips_overflow():
+	sensor = FakeSensor()
+	sensor.bus.sample(1, 2, 3)
+	sensor.bus.registers[6] |= heading.STAT_OVL
+	assert heading.burstRead(sensor) is None
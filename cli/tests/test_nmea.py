@@ -0,0 +1,100 @@
+import pytest
+import nmea
+
+RMC = "GPRMC,123519.00,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W"
+GGA = "GPGGA,123519.00,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,"
+
+def test_rmc_and_gga():
+	rmc, gga = nmea.NMEAParser().feed(nmea.sentence(RMC) + nmea.sentence(GGA))
+	assert isinstance(rmc, nmea.RMCFix)
+	assert rmc.talker == b'GP' and rmc.valid
+	assert rmc.time == pytest.approx(12 * 3600 + 35 * 60 + 19)
+	assert rmc.latitude == pytest.approx(48 + 7.038 / 60)
+	assert rmc.longitude == pytest.approx(11 + 31.0 / 60)
+	assert (rmc.speedKnots, rmc.course, rmc.date) == (22.4, 84.4, 230394)
+	assert isinstance(gga, nmea.GGAFix)
+	assert (gga.quality, gga.satellites, gga.hdop, gga.altitude) == (1, 8, 0.9, 545.4)
+
+def test_bad_checksum():
+	parser = nmea.NMEAParser()
+	good = nmea.sentence(RMC)
+	bad = good.replace(b'*', b'0*', 1)
+	assert parser.feed(bad) == []
+	assert parser.feed(good[:-4] + b'ZZ\r\n') == []
+	assert parser.feed(good.replace(b'*', b'', 1)) == []
+	assert parser.checksumErrors == 3
+	assert parser.sentences == 0
+	assert len(parser.feed(good)) == 1
+
+def test_checksum_hex_case():
+	good = nmea.sentence(RMC)
+	assert len(nmea.NMEAParser().feed(good[:-4] + good[-4:-2].lower() + b'\r\n')) == 1
+
+@pytest.mark.parametrize("talker", ["GN", "GL", "GA"])
+def test_talkers(talker):
+	rmc, gga = nmea.NMEAParser().feed(nmea.sentence(talker + RMC[2:]) + nmea.sentence(talker + GGA[2:]))
+	assert rmc.talker == gga.talker == talker.encode()
+	assert isinstance(rmc, nmea.RMCFix) and isinstance(gga, nmea.GGAFix)
+
+def test_split_across_chunks():
+	parser = nmea.NMEAParser()
+	data = nmea.sentence(RMC) + nmea.sentence(GGA)
+	records = []
+	for i in range(0, len(data), 7):
+		records += parser.feed(data[i:i + 7])
+	assert [type(r) for r in records] == [nmea.RMCFix, nmea.GGAFix]
+	assert parser.buffer == b''
+
+def test_one_byte_at_a_time():
+	parser = nmea.NMEAParser()
+	data = nmea.sentence(GGA)
+	records = []
+	for i in range(len(data)):
+		records += parser.feed(data[i:i + 1])
+	assert len(records) == 1 and records[0].satellites == 8
+
+def test_garbage_before_start():
+	parser = nmea.NMEAParser()
+	records = parser.feed(b'\x00\xff\x12junk' + nmea.sentence(RMC) + b'more junk\r\n' + nmea.sentence(GGA))
+	assert [type(r) for r in records] == [nmea.RMCFix, nmea.GGAFix]
+	assert parser.checksumErrors == 0
+
+def test_runaway_line_resyncs():
+	parser = nmea.NMEAParser()
+	assert parser.feed(b'x' * (nmea.MAX_SENTENCE_LENGTH + 10)) == []
+	assert len(parser.buffer) <= nmea.MAX_SENTENCE_LENGTH
+	assert len(parser.feed(nmea.sentence(RMC))) == 1
+
+def test_void_rmc_with_empty_fields():
+	rmc, = nmea.NMEAParser().feed(nmea.sentence("GPRMC,123519.00,V,,,,,,,230394,,,N"))
+	assert not rmc.valid
+	assert rmc.latitude is None and rmc.longitude is None
+	assert rmc.speedKnots is None and rmc.course is None
+	assert rmc.time == pytest.approx(12 * 3600 + 35 * 60 + 19)
+
+def test_rmc_without_time():
+	rmc, = nmea.NMEAParser().feed(nmea.sentence("GNRMC,,V,,,,,,,,,,N"))
+	assert rmc.time is None and rmc.date is None and not rmc.valid
+
+def test_gga_without_fix():
+	gga, = nmea.NMEAParser().feed(nmea.sentence("GPGGA,,,,,,0,,,,,,,,"))
+	assert (gga.quality, gga.satellites) == (0, 0)
+	assert gga.latitude is None and gga.hdop is None and gga.altitude is None
+
+def test_south_west_hemispheres():
+	rmc, gga = nmea.NMEAParser().feed(
+		nmea.sentence("GPRMC,000000.00,A,3351.000,S,15112.600,W,0.0,0.0,010120,,,A") +
+		nmea.sentence("GPGGA,000000.00,3351.000,S,15112.600,W,1,05,1.2,10.0,M,,M,,"))
+	for fix in (rmc, gga):
+		assert fix.latitude == pytest.approx(-(33 + 51.0 / 60))
+		assert fix.longitude == pytest.approx(-(151 + 12.6 / 60))
+
+def test_invalid_hemisphere_is_a_decode_error():
+	parser = nmea.NMEAParser()
+	assert parser.feed(nmea.sentence("GPRMC,000000.00,A,3351.000,X,15112.600,W,0.0,0.0,010120,,,A")) == []
+	assert parser.decodeErrors == 1
+
+def test_unsupported_sentence():
+	parser = nmea.NMEAParser()
+	assert parser.feed(nmea.sentence("GPGSV,3,1,11,03,03,111,00")) == []
+	assert parser.unsupported == 1